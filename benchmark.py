@@ -0,0 +1,293 @@
+import argparse
+import logging
+import os
+import sys
+
+import torch
+import torch.backends.cudnn as cudnn
+
+from yolact_edge.data import cfg, set_cfg
+from yolact_edge.yolact import Yolact
+from yolact_edge.utils import timer
+from yolact_edge.utils.shapes import image_size
+from yolact_edge.utils.memory import TensorMemory
+from yolact_edge.utils.benchmark import environment, stage_stats, save_results, load_results, \
+    compare_results, print_comparison
+
+import eval as eval_script
+
+
+# The models benchmarked by default. The trainflow configs are left out since they only run the flow net.
+MODEL_CONFIGS = [
+    'yolact_edge_mobilenetv2_config',
+    'yolact_edge_vid_config',
+    'yolact_edge_vid_minimal_config',
+    'yolact_edge_youtubevis_config',
+    'yolact_resnet50_config',
+    'yolact_resnet152_config',
+    'yolact_edge_resnet50_config',
+    'yolact_edge_vid_resnet50_config',
+    'yolact_edge_youtubevis_resnet50_config',
+]
+
+
+def int_list(v):
+    return [int(x) for x in v.split(',')]
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark the per-stage latency and throughput of YOLACT Edge models on synthetic inputs')
+    parser.add_argument('--configs', default=','.join(MODEL_CONFIGS), type=lambda v: v.split(','),
+                        help='Comma separated config objects to benchmark. Defaults to every inference config.')
+    parser.add_argument('--sizes', default=None, type=int_list,
+                        help='Comma separated input sizes (overriding max_size of the configs). Defaults to max_size of each config.')
+    parser.add_argument('--batch_sizes', default=[1], type=int_list,
+                        help='Comma separated batch sizes to run each config and size with.')
+    parser.add_argument('--warmup', default=10, type=int,
+                        help='The number of iterations to run before timing, to let caches and cudnn settle.')
+    parser.add_argument('--iterations', default=50, type=int,
+                        help='The number of timed iterations of each run.')
+    parser.add_argument('--trained_model', default=None, type=str,
+                        help='Weights to load. Only for a single config. By default the weights are random (but seeded).')
+    parser.add_argument('--conf_thresh', default=None, type=float,
+                        help='Override the confidence threshold of Detect. With random weights, next to nothing passes the default of 0.05, so set this to 0 to time Detect, Postprocess and display on a full set of detections.')
+    parser.add_argument('--cuda', default=torch.cuda.is_available(), type=eval_script.str2bool,
+                        help='Run on the GPU. Defaults to whether one is available.')
+    parser.add_argument('--num_threads', default=None, type=int,
+                        help='The number of threads torch uses on the CPU. Fix this for comparable CPU results.')
+    parser.add_argument('--output_buffers', default=False, dest='output_buffers', action='store_true',
+                        help='Reuse the output buffers of the prediction heads and protonet from frame to frame (see Yolact.use_output_buffers), and measure how many bytes of the outputs are still allocated per frame after warmup, over --memory_iterations frames.')
+    parser.add_argument('--channels_last', default=False, dest='channels_last', action='store_true',
+                        help='Run the models and their inputs in the channels last memory format (see Yolact.use_channels_last).')
+    parser.add_argument('--fused_heads', default=False, dest='fused_heads', action='store_true',
+                        help='Run the prediction heads of every FPN level straight into one output tensor (see Yolact.use_fused_heads).')
+    parser.add_argument('--inference_mode', default=False, dest='inference_mode', action='store_true',
+                        help='Run under torch.inference_mode() instead of torch.no_grad().')
+    parser.add_argument('--memory', default=False, dest='memory', action='store_true',
+                        help='After timing each run, measure the peak and retained memory of each stage over a few more frames.')
+    parser.add_argument('--memory_iterations', default=5, type=int,
+                        help='The number of frames to measure memory over with --memory and --output_buffers.')
+    parser.add_argument('--seed', default=0, type=int,
+                        help='The seed for the random weights and inputs.')
+    parser.add_argument('--output', default='results/benchmark.json', type=str,
+                        help='Where to write the results as JSON.')
+    parser.add_argument('--compare', default=None, nargs=2, metavar=('BASE', 'NEW'),
+                        help='Instead of benchmarking, compare two result files and exit with 1 if any stage regressed.')
+    parser.add_argument('--metric', default='p50', choices=['mean', 'p50', 'p95', 'p99'],
+                        help='The statistic to compare.')
+    parser.add_argument('--threshold', default=0.1, type=float,
+                        help='How much slower (as a fraction) a stage has to get to count as a regression.')
+    parser.add_argument('--min_delta', default=0.1, type=float,
+                        help='How many ms slower a stage has to get to count as a regression, so that noise in tiny stages isn\'t reported.')
+
+    global args
+    args = parser.parse_args(argv)
+
+
+def build_net(device):
+    # Benchmark the plain PyTorch modules, not the ones meant to be converted to TensorRT
+    for key in [k for k in vars(cfg) if k.startswith('torch2trt_') and k != 'torch2trt_max_calibration_images']:
+        setattr(cfg, key, False)
+
+    torch.manual_seed(args.seed)
+    net = Yolact(training=False)
+    if args.trained_model is not None:
+        net.load_weights(args.trained_model)
+    else:
+        net.create_partial_backbone()
+    net.eval()
+
+    net.detect.use_fast_nms = True
+    cfg.mask_proto_debug = False
+    if args.conf_thresh is not None:
+        net.detect.conf_thresh = args.conf_thresh
+    if args.output_buffers:
+        net.use_output_buffers()
+    if args.channels_last:
+        net.use_channels_last()
+    if args.fused_heads:
+        net.use_fused_heads()
+
+    return net.to(device)
+
+
+def run_frames(net, images, frames, extras, mode, num_frames):
+    for _ in range(num_frames):
+        with timer.env(mode):
+            dets = net(images, extras=extras)["pred_outs"]
+
+            with timer.env('display'):
+                for idx in range(images.size(0)):
+                    eval_script.prep_display(dets[idx:idx+1], frames[idx], None, None, undo_transform=False)
+
+            if args.cuda:
+                torch.cuda.synchronize()
+
+
+def output_allocations(net, images, extras, num_frames):
+    """
+    Runs num_frames more frames and returns the most bytes of the network's outputs (everything it hands to Detect)
+    that were allocated during a frame, from the tensors TensorMemory sees allocated in it. Once the output buffers
+    have warmed up this should be 0, since every output is written into a buffer allocated before.
+    """
+    detect = net.detect
+    allocated = []
+
+    def check_outputs(pred_outs):
+        allocated[-1] += sum(v.untyped_storage().nbytes() for v in pred_outs.values()
+                             if torch.is_tensor(v) and counter.tracks(v))
+        return detect(pred_outs)
+
+    net.detect = check_outputs
+    try:
+        for _ in range(num_frames):
+            counter = TensorMemory(images.device.type)
+            allocated.append(0)
+            counter.start()
+            try:
+                net(images, extras=extras)
+            finally:
+                counter.stop()
+    finally:
+        net.detect = detect
+
+    return max(allocated)
+
+
+def benchmark(net, batch_size, mode, device):
+    """
+    Times warmup + iterations frames of mode ('keyframe' or 'non-keyframe') and returns the run's results. With
+    --memory, the memory of each stage is then measured separately, since measuring it slows everything down.
+    """
+    width, height = image_size()
+    generator = torch.Generator().manual_seed(args.seed)
+    images = torch.randn(batch_size, 3, height, width, generator=generator).to(device)
+    if args.channels_last:
+        images = images.contiguous(memory_format=torch.channels_last)
+    frames = torch.randint(0, 256, (batch_size, height, width, 3), generator=generator).float().to(device)
+
+    # Video models keep the features of keyframes to warp them to the frames that follow
+    extras = {"backbone": "full", "interrupt": False, "keep_statistics": cfg.flow.warp_mode != 'none',
+              "moving_statistics": None}
+
+    with torch.inference_mode(args.inference_mode), torch.no_grad():
+        if mode == 'non-keyframe':
+            outs = net(images, extras={"backbone": "full", "interrupt": False, "keep_statistics": True,
+                                       "moving_statistics": {"conf_hist": []}})
+            extras = {"backbone": "partial", "interrupt": False, "keep_statistics": False,
+                      "moving_statistics": {"conf_hist": [], "feats": outs["feats"], "lateral": outs["lateral"]}}
+
+        run_frames(net, images, frames, extras, mode, args.warmup)
+        timer.profiler.clear()
+
+        run_frames(net, images, frames, extras, mode, args.iterations)
+        stages = stage_stats(timer.stats(), mode)
+
+        run = {
+            'config': cfg.name,
+            'size': cfg.max_size,
+            'batch_size': batch_size,
+            'mode': mode,
+            'throughput': batch_size * 1000 / stages['total']['mean'],
+            'stages': stages,
+        }
+
+        if args.output_buffers:
+            run['output_buffers'] = dict(net.output_buffers.stats(), output_bytes_allocated_after_warmup=
+                                         output_allocations(net, images, extras, args.memory_iterations))
+
+        if args.memory:
+            timer.profiler.clear()
+            timer.start_memory(device)
+            try:
+                run_frames(net, images, frames, extras, mode, args.memory_iterations)
+            finally:
+                timer.stop_memory()
+            run['memory'] = {stage: s['memory'] for stage, s in stage_stats(timer.stats(), mode).items()}
+
+    return run
+
+
+def run_all():
+    device = torch.device('cuda' if args.cuda else 'cpu')
+    if args.cuda:
+        cudnn.benchmark = True
+        torch.set_default_tensor_type('torch.cuda.FloatTensor')
+        timer.use_device_events(True)
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+
+    # prep_display reads the display settings from eval's arguments, so use its defaults
+    eval_script.parse_args([])
+    timer.enable_all()
+
+    runs = []
+    for config in args.configs:
+        set_cfg(config)
+        if cfg.flow.train_flow:
+            logger.warning('Skipping {}, which only trains the flow net.'.format(config))
+            continue
+
+        modes = ['keyframe']
+        if cfg.flow.warp_mode != 'none':
+            modes.append('non-keyframe')
+
+        for size in args.sizes or [cfg.max_size]:
+            cfg.max_size = size
+            net = build_net(device)
+
+            for batch_size in args.batch_sizes:
+                for mode in modes:
+                    run = benchmark(net, batch_size, mode, device)
+                    runs.append(run)
+                    logger.info('{} {} b{} {}: {:.2f} ms ({:.1f} images/s)'.format(
+                        config, size, batch_size, mode, run['stages']['total']['p50'], run['throughput']))
+                    if args.output_buffers:
+                        logger.info('  output bytes allocated per frame after warmup: {}'.format(
+                            run['output_buffers']['output_bytes_allocated_after_warmup']))
+                    if args.memory:
+                        logger.info('  peak memory per frame: {}'.format(', '.join(
+                            '{} {:.1f} MB'.format(counter, m['peak_max'] / 2**20)
+                            for counter, m in run['memory']['total'].items())))
+
+            del net
+
+    return {
+        'environment': environment(device),
+        'settings': {'warmup': args.warmup, 'iterations': args.iterations, 'memory_iterations': args.memory_iterations
+                     if args.memory else None, 'seed': args.seed,
+                     'conf_thresh': args.conf_thresh, 'trained_model': args.trained_model,
+                     'output_buffers': args.output_buffers, 'channels_last': args.channels_last,
+                     'fused_heads': args.fused_heads, 'inference_mode': args.inference_mode},
+        'runs': runs,
+    }
+
+
+if __name__ == '__main__':
+    parse_args()
+
+    from yolact_edge.utils.logging_helper import setup_logger
+    setup_logger(logging_level=logging.INFO)
+    logger = logging.getLogger("yolact.benchmark")
+
+    if args.compare is not None:
+        base, new = [load_results(path) for path in args.compare]
+        if base['environment'].get('device_name', base['environment']['processor']) != \
+                new['environment'].get('device_name', new['environment']['processor']):
+            logger.warning('The results are from different devices.')
+
+        rows, unmatched = compare_results(base, new, metric=args.metric, threshold=args.threshold,
+                                          min_delta=args.min_delta)
+        print_comparison(rows, unmatched, metric=args.metric)
+        sys.exit(1 if any(row[-1] for row in rows) else 0)
+
+    if args.trained_model is not None and len(args.configs) > 1:
+        raise ValueError('--trained_model can only be used with a single config.')
+
+    if os.path.dirname(args.output):
+        os.makedirs(os.path.dirname(args.output), exist_ok=True)
+
+    results = run_all()
+    save_results(args.output, results)
+    logger.info('Wrote the results to {}.'.format(args.output))
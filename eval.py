@@ -1,13 +1,16 @@
 from yolact_edge.data import COCODetection, YoutubeVIS, get_label_map, MEANS, COLORS
 from yolact_edge.data import cfg, set_cfg, set_dataset
 from yolact_edge.yolact import Yolact
-from yolact_edge.utils.augmentations import BaseTransform, BaseTransformVideo, FastBaseTransform, Resize
+from yolact_edge.utils.augmentations import BaseTransform, BaseTransformVideo, FastBaseTransform, FastUint8Transform, Resize
 from yolact_edge.utils.functions import MovingAverage, ProgressBar
 from yolact_edge.layers.box_utils import jaccard, center_size
 from yolact_edge.utils import timer
+from yolact_edge.utils import metrics
 from yolact_edge.utils.functions import SavePath
 from yolact_edge.layers.output_utils import postprocess, undo_image_transformation
 from yolact_edge.utils.tensorrt import convert_to_tensorrt
+from yolact_edge.utils.optimize import optimize_for_inference
+from yolact_edge.utils.quantization import quantize_int8
 
 import pycocotools
 
@@ -134,6 +137,22 @@ def parse_args(argv=None):
                         help='This replaces all TensorRT INT8 optimization with FP16 optimization when specified.')
     parser.add_argument('--use_tensorrt_safe_mode', default=False, dest='use_tensorrt_safe_mode', action='store_true',
                         help='This enables the safe mode that is a workaround for various TensorRT engine issues.')
+    parser.add_argument('--quantize_int8', default=False, dest='quantize_int8', action='store_true',
+                        help='Quantize the network to int8 for CPU inference (needs --cuda=False) instead of converting it to TensorRT. Calibrates on --calib_images and logs a comparison against fp32.')
+    parser.add_argument('--optimize_for_inference', default=False, dest='optimize_for_inference', action='store_true',
+                        help='Fold batch norms into convs and drop training-only layers before running. Outputs only change by float rounding.')
+    parser.add_argument('--channels_last', default=False, dest='channels_last', action='store_true',
+                        help='Run the model and its inputs in the channels last memory format, which is faster for convolutions on most CPUs. Not for TensorRT, so use it with --disable_tensorrt.')
+    parser.add_argument('--output_buffers', default=True, type=str2bool,
+                        help='In the video modes, reuse the output buffers of the prediction heads and protonet from frame to frame instead of allocating them every time (see Yolact.use_output_buffers).')
+    parser.add_argument('--fused_heads', default=False, dest='fused_heads', action='store_true',
+                        help='Run the prediction heads of every FPN level straight into one output tensor instead of concatenating their outputs. Falls back to the usual heads for TensorRT and configs it doesn\'t support.')
+    parser.add_argument('--inference_mode', default=False, dest='inference_mode', action='store_true',
+                        help='Evaluate under torch.inference_mode() instead of only torch.no_grad(). The threads of the video pipeline still only use no_grad.')
+    parser.add_argument('--trace', default=None, type=str,
+                        help='Record every timed stage (with its thread and the frame / keyframe it was for) and write them to this file as a Chrome trace, for chrome://tracing or ui.perfetto.dev.')
+    parser.add_argument('--metrics_port', default=None, type=int,
+                        help='Collect metrics (frames in and out, dropped frames, stage latencies, keyframes, detections and queue sizes) and serve them for Prometheus at http://127.0.0.1:<port>/metrics.')
 
     parser.set_defaults(no_bar=False, display=False, resume=False, output_coco_json=False, output_web_json=False, shuffle=False,
                         benchmark=False, no_sort=False, no_hash=False, mask_proto_debug=False, crop=True, detect=False)
@@ -167,7 +186,8 @@ def prep_display(dets_out, img, h, w, undo_transform=True, class_color=False, ma
         t = postprocess(dets_out, w, h, visualize_lincomb = args.display_lincomb,
                                         crop_masks        = args.crop,
                                         score_threshold   = args.score_threshold)
-        torch.cuda.synchronize()
+        if img_gpu.is_cuda:
+            torch.cuda.synchronize()
 
     with timer.env('Copy'):
         if cfg.eval_mask_branch:
@@ -211,7 +231,7 @@ def prep_display(dets_out, img, h, w, undo_transform=True, class_color=False, ma
         masks = masks[:num_dets_to_consider, :, :, None]
         
         # Prepare the RGB images for each mask given their color (size [num_dets, h, w, 1])
-        colors = torch.cat([get_color(j, on_gpu=img_gpu.device.index).view(1, 1, 1, 3) for j in range(num_dets_to_consider)], dim=0)
+        colors = torch.cat([get_color(j, on_gpu=img_gpu.device).view(1, 1, 1, 3) for j in range(num_dets_to_consider)], dim=0)
         masks_color = masks.repeat(1, 1, 1, 3) * colors * mask_alpha
 
         # This is 1 everywhere except for 1-mask_alpha where the mask is
@@ -584,9 +604,15 @@ def badhash(x):
     x =  ((x >> 16) ^ x) & 0xFFFFFFFF
     return x
 
+def memory_format():
+    """ The memory format the network takes its input in. """
+    return torch.channels_last if args.channels_last else torch.contiguous_format
+
 def evalimage(net:Yolact, path:str, save_path:str=None, detections:Detections=None, image_id=None):
-    frame = torch.from_numpy(cv2.imread(path)).cuda().float()
-    batch = FastBaseTransform()(frame.unsqueeze(0))
+    frame = torch.from_numpy(cv2.imread(path))
+    if args.cuda:
+        frame = frame.cuda()
+    batch = FastUint8Transform(memory_format=memory_format())(frame.unsqueeze(0))
 
     if cfg.flow.warp_mode != 'none':
         assert False, "Evaluating the image with a video-based model. If you believe this is a problem, please report a issue at GitHub, thanks."
@@ -661,6 +687,11 @@ def evalvideo(net:Yolact, path:str):
         print('Could not open video "%s"' % path)
         exit(-1)
     
+    # Replicas on several GPUs would share the one buffer pool. Frame N's detections (which keep a view of its
+    # prototypes) are drawn while frame N+1 runs through the network, so there are two frames in flight.
+    if args.output_buffers and torch.cuda.device_count() <= 1:
+        net.use_output_buffers(num_slots=2)
+
     net = CustomDataParallel(net).cuda()
     transform = torch.nn.DataParallel(FastBaseTransform()).cuda()
     frame_times = MovingAverage(400)
@@ -675,24 +706,38 @@ def evalvideo(net:Yolact, path:str):
 
     def cleanup_and_exit():
         print()
+        if args.trace is not None:
+            timer.save_trace(args.trace)
         pool.terminate()
         vid.release()
         cv2.destroyAllWindows()
         exit()
 
     def get_next_frame(vid):
-        return [vid.read()[1] for _ in range(args.video_multiframe)]
+        with timer.env('Read Frame'):
+            frames = []
+            for _ in range(args.video_multiframe):
+                ret, frame = vid.read()
+                if ret:
+                    metrics.frames_in().inc()
+                elif is_webcam or vid.get(cv2.CAP_PROP_POS_FRAMES) < vid.get(cv2.CAP_PROP_FRAME_COUNT):
+                    # A file that has no frames left just ended, so only count the reads that skip a frame
+                    metrics.frames_dropped().inc()
+                frames.append(frame)
+            return frames
 
     def transform_frame(frames):
-        with torch.no_grad():
+        with torch.no_grad(), timer.env('Transform'):
             frames = [torch.from_numpy(frame).cuda().float() for frame in frames]
             return frames, transform(torch.stack(frames, 0))
 
     def eval_network(inp):
         nonlocal frame_idx
-        with torch.no_grad():
+        with torch.no_grad(), timer.env('Network'):
             frames, imgs = inp
-            if frame_idx % every_k_frames == 0 or cfg.flow.warp_mode == 'none':
+            keyframe = frame_idx % every_k_frames == 0 or cfg.flow.warp_mode == 'none'
+            timer.annotate(frame=frame_idx, keyframe=keyframe)
+            if keyframe:
                 extras = {"backbone": "full", "interrupt": False, "keep_statistics": True,
                         "moving_statistics": moving_statistics}
 
@@ -709,12 +754,14 @@ def evalvideo(net:Yolact, path:str):
                 with torch.no_grad():
                     net_outs = net(imgs, extras=extras)
             frame_idx += 1
+            metrics.network_frames().labels(keyframe=str(keyframe).lower()).inc(len(frames))
 
             return frames, net_outs["pred_outs"]
 
     def prep_frame(inp):
-        with torch.no_grad():
+        with torch.no_grad(), timer.env('Prep Frame'):
             frame, preds = inp
+            metrics.detections().observe(0 if preds[0] is None else preds[0]['box'].size(0))
             return prep_display(preds, frame, None, None, undo_transform=False, class_color=True)
 
     frame_buffer = Queue()
@@ -738,6 +785,7 @@ def evalvideo(net:Yolact, path:str):
                     video_frame_times.add(next_time - last_time)
                     video_fps = 1 / video_frame_times.get_avg()
                 cv2.imshow(path, frame_buffer.get())
+                metrics.frames_out().inc()
                 last_time = next_time
 
             if cv2.waitKey(1) == 27: # Press Escape to close
@@ -811,6 +859,9 @@ def evalvideo(net:Yolact, path:str):
         
         # Finish loading in the next frames and add them to the processing queue
         active_frames.append({'value': next_frames.get(), 'idx': len(sequence)-1})
+
+        metrics.queue_size().labels(queue='frame_buffer').set(frame_buffer.qsize())
+        metrics.queue_size().labels(queue='active_frames').set(len(active_frames))
         
         # Compute FPS
         inference_time = time.time() - start_time
@@ -834,10 +885,14 @@ def savevideo(net:Yolact, in_path:str, out_path:str):
     
     out = cv2.VideoWriter(out_path, cv2.VideoWriter_fourcc(*"mp4v"), target_fps, (frame_width, frame_height))
 
-    transform = FastBaseTransform()
+    transform = FastUint8Transform(memory_format=memory_format())
     frame_times = MovingAverage()
     progress_bar = ProgressBar(30, num_frames)
 
+    # Each frame is written out before the next one runs
+    if args.output_buffers:
+        net.use_output_buffers()
+
     frame_idx = 0
     every_k_frames = 5
     moving_statistics = {"conf_hist": []}
@@ -846,12 +901,15 @@ def savevideo(net:Yolact, in_path:str, out_path:str):
         for i in range(num_frames):
             timer.reset()
             frame_idx = i
+            keyframe = frame_idx % every_k_frames == 0 or cfg.flow.warp_mode == 'none'
+            timer.annotate(frame=frame_idx, keyframe=keyframe)
             with timer.env('Video'):
-                frame = torch.from_numpy(vid.read()[1]).cuda().float()
+                frame = torch.from_numpy(vid.read()[1]).cuda()
+                metrics.frames_in().inc()
                 batch = transform(frame.unsqueeze(0))
                 # preds = net(batch)
 
-                if frame_idx % every_k_frames == 0 or cfg.flow.warp_mode == 'none':
+                if keyframe:
                     extras = {"backbone": "full", "interrupt": False, "keep_statistics": True,
                             "moving_statistics": moving_statistics}
 
@@ -869,10 +927,13 @@ def savevideo(net:Yolact, in_path:str, out_path:str):
                         net_outs = net(batch, extras=extras)
                 
                 preds = net_outs["pred_outs"]
+                metrics.network_frames().labels(keyframe=str(keyframe).lower()).inc()
+                metrics.detections().observe(0 if preds[0] is None else preds[0]['box'].size(0))
 
                 processed = prep_display(preds, frame, None, None, undo_transform=False, class_color=True)
 
                 out.write(processed)
+                metrics.frames_out().inc()
             
             if i > 1:
                 frame_times.add(timer.total_time())
@@ -1011,6 +1072,7 @@ def evaluate(net:Yolact, dataset, train_mode=False, train_cfg=None):
                             if not train_cfg.dataset.use_all_frames or frame_idx % frame_eval_stride == pass_idx or not meet_annot or \
                                     (train_cfg.flow.warp_mode == 'none' and not train_cfg.flow.use_spa):
                                 if frame_idx % frame_eval_stride == pass_idx: meet_annot = True
+                                timer.annotate(video=it, frame=frame_idx, keyframe=True)
                                 with timer.env('Network Extra'):
                                     extras = {
                                         "backbone": "full",
@@ -1028,6 +1090,7 @@ def evaluate(net:Yolact, dataset, train_mode=False, train_cfg=None):
                             if frame_idx % frame_eval_stride != pass_idx and meet_annot and \
                                     (train_cfg.flow.warp_mode != 'none' or train_cfg.flow.use_spa):
                                 if not train_cfg.dataset.use_all_frames: timer.reset() # TODO: this is in-accurate approx
+                                timer.annotate(video=it, frame=frame_idx, keyframe=False)
                                 with timer.env('Network Extra'):
                                     extras = {
                                         "backbone": "partial",
@@ -1077,6 +1140,7 @@ def evaluate(net:Yolact, dataset, train_mode=False, train_cfg=None):
             # Main eval loop
             for it, image_idx in enumerate(dataset_indices):
                 timer.reset()
+                timer.annotate(image=it)
 
                 with timer.env('Load Data'):
                     img, gt, gt_masks, h, w, num_crowd = dataset.pull_item(image_idx)
@@ -1143,6 +1207,8 @@ def evaluate(net:Yolact, dataset, train_mode=False, train_cfg=None):
             print()
             print('Stats for the last frame:')
             timer.print_stats()
+            print('Stats for all frames:')
+            timer.print_summary()
             avg_seconds = frame_times.get_avg()
             print('Average: %5.2f fps, %5.2f ms' % (1 / frame_times.get_avg(), 1000*avg_seconds))
 
@@ -1157,6 +1223,8 @@ def evaluate(net:Yolact, dataset, train_mode=False, train_cfg=None):
             print()
             print('Stats for the last frame:')
             timer.print_stats()
+            print('Stats for all frames:')
+            timer.print_summary()
             avg_seconds = frame_times.get_avg()
             print('Average: %5.2f fps, %5.2f ms' % (1 / frame_times.get_avg(), 1000*avg_seconds))
 
@@ -1272,11 +1340,40 @@ if __name__ == '__main__':
         net.eval()
         logger.info('Model loaded.')
 
-        convert_to_tensorrt(net, cfg, args, transform=BaseTransform())
+        if args.optimize_for_inference:
+            optimize_for_inference(net)
+
+        # The TensorRT engines are built for and fed NCHW inputs
+        uses_tensorrt = not (args.quantize_int8 or args.disable_tensorrt) and any(
+            getattr(cfg, key) for key in vars(cfg) if key.startswith('torch2trt_') and key != 'torch2trt_max_calibration_images')
+        if args.channels_last and uses_tensorrt:
+            raise ValueError('--channels_last can\'t be used with TensorRT. Run with --disable_tensorrt to use it.')
+
+        if args.quantize_int8:
+            quantize_int8(net, cfg, args, transform=BaseTransform())
+        else:
+            convert_to_tensorrt(net, cfg, args, transform=BaseTransform())
 
         if args.cuda:
             net = net.cuda()
 
-        evaluate(net, dataset)
+        if args.channels_last:
+            net.use_channels_last()
+
+        if args.fused_heads:
+            net.use_fused_heads()
+
+        if args.trace is not None:
+            timer.start_trace()
+
+        if args.metrics_port is not None:
+            metrics.enable(args.metrics_port)
+
+        with torch.inference_mode(args.inference_mode):
+            evaluate(net, dataset)
+
+        if args.trace is not None:
+            timer.save_trace(args.trace)
+            logger.info('Saved a trace of the timed stages to {}.'.format(args.trace))
 
 
@@ -0,0 +1,155 @@
+import os
+
+# Tracing for export can't go through modules compiled with torch.jit, so don't compile them in the first place
+os.environ.setdefault('PYTORCH_JIT', '0')
+
+import argparse
+import logging
+import sys
+
+import torch
+
+from yolact_edge.data import cfg, set_cfg
+from yolact_edge.yolact import Yolact
+from yolact_edge.utils.functions import SavePath
+from yolact_edge.utils.onnx_export import InferenceGraph, export_onnx
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Export YOLACT Edge to ONNX')
+    parser.add_argument('--trained_model', default=None, type=str,
+                        help='Trained state_dict file path to export. If not specified, the exported weights are random.')
+    parser.add_argument('--config', default=None,
+                        help='The config object to use. If not specified, it\'s parsed from the name of --trained_model.')
+    parser.add_argument('--output', default=None, type=str,
+                        help='Where to write the graphs. <output>_keyframe.onnx and (for video models) <output>_nonkeyframe.onnx are written. Defaults to the name of the config in weights/.')
+    parser.add_argument('--nms', default=False, dest='nms', action='store_true',
+                        help='Include box decoding and fast NMS in the graphs, so that they output the top detections instead of every prior.')
+    parser.add_argument('--opset', default=16, type=int,
+                        help='The ONNX opset to export with. The non-keyframe path needs at least 16 for grid_sample.')
+    parser.add_argument('--conf_thresh', default=None, type=float,
+                        help='Override the confidence threshold of the NMS in the graphs. With random weights, next to nothing passes the default of 0.05, so set this to 0 to --check the NMS outputs.')
+    parser.add_argument('--check', default=False, dest='check', action='store_true',
+                        help='Run the exported graphs with onnxruntime at batch size 2 and compare them against PyTorch. Exits with 1 if any output differs by more than --atol + --rtol * the PyTorch value.')
+    parser.add_argument('--atol', default=1e-4, type=float,
+                        help='The absolute tolerance of --check.')
+    parser.add_argument('--rtol', default=1e-3, type=float,
+                        help='The relative tolerance of --check.')
+
+    global args
+    args = parser.parse_args(argv)
+
+
+def sorted_detections(outputs, names):
+    """
+    The valid detections (score > 0) of each image in the NMS outputs, sorted by score and then box, so that
+    detections with tied scores line up. Returns the rows of every image concatenated for each of names.
+    """
+    import numpy as np
+
+    rows = {name: [] for name in names}
+    for idx in range(outputs['scores'].shape[0]):
+        scores, boxes = outputs['scores'][idx], outputs['boxes'][idx]
+        valid = np.nonzero(scores > 0)[0]
+        # Round the keys so that float noise between the two runs doesn't change the order
+        keys = [np.round(boxes[valid, i], 4) for i in reversed(range(4))] + [-np.round(scores[valid], 5)]
+        order = valid[np.lexsort(keys)]
+        for name in names:
+            rows[name].append(outputs[name][idx][order])
+    return {name: np.concatenate(rows[name]) for name in names}
+
+
+def check(graph, path):
+    """ Compares the graph at path run by onnxruntime with PyTorch. Returns whether every output matched. """
+    import numpy as np
+    import onnxruntime
+
+    images = torch.randn_like(graph.example_inputs(batch_size=2)[0])
+
+    with torch.no_grad():
+        if graph.keyframe:
+            inputs = (images,)
+        else:
+            inputs = graph.inputs_after(images, InferenceGraph(graph.net, keyframe=True)(images))
+        expected = graph(*inputs)
+
+    session = onnxruntime.InferenceSession(path, providers=['CPUExecutionProvider'])
+    outputs = session.run(None, {name: x.numpy() for name, x in zip(graph.input_names, inputs)})
+
+    outputs = dict(zip(graph.output_names, outputs))
+    expected = {name: exp.numpy() for name, exp in zip(graph.output_names, expected)}
+
+    if graph.nms is not None:
+        num_valid = [int((scores > 0).sum()) for scores in (outputs['scores'], expected['scores'])]
+        if num_valid[1] == 0:
+            logger.error('No detection cleared conf_thresh ({}), so the NMS outputs can\'t be compared. '
+                         'Check with --conf_thresh=0 or trained weights.'.format(graph.nms.conf_thresh))
+            return False
+        if num_valid[0] != num_valid[1]:
+            logger.error('onnxruntime returned {} detections and PyTorch {}.'.format(*num_valid))
+            return False
+
+        # Only the valid detections are compared, in the same order
+        names = ['boxes', 'scores', 'classes', 'coeffs']
+        outputs.update(sorted_detections(outputs, names))
+        expected.update(sorted_detections(expected, names))
+        logger.info('Comparing {} detections.'.format(num_valid[1]))
+
+    matched = True
+    for name in graph.output_names:
+        out, exp = outputs[name], expected[name]
+        close = out.shape == exp.shape and np.allclose(out, exp, rtol=args.rtol, atol=args.atol)
+        diff = np.abs(out - exp).max() if out.shape == exp.shape and out.size > 0 else 0
+        logger.info('{:>8}: {:<20} max abs diff {:.2e}{}'.format(
+            name, str(tuple(out.shape)), diff, '' if close else '  <- mismatch'))
+        matched = matched and close
+
+    return matched
+
+
+if __name__ == '__main__':
+    parse_args()
+
+    if args.config is not None:
+        set_cfg(args.config)
+    elif args.trained_model is not None:
+        args.config = SavePath.from_str(args.trained_model).model_name + '_config'
+        set_cfg(args.config)
+
+    if args.output is None:
+        args.output = os.path.join('weights', cfg.name)
+
+    from yolact_edge.utils.logging_helper import setup_logger
+    setup_logger(logging_level=logging.INFO)
+    logger = logging.getLogger("yolact.export")
+
+    # Build the plain PyTorch modules, not the ones meant to be converted to TensorRT
+    for key in [k for k in vars(cfg) if k.startswith('torch2trt_') and k != 'torch2trt_max_calibration_images']:
+        setattr(cfg, key, False)
+
+    net = Yolact(training=False)
+    if args.trained_model is not None:
+        net.load_weights(args.trained_model)
+    else:
+        logger.warning("No weights loaded!")
+        net.create_partial_backbone()
+    net.eval()
+
+    if args.conf_thresh is not None:
+        net.detect.conf_thresh = args.conf_thresh
+
+    paths = [(True, args.output + '_keyframe.onnx')]
+    if cfg.flow is not None and cfg.flow.warp_mode != 'none':
+        paths.append((False, args.output + '_nonkeyframe.onnx'))
+
+    os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+
+    failed = False
+    for keyframe, path in paths:
+        graph = export_onnx(net, path, keyframe=keyframe, nms=args.nms, opset_version=args.opset)
+        if args.check and not check(graph, path):
+            logger.error('The {} path doesn\'t match PyTorch.'.format('keyframe' if keyframe else 'non-keyframe'))
+            failed = True
+
+    sys.exit(1 if failed else 0)
@@ -1,6 +1,10 @@
 from yolact_edge.utils import timer
 from yolact_edge.data import *
 from yolact_edge.utils.augmentations import SSDAugmentation, SSDAugmentationVideo, BaseTransform, BaseTransformVideo
+from yolact_edge.utils.augmentations import SSDAugmentationPhotometric
+from yolact_edge.utils.batch_augmentations import BatchedSSDAugmentation
+from yolact_edge.data.prefetcher import DataPrefetcher
+from yolact_edge.utils.checkpoint import CheckpointWriter, load_training_state
 from yolact_edge.utils.functions import MovingAverage, SavePath
 from yolact_edge.layers.modules import MultiBoxLoss
 from yolact_edge.layers.modules.optical_flow_loss import OpticalFlowLoss
@@ -26,6 +30,7 @@ import torch.multiprocessing as mp
 from yolact_edge.utils.logging_helper import setup_logger
 import logging
 import random
+import contextlib
 
 # Oof
 import eval as eval_script
@@ -42,8 +47,8 @@ parser.add_argument('--resume', default=None, type=str,
                     help='Checkpoint state_dict file to resume training from. If this is "interrupt"'\
                          ', the model will resume training from the interrupt file.')
 parser.add_argument('--start_iter', default=0, type=int,
-                    help='Resume training at this iter. If this is -1, the iteration will be'\
-                         'determined from the file name.')
+                    help='Resume training at this iter. If this is -1, the iteration will be '\
+                         'taken from the saved training state (see --save_training_state) or else the file name.')
 parser.add_argument('--random_seed', default=42, type=int,
                     help='Random seed used across all workers')
 parser.add_argument('--num_workers', default=4, type=int,
@@ -90,6 +95,16 @@ parser.add_argument('--interrupt_no_save', dest='interrupt_no_save', action='sto
                     help='Just exit when keyboard interrupt occurs for testing.')
 parser.add_argument('--no_warmup_rescale', dest='warmup_rescale', action='store_false',
                     help='Do not rescale warmup coefficients on multiple GPU training.')
+parser.add_argument('--no_prefetch', dest='prefetch', action='store_false',
+                    help='Do not copy the next batch to the GPU while training on the current one.')
+parser.add_argument('--save_training_state', dest='save_training_state', action='store_true',
+                    help='Also save the optimizer state next to each checkpoint, so --resume picks up exactly where it left off.')
+parser.add_argument('--accumulate_steps', default=1, type=int,
+                    help='Accumulate gradients over this many batches per iteration, so the effective batch size is '\
+                         'batch_size * num_gpus * accumulate_steps. Only for image datasets.')
+parser.add_argument('--amp', default=None, type=str, choices=['fp16', 'bf16'],
+                    help='Train with automatic mixed precision in this dtype. The losses are still computed in fp32. '\
+                         'bf16 also works on the CPU (with --cuda=false).')
 
 parser.set_defaults(keep_latest=False)
 args = parser.parse_args()
@@ -128,12 +143,14 @@ else:
 
 def multi_gpu_rescale(args):
     # auto rescale parameters when GPU count > 1 or batch size is not 8
-    scale_factor = args.num_gpus * args.batch_size // 8
+    # With gradient accumulation an iteration covers accumulate_steps batches, so count those too. Effective
+    # batches smaller than 8 aren't scaled down, since that would zero the lr and the number of iterations.
+    scale_factor = max(1, args.num_gpus * args.batch_size * args.accumulate_steps // 8)
     args.lr *= scale_factor
     global lr
     lr = args.lr
 
-    if args.warmup_rescale:
+    if args.warmup_rescale and args.num_gpus > 1:
         cfg.lr_warmup_init = 0
         cfg.lr_warmup_until = 1000
 
@@ -144,7 +161,10 @@ def multi_gpu_rescale(args):
 
 
 def train(rank, args):
-    if args.num_gpus > 1:
+    if args.accumulate_steps > 1 and (cfg.dataset.is_video or cfg.dataset.name == 'FlyingChairs'):
+        raise NotImplementedError('Gradient accumulation is only supported when training on image datasets.')
+
+    if args.num_gpus > 1 or args.accumulate_steps > 1:
         multi_gpu_rescale(args)
     if rank == 0:
         if not os.path.exists(args.save_folder):
@@ -187,6 +207,15 @@ def train(rank, args):
         logger.info('Multiple GPUs detected! Turning off JIT.')
 
     collate_fn = detection_collate
+
+    # With batched augmentation, the workers only decode and do the photometric distortion
+    if cfg.augment_batched:
+        image_transform = SSDAugmentationPhotometric(MEANS)
+        image_collate_fn = padded_detection_collate
+    else:
+        image_transform = SSDAugmentation(MEANS)
+        image_collate_fn = detection_collate
+
     if cfg.dataset.name == 'YouTube VIS':
         dataset = YoutubeVIS(image_path=cfg.dataset.train_images,
                              info_file=cfg.dataset.train_info,
@@ -196,8 +225,8 @@ def train(rank, args):
         if cfg.dataset.joint == 'coco':
             joint_dataset = COCODetection(image_path=cfg.joint_dataset.train_images,
                                           info_file=cfg.joint_dataset.train_info,
-                                          transform=SSDAugmentation(MEANS))
-            joint_collate_fn = detection_collate
+                                          transform=image_transform)
+            joint_collate_fn = image_collate_fn
 
         if args.validation_epoch > 0:
             setup_eval()
@@ -216,7 +245,8 @@ def train(rank, args):
     else:
         dataset = COCODetection(image_path=cfg.dataset.train_images,
                                 info_file=cfg.dataset.train_info,
-                                transform=SSDAugmentation(MEANS))
+                                transform=image_transform)
+        collate_fn = image_collate_fn
 
         if args.validation_epoch > 0:
             setup_eval()
@@ -228,6 +258,10 @@ def train(rank, args):
     if args.cuda:
         torch.cuda.set_device(rank)
 
+    batch_augment = None
+    if cfg.augment_batched:
+        batch_augment = BatchedSSDAugmentation(torch.device('cuda', rank) if args.cuda else torch.device('cpu'))
+
     # Parallel wraps the underlying module, but when saving and loading we don't want that
     yolact_net = Yolact()
     net = yolact_net
@@ -248,10 +282,16 @@ def train(rank, args):
     if args.resume is not None:
         logger.info('Resuming training, loading {}...'.format(args.resume))
         yolact_net.load_weights(args.resume, args=args)
+        training_state = load_training_state(args.resume)
 
         if args.start_iter == -1:
-            args.start_iter = SavePath.from_str(args.resume).iteration
+            # The saved training state has the exact iteration, the file name only does if train.py named the file
+            if training_state is not None:
+                args.start_iter = training_state['iteration']
+            else:
+                args.start_iter = SavePath.from_str(args.resume).iteration
     else:
+        training_state = None
         logger.info('Initializing weights...')
         yolact_net.init_weights(backbone_path=args.save_folder + cfg.backbone.path)
 
@@ -276,12 +316,42 @@ def train(rank, args):
                           lr=args.lr, momentum=args.momentum,
                           weight_decay=args.decay)
 
+    # With mixed precision the forward passes run under autocast, the losses in fp32 (see MultiBoxLoss) and the
+    # backward pass goes through a GradScaler. fp16 needs the loss scaling to keep small gradients from flushing
+    # to zero, but bf16 has the same range as fp32 so the scaler is just a pass-through there.
+    if args.amp is not None:
+        if args.amp == 'fp16' and not args.cuda:
+            raise ValueError('--amp fp16 needs CUDA, use --amp bf16 to train in mixed precision on the CPU.')
+        amp_dtype = torch.float16 if args.amp == 'fp16' else torch.bfloat16
+        autocast = lambda: torch.autocast('cuda' if args.cuda else 'cpu', dtype=amp_dtype)
+        logger.info('Using mixed precision training in {}'.format(args.amp))
+    else:
+        autocast = contextlib.nullcontext
+    scaler = torch.cuda.amp.GradScaler(enabled=args.amp == 'fp16')
+    amp_skipped_steps = 0
+
+    if training_state is not None:
+        logger.info('Restoring optimizer state from iter {}'.format(training_state['iteration']))
+        optimizer.load_state_dict(training_state['optimizer'])
+        if training_state.get('scaler'):
+            scaler.load_state_dict(training_state['scaler'])
+
+    # Checkpoints are written on a background thread so training doesn't wait on the disk
+    checkpoint_writer = CheckpointWriter()
+
+    def save_checkpoint(path):
+        training_state = None
+        if args.save_training_state:
+            # No epoch, the training loop works that out from the iteration
+            training_state = {'optimizer': optimizer.state_dict(), 'scaler': scaler.state_dict(), 'iteration': iteration}
+        checkpoint_writer.save(path, yolact_net.state_dict(), training_state)
+
     # loss counters
     iteration = max(args.start_iter, 0)
     w.set_step(iteration)
     last_time = time.time()
 
-    epoch_size = len(dataset) // args.batch_size // args.num_gpus
+    epoch_size = len(dataset) // args.batch_size // args.num_gpus // args.accumulate_steps
     num_epochs = math.ceil(cfg.max_iter / epoch_size)
     
     # Which learning rate adjustment step are we on? lr' = lr * gamma ^ step_index
@@ -300,6 +370,12 @@ def train(rank, args):
                                   batch_sampler=train_sampler)
     data_loader_iter = iter(data_loader)
 
+    # Overlap the host to device copy of the next batch with the current step
+    prefetch_device = torch.device('cuda', rank) if args.cuda and args.prefetch else torch.device('cpu')
+    # Batched augmentation reads the targets on the CPU, so don't send them over only to copy them back
+    host_targets = batch_augment is not None and not cfg.dataset.is_video and cfg.dataset.name != 'FlyingChairs'
+    data_loader_iter = DataPrefetcher(data_loader_iter, prefetch_device, host_targets=host_targets)
+
     if cfg.dataset.joint:
         joint_infinite_sampler = InfiniteSampler(joint_dataset, seed=args.random_seed, num_replicas=args.num_gpus,
                                            rank=rank, shuffle=True)
@@ -309,7 +385,8 @@ def train(rank, args):
                                             collate_fn=joint_collate_fn,
                                             multiprocessing_context="fork" if args.num_workers > 1 else None,
                                             batch_sampler=joint_train_sampler)
-        joint_data_loader_iter = iter(joint_data_loader)
+        joint_data_loader_iter = DataPrefetcher(iter(joint_data_loader), prefetch_device,
+                                                host_targets=batch_augment is not None)
 
     save_path = lambda epoch, iteration: SavePath(cfg.name, epoch, iteration).get_path(root=args.save_folder)
     time_avg = MovingAverage()
@@ -333,9 +410,7 @@ def train(rank, args):
         loss = sum([losses[k] for k in losses])
 
         # Backprop
-        loss.backward()  # Do this to free up vram even if loss is not finite
-        if torch.isfinite(loss).item():
-            optimizer.step()
+        backward_and_step(loss)
 
         # Add the loss to the moving average for bookkeeping
         for k in losses:
@@ -344,6 +419,99 @@ def train(rank, args):
 
         return losses
 
+    def accumulate_and_log(prefix, micro_batches):
+        """
+        Like backward_and_log, but does a single optimizer step over several batches. The losses are normalized
+        over all of them as if they were one batch, and gradients are only synced across GPUs for the last one.
+        """
+        optimizer.zero_grad()
+
+        # Only one micro-batch is prepared (and augmented) at a time to keep the memory of a single batch, but the
+        # losses are normalized by the targets of all of them. The batched augmentation changes the targets, so
+        # draw it for every micro-batch up front and only resample the images and masks in the loop.
+        if batch_augment is not None:
+            augmentations = [batch_augment.draw(datum) for datum in micro_batches]
+            all_targets = [(targets, num_crowds) for targets, num_crowds, _ in augmentations]
+        else:
+            augmentations = [None] * len(micro_batches)
+            all_targets = [(targets, num_crowds) for _, (targets, _, num_crowds) in micro_batches]
+        total_batch_size = sum(datum[0].size(0) for datum in micro_batches)
+
+        norm = None
+        total_losses = {}
+        finite = True
+
+        for idx, augmentation in enumerate(augmentations):
+            datum, micro_batches[idx] = micro_batches[idx], None
+            if augmentation is not None:
+                datum = batch_augment.apply(datum, augmentation)
+            images, targets, masks, num_crowds = prepare_data(datum)
+            del datum
+
+            last = idx == len(micro_batches) - 1
+            sync = contextlib.nullcontext if last or not misc.is_distributed_initialized() else net.no_sync
+
+            with sync():
+                extras = {"backbone": "full", "interrupt": False,
+                          "moving_statistics": {"aligned_feats": []}}
+                with autocast():
+                    net_outs = net(images, extras=extras)
+                out = net_outs["pred_outs"]
+
+                # Which priors are positive doesn't depend on the network, so count them for every batch up front
+                if norm is None and not cfg.use_prediction_matching:
+                    priors = out['priors']
+                    num_pos = sum(criterion.num_positives(priors, [t.to(priors.device) for t in batch_targets], batch_crowds)
+                                  for batch_targets, batch_crowds in all_targets)
+                    norm = (num_pos.float(), total_batch_size)
+
+                losses = criterion(out, targets, masks, num_crowds, norm=norm)
+                losses = {k: v.mean() for k, v in losses.items()}  # Mean here because Dataparallel
+                if cfg.use_prediction_matching:
+                    # The best we can do is to average the per-batch normalized losses
+                    losses = {k: v / len(micro_batches) for k, v in losses.items()}
+
+                loss = sum([losses[k] for k in losses])
+                scaler.scale(loss).backward()
+                finite = finite and torch.isfinite(loss).item()
+
+            for k in losses:
+                total_losses[k] = total_losses.get(k, 0) + losses[k].item()
+
+            # Free this micro-batch before the next one is prepared
+            del images, targets, masks, net_outs, out, loss
+
+        # With fp16 the scaler finds the inf / nan gradients itself, skips the step and backs off the scale
+        if finite or scaler.is_enabled():
+            optimizer_step()
+
+        # Add the loss to the moving average for bookkeeping
+        for k in total_losses:
+            loss_avgs[k].add(total_losses[k])
+            w.add_scalar('{prefix}/{key}'.format(prefix=prefix, key=k), total_losses[k])
+
+        return total_losses
+
+    def backward_and_step(loss):
+        scaler.scale(loss).backward()  # Do this to free up vram even if loss is not finite
+        # With fp16 the scaler finds the inf / nan gradients itself, skips the step and backs off the scale
+        if scaler.is_enabled() or torch.isfinite(loss).item():
+            optimizer_step()
+
+    def optimizer_step():
+        nonlocal amp_skipped_steps
+
+        scale = scaler.get_scale()
+        scaler.step(optimizer)
+        scaler.update()
+
+        if scaler.is_enabled():
+            # The scaler skips the step and backs off the scale when it finds inf or nan gradients
+            if scaler.get_scale() < scale:
+                amp_skipped_steps += 1
+            w.add_scalar('amp/loss_scale', scaler.get_scale())
+            w.add_scalar('amp/skipped_steps', amp_skipped_steps)
+
     logger.info('Begin training!')
     # try-except so you can use ctrl+c to save early and stop training
     try:
@@ -399,36 +567,44 @@ def train(rank, args):
 
                 if cfg.dataset.name == "FlyingChairs":
                     imgs_1, imgs_2, flows = prepare_flow_data(datum)
-                    net_outs = net(None, extras=(imgs_1, imgs_2))
+                    with autocast():
+                        net_outs = net(None, extras=(imgs_1, imgs_2))
                     # Compute Loss
                     optimizer.zero_grad()
 
-                    losses = criterion(net_outs, flows)
+                    losses = criterion([x.float() for x in net_outs], flows)
 
                     losses = { k: v.mean() for k,v in losses.items() } # Mean here because Dataparallel
                     loss = sum([losses[k] for k in losses])
 
                     # Backprop
-                    loss.backward() # Do this to free up vram even if loss is not finite
-                    if torch.isfinite(loss).item():
-                        optimizer.step()
+                    backward_and_step(loss)
 
                     # Add the loss to the moving average for bookkeeping
                     for k in losses:
                         loss_avgs[k].add(losses[k].item())
                         w.add_scalar('loss/%s' % k, losses[k].item())
                 
+                elif args.accumulate_steps > 1:
+                    micro_batches = [datum] + [next(data_loader_iter) for _ in range(args.accumulate_steps - 1)]
+                    losses = accumulate_and_log("compute", micro_batches)
+
                 elif cfg.dataset.joint or not cfg.dataset.is_video:
                     if cfg.dataset.joint:
                         joint_datum = next(joint_data_loader_iter)
+                        if batch_augment is not None:
+                            joint_datum = batch_augment(joint_datum)
                         # Load training data
                         # Note, for training on multiple gpus this will use the custom replicate and gather I wrote up there
                         images, targets, masks, num_crowds = prepare_data(joint_datum)
                     else:
+                        if batch_augment is not None:
+                            datum = batch_augment(datum)
                         images, targets, masks, num_crowds = prepare_data(datum)
                     extras = {"backbone": "full", "interrupt": False,
                               "moving_statistics": {"aligned_feats": []}}
-                    net_outs = net(images,extras=extras)
+                    with autocast():
+                        net_outs = net(images,extras=extras)
                     run_name = "joint" if cfg.dataset.joint else "compute"
                     losses = backward_and_log(run_name, net_outs, targets, masks, num_crowds)
 
@@ -443,7 +619,7 @@ def train(rank, args):
                         extras = {"backbone": "full", "interrupt": True, "keep_statistics": True,
                                   "moving_statistics": moving_statistics}
 
-                        with torch.no_grad():
+                        with torch.no_grad(), autocast():
                             net_outs = net(images, extras=extras)
 
                         moving_statistics["feats"] = net_outs["feats"]
@@ -462,7 +638,8 @@ def train(rank, args):
 
                     extras = {"backbone": "full", "interrupt": not cfg.flow.base_backward,
                               "moving_statistics": moving_statistics}
-                    gt_net_outs = net(images, extras=extras)
+                    with autocast():
+                        gt_net_outs = net(images, extras=extras)
                     if cfg.flow.base_backward:
                         losses = backward_and_log("compute", gt_net_outs, targets, masks, num_crowds)
 
@@ -475,8 +652,10 @@ def train(rank, args):
                         reference_frame = references[0]
                         extras = {"backbone": "partial", "moving_statistics": moving_statistics}
 
-                        net_outs = net(images, extras=extras)
-                        extra_loss = yolact_net.extra_loss(net_outs, gt_net_outs)
+                        with autocast():
+                            net_outs = net(images, extras=extras)
+                            extra_loss = yolact_net.extra_loss(net_outs, gt_net_outs)
+                        extra_loss = {k: v.float() for k, v in extra_loss.items()}
 
                         losses = backward_and_log("warp", net_outs, targets, masks, num_crowds, extra_loss=extra_loss)
 
@@ -513,6 +692,10 @@ time: {time}  data_time: {data_time}  lr: {lr}  {memory}\
                         lr="{:.6f}".format(lr), memory="max_mem: {:.0f}M".format(max_mem_mb)
                     ))
 
+                    if data_loader_iter.enabled:
+                        for k, v in data_loader_iter.stats().items():
+                            w.add_scalar('prefetch/{}'.format(k), v)
+
                 if rank == 0 and iteration % 100 == 0:
                     
                     if cfg.flow.train_flow:
@@ -584,15 +767,17 @@ time: {time}  data_time: {data_time}  lr: {lr}  {memory}\
 
                 if rank == 0 and iteration % args.save_interval == 0 and iteration != args.start_iter:
                     if args.keep_latest:
+                        # Make sure the last save made it to disk before looking for it
+                        checkpoint_writer.wait()
                         latest = SavePath.get_latest(args.save_folder, cfg.name)
 
                     logger.info('Saving state, iter: {}'.format(iteration))
-                    yolact_net.save_weights(save_path(epoch, iteration))
+                    save_checkpoint(save_path(epoch, iteration))
 
                     if args.keep_latest and latest is not None:
                         if args.keep_latest_interval <= 0 or iteration % args.keep_latest_interval != args.save_interval:
                             logger.info('Deleting old save...')
-                            os.remove(latest)
+                            checkpoint_writer.remove(latest)
 
             misc.barrier()
 
@@ -612,11 +797,17 @@ time: {time}  data_time: {data_time}  lr: {lr}  {memory}\
             # Delete previous copy of the interrupted network so we don't spam the weights folder
             SavePath.remove_interrupt(args.save_folder)
 
-            yolact_net.save_weights(save_path(epoch, repr(iteration) + '_interrupt'))
+            save_checkpoint(save_path(epoch, repr(iteration) + '_interrupt'))
+        checkpoint_writer.close()
         return
 
+    if data_loader_iter.enabled:
+        logger.info('Prefetcher: {mb_per_batch:.1f}MB/batch copied in {copy_ms:.2f}ms, '
+                    '{overlap:.1%} of batches ready before they were needed'.format(**data_loader_iter.stats()))
+
     if rank == 0:
-        yolact_net.save_weights(save_path(epoch, iteration))
+        save_checkpoint(save_path(epoch, iteration))
+    checkpoint_writer.close()
 
 
 def set_lr(optimizer, new_lr):
@@ -32,3 +32,29 @@ def detection_collate(batch):
         num_crowds.append(sample[1][2])
 
     return torch.stack(imgs, 0), (targets, masks, num_crowds)
+
+
+def padded_detection_collate(batch):
+    """
+    Like detection_collate, but for images that haven't been resized yet (see SSDAugmentationPhotometric).
+    Images are padded with MEANS at the bottom and right to the largest image in the batch, and the masks
+    are left at each image's own size as uint8, which is also how the image sizes are recovered later.
+    """
+    targets = []
+    masks = []
+    num_crowds = []
+
+    max_h = max(sample[0].size(1) for sample in batch)
+    max_w = max(sample[0].size(2) for sample in batch)
+
+    imgs = torch.FloatTensor(len(batch), 3, max_h, max_w)
+    imgs[:] = torch.FloatTensor(MEANS)[:, None, None]
+
+    for idx, sample in enumerate(batch):
+        _, h, w = sample[0].size()
+        imgs[idx, :, :h, :w] = sample[0]
+        targets.append(torch.FloatTensor(sample[1][0]))
+        masks.append(torch.from_numpy(np.ascontiguousarray(sample[1][1], dtype=np.uint8)))
+        num_crowds.append(sample[1][2])
+
+    return imgs, (targets, masks, num_crowds)
@@ -626,6 +626,8 @@ coco_base_config = Config({
     # SSD data augmentation parameters
     # Randomize hue, vibrance, etc.
     'augment_photometric_distort': True,
+    # Do the photometric distortion in a single float32 pass (same distributions, see FusedPhotometricDistort)
+    'augment_fused_photometric_distort': False,
     # Have a chance to scale down the image and pad (to emulate smaller detections)
     'augment_expand': True,
     # Potentialy sample a random crop from the image and put it in a random place
@@ -636,6 +638,15 @@ coco_base_config = Config({
     'augment_random_flip': False,
     # With uniform probability, rotate the image [0,90,180,270] degrees
     'augment_random_rot90': False,
+    # Do expand, random sample crop, mirror, flip and resize on the collated batch on the training device instead
+    # of per image in the data loader workers (see BatchedSSDAugmentation). Only applies to image datasets.
+    'augment_batched': False,
+
+    # If set, decoded images are cached in this folder and shared across epochs and data loader workers.
+    # Point it at a tmpfs (e.g., /dev/shm/yolact_edge_images) to keep the cache in shared memory.
+    'image_cache_dir': None,
+    # The size budget of the image cache in bytes. Least recently used images are evicted past this.
+    'image_cache_max_bytes': 8 * 1024 ** 3,
 
     # Discard detections with width and height smaller than this (in absolute width and height)
     'discard_box_width': 4 / 550,
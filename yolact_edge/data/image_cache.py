@@ -0,0 +1,137 @@
+import os
+import os.path as osp
+import hashlib
+import cv2
+import numpy as np
+from .config import cfg
+
+
+class ImageCache(object):
+    """
+    An on-disk LRU cache of decoded images, shared by every process that points at the same folder.
+
+    Entries are raw .npy dumps of what cv2.imread returned, keyed on the absolute path, size and mtime
+    of the source file, so editing an image on disk simply misses the old entry (which then ages out).
+    Point cache_dir at a tmpfs such as /dev/shm to keep the cache in shared memory. Since DataLoader
+    workers only share the folder and not any Python state, this works with both fork and spawn.
+
+    Args:
+        - cache_dir: The folder to store decoded images in. It's created if it doesn't exist.
+        - max_bytes: The byte budget for the folder. When it's exceeded, the least recently used
+                     entries are deleted until usage drops below low_water * max_bytes.
+    """
+
+    def __init__(self, cache_dir, max_bytes, low_water=0.9):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.low_water = low_water
+
+        os.makedirs(cache_dir, exist_ok=True)
+
+        # Our own estimate of how full the folder is. Other workers write to it too, so this gets
+        # resynced from disk every time we evict.
+        self._usage = None
+
+        self.hits = 0
+        self.misses = 0
+
+    def _entry_path(self, path):
+        st = os.stat(path)
+        key = '{}:{}:{}'.format(osp.abspath(path), st.st_size, st.st_mtime_ns)
+        return osp.join(self.cache_dir, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.npy')
+
+    def imread(self, path):
+        """ A drop-in replacement for cv2.imread(path) that goes through the cache. """
+        entry = self._entry_path(path)
+
+        try:
+            img = np.load(entry)
+            # Bump the entry's mtime so eviction treats it as recently used
+            os.utime(entry)
+            self.hits += 1
+            return img
+        except (OSError, ValueError):
+            # Either it's not cached or another worker is halfway through evicting it
+            pass
+
+        self.misses += 1
+        img = cv2.imread(path)
+
+        if img is not None:
+            self._put(entry, img)
+
+        return img
+
+    def _put(self, entry, img):
+        if img.nbytes > self.max_bytes:
+            return
+
+        # Write to a private temp file first so other workers never see a partial entry
+        tmp_path = '{}.{}.tmp'.format(entry, os.getpid())
+        try:
+            with open(tmp_path, 'wb') as f:
+                np.save(f, img)
+            os.replace(tmp_path, entry)
+        except OSError:
+            # Running out of space in the cache isn't worth crashing the data loader over
+            if osp.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+
+        if self._usage is None:
+            self._usage = self._disk_usage()[0]
+        else:
+            self._usage += img.nbytes
+
+        if self._usage > self.max_bytes:
+            self.evict()
+
+    def _disk_usage(self):
+        entries = []
+        total = 0
+
+        for f in os.scandir(self.cache_dir):
+            if not f.name.endswith('.npy'):
+                continue
+            try:
+                st = f.stat()
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, f.path))
+            total += st.st_size
+
+        return total, entries
+
+    def evict(self):
+        """ Deletes the least recently used entries until the cache is back under its low water mark. """
+        total, entries = self._disk_usage()
+        target = self.max_bytes * self.low_water
+
+        for _, size, path in sorted(entries):
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                # Someone else got to it first
+                pass
+            total -= size
+
+        self._usage = total
+
+    def clear(self):
+        for f in os.scandir(self.cache_dir):
+            if f.name.endswith('.npy') or f.name.endswith('.tmp'):
+                os.remove(f.path)
+        self._usage = 0
+
+    def __repr__(self):
+        return 'ImageCache(cache_dir={}, max_bytes={}, hits={}, misses={})'.format(
+            self.cache_dir, self.max_bytes, self.hits, self.misses)
+
+
+def build_image_cache():
+    """ Returns the ImageCache set up by cfg.image_cache_dir, or None if caching is turned off. """
+    if cfg.image_cache_dir is None:
+        return None
+    return ImageCache(cfg.image_cache_dir, cfg.image_cache_max_bytes)
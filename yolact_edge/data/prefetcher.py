@@ -0,0 +1,166 @@
+import torch
+
+
+class DataPrefetcher(object):
+    """
+    Wraps a data loader iterator so that the next batch is copied to the GPU while the current one is being
+    trained on. Returns the same nested tuples / lists the loader does, but with every tensor on device.
+
+    All the tensors in a batch with the same dtype (images, every target and every mask) are packed into one
+    pinned host buffer and sent over in a single non_blocking copy on a side stream, then unpacked on the GPU
+    as views. There are two sets of host buffers that are swapped every batch, so packing the next batch never
+    waits on anything but the copy from two batches ago.
+
+    On the CPU this just passes the loader through.
+
+    Args:
+        - loader_iter: An iterator over a DataLoader.
+        - device: The device to copy batches to.
+        - host_targets: Leave the targets of (images, (targets, masks, num_crowds)) batches on the host, for when
+                        they're read on the CPU first (like BatchedSSDAugmentation does), which would otherwise
+                        have to wait to copy them back.
+    """
+
+    def __init__(self, loader_iter, device, host_targets=False):
+        self.loader_iter = loader_iter
+        self.device = torch.device(device)
+        self.host_targets = host_targets
+        self.enabled = self.device.type == 'cuda'
+
+        # Bookkeeping for stats()
+        self.batches = 0
+        self.preloaded = 0
+        self.ready_batches = 0
+        self.timed_batches = 0
+        self.bytes = 0
+        self.copy_ms = 0
+
+        if self.enabled:
+            self.stream = torch.cuda.Stream(device=self.device)
+
+            # One pinned buffer per dtype in each set
+            self.host_buffers = [{}, {}]
+            self.copy_events = [None, None]
+            self.buffer_idx = 0
+
+            self.preload()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if not self.enabled:
+            return next(self.loader_iter)
+
+        if self.next_datum is None:
+            raise StopIteration
+
+        datum, copy_done, device_buffers = self.next_datum
+
+        # If the copy is already done by the time it's asked for, it was completely hidden behind the last step
+        if copy_done.query():
+            self.ready_batches += 1
+        self.batches += 1
+
+        # This has to come before preloading the next batch, otherwise we'd wait on that copy too
+        current_stream = torch.cuda.current_stream(self.device)
+        current_stream.wait_stream(self.stream)
+        for buf in device_buffers:
+            buf.record_stream(current_stream)
+
+        self.preload()
+
+        return datum
+
+    def preload(self):
+        try:
+            datum = next(self.loader_iter)
+        except StopIteration:
+            self.next_datum = None
+            return
+
+        tensors = []
+        self._collect(datum, tensors)
+
+        if self.host_targets:
+            on_host = set(id(t) for t in datum[1][0])
+            tensors = [t for t in tensors if id(t) not in on_host]
+
+        groups = {}
+        for t in tensors:
+            groups.setdefault(t.dtype, []).append(t)
+
+        idx = self.buffer_idx
+        self.buffer_idx = 1 - idx
+
+        # The last copy out of this set of host buffers has to finish before we can overwrite them
+        if self.copy_events[idx] is not None:
+            start, end = self.copy_events[idx]
+            end.synchronize()
+            self.copy_ms += start.elapsed_time(end)
+            self.timed_batches += 1
+
+        host_buffers = self.host_buffers[idx]
+        device_views = {}
+        device_buffers = []
+
+        start = torch.cuda.Event(enable_timing=True)
+        end = torch.cuda.Event(enable_timing=True)
+
+        with torch.cuda.stream(self.stream):
+            start.record()
+
+            for dtype, group in groups.items():
+                numel = sum(t.numel() for t in group)
+
+                host = host_buffers.get(dtype, None)
+                if host is None or host.numel() < numel:
+                    host = torch.empty(numel, dtype=dtype, device='cpu', pin_memory=True)
+                    host_buffers[dtype] = host
+
+                offset = 0
+                for t in group:
+                    host[offset:offset+t.numel()].copy_(t.reshape(-1))
+                    offset += t.numel()
+
+                dev = host[:numel].to(self.device, non_blocking=True)
+                device_buffers.append(dev)
+
+                offset = 0
+                for t in group:
+                    device_views[id(t)] = dev[offset:offset+t.numel()].view(t.shape)
+                    offset += t.numel()
+
+                self.bytes += numel * host.element_size()
+
+            end.record()
+
+        self.copy_events[idx] = (start, end)
+        self.preloaded += 1
+        self.next_datum = (self._replace(datum, device_views), end, device_buffers)
+
+    def _collect(self, obj, tensors):
+        if torch.is_tensor(obj):
+            tensors.append(obj)
+        elif isinstance(obj, (list, tuple)):
+            for x in obj:
+                self._collect(x, tensors)
+
+    def _replace(self, obj, device_views):
+        if torch.is_tensor(obj):
+            return device_views.get(id(obj), obj)
+        elif isinstance(obj, (list, tuple)):
+            return type(obj)(self._replace(x, device_views) for x in obj)
+        else:
+            return obj
+
+    def stats(self):
+        """
+        Returns how the transfers have gone so far: the average MB and milliseconds per batch copied and the
+        fraction of batches whose copy was fully overlapped with the previous training step.
+        """
+        return {
+            'mb_per_batch': self.bytes / max(self.preloaded, 1) / 1024 ** 2,
+            'copy_ms': self.copy_ms / max(self.timed_batches, 1),
+            'overlap': self.ready_batches / max(self.batches, 1),
+        }
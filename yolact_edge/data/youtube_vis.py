@@ -7,6 +7,7 @@ import torchvision.transforms as transforms
 import cv2
 import numpy as np
 from .config import cfg
+from .image_cache import build_image_cache
 from pycocotools import mask as maskUtils
 import contextlib
 import io
@@ -125,6 +126,8 @@ class YoutubeVIS(data.Dataset):
         self.name = dataset_name
         self.has_gt = has_gt
 
+        self.image_cache = build_image_cache()
+
     def __getitem__(self, index):
         """
         Args:
@@ -335,7 +338,10 @@ class YoutubeVIS(data.Dataset):
         path = osp.join(self.root, file_name)
         assert osp.exists(path), 'Image path does not exist: {}'.format(path)
 
-        img = cv2.imread(path)
+        if self.image_cache is not None:
+            img = self.image_cache.imread(path)
+        else:
+            img = cv2.imread(path)
         height, width, _ = img.shape
 
         target_is_in_frame = self.target_in_frame(target, annot_id)
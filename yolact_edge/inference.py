@@ -5,11 +5,13 @@ import matplotlib.pyplot as plt
 from collections import defaultdict
 from yolact_edge.data.config import cfg, set_cfg
 from yolact_edge.yolact import Yolact
-from yolact_edge.utils.augmentations import FastBaseTransform, BaseTransform
+from yolact_edge.utils.augmentations import FastUint8Transform, BaseTransform
 from yolact_edge.utils import timer
+from yolact_edge.utils import metrics
 from yolact_edge.layers.output_utils import postprocess, undo_image_transformation
 from yolact_edge.data import COLORS, set_dataset
 from yolact_edge.utils.tensorrt import convert_to_tensorrt
+from yolact_edge.utils.optimize import optimize_for_inference
 import argparse
 import random
 
@@ -114,6 +116,12 @@ def parse_args(argv=None):
                         help='This replaces all TensorRT INT8 optimization with FP16 optimization when specified.')
     parser.add_argument('--use_tensorrt_safe_mode', default=False, dest='use_tensorrt_safe_mode', action='store_true',
                         help='This enables the safe mode that is a workaround for various TensorRT engine issues.')
+    parser.add_argument('--optimize_for_inference', default=False, dest='optimize_for_inference', action='store_true',
+                        help='Fold batch norms into convs and drop training-only layers before running. Outputs only change by float rounding.')
+    parser.add_argument('--output_buffers', default=True, type=str2bool,
+                        help='Reuse the output buffers of the prediction heads and protonet from frame to frame instead of allocating them every time (see Yolact.use_output_buffers).')
+    parser.add_argument('--metrics_port', default=None, type=int,
+                        help='Collect metrics (frames, stage latencies and detections) and serve them for Prometheus at http://127.0.0.1:<port>/metrics.')
 
     parser.set_defaults(no_bar=False, display=False, resume=False, output_coco_json=False, output_web_json=False, shuffle=False,
                         benchmark=False, no_sort=False, no_hash=False, mask_proto_debug=False, crop=True, detect=False)
@@ -160,13 +168,22 @@ class YOLACTEdgeInference(object):
                 print("CUDA missing... Exiting...")
                 exit(1)
 
+            if args.metrics_port is not None:
+                metrics.enable(args.metrics_port)
+
             print("Loading YOLACT edge model...")
             net = Yolact(training=False)
             net.load_weights(weights, args=args)
             net.eval()
+            if args.optimize_for_inference:
+                optimize_for_inference(net)
             convert_to_tensorrt(net, cfg, args, transform=BaseTransform())
+            if args.output_buffers:
+                # predict() is done with a frame's outputs before it returns, so one slot is enough
+                net.use_output_buffers()
             net = net.cuda()
             self.net = net
+            self.transform = FastUint8Transform()
             print("Model ready for inference...")
 
     def prep_output(self, dets_out, img, h, w, undo_transform=True, class_color=False, mask_alpha=0.45):
@@ -285,17 +302,24 @@ class YOLACTEdgeInference(object):
         return (img_numpy, classes, scores, masks)
 
     def predict(self, img, show=False):
-        frame = torch.Tensor(img).cuda().float()
-        batch = FastBaseTransform()(frame.unsqueeze(0))
+        metrics.frames_in().inc()
 
-        extras = {"backbone": "full", "interrupt": False,
-                  "keep_statistics": False, "moving_statistics": None}
+        with timer.env('Predict'):
+            frame = torch.as_tensor(img).cuda()
+            batch = self.transform(frame.unsqueeze(0))
 
-        with torch.no_grad():
-            preds = self.net(batch, extras=extras)["pred_outs"]
+            extras = {"backbone": "full", "interrupt": False,
+                      "keep_statistics": False, "moving_statistics": None}
+
+            with torch.no_grad():
+                preds = self.net(batch, extras=extras)["pred_outs"]
+                metrics.network_frames().labels(keyframe='true').inc()
+                metrics.detections().observe(0 if preds[0] is None else preds[0]['box'].size(0))
+
+                out = self.prep_output(
+                    preds, frame, None, None, undo_transform=False)
 
-            out = self.prep_output(
-                preds, frame, None, None, undo_transform=False)
+        metrics.frames_out().inc()
 
         if out == None:
             print("No predictions!")
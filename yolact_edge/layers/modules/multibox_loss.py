@@ -43,7 +43,7 @@ class MultiBoxLoss(nn.Module):
         self.l1_expected_area = 20*20/70/70
         self.l1_alpha = 0.1
 
-    def forward(self, predictions, targets, masks, num_crowds):
+    def forward(self, predictions, targets, masks, num_crowds, norm=None):
         """Multibox Loss
         Args:
             predictions (tuple): A tuple containing loc preds, conf preds,
@@ -62,10 +62,19 @@ class MultiBoxLoss(nn.Module):
 
             num_crowds (list<int>): Number of crowd annotations per batch. The crowd
                 annotations should be the last num_crowds elements of targets and masks.
+
+            norm (tuple): If not None, (num_pos, batch_size) to normalize the losses by
+                instead of this batch's own. Used to treat several micro-batches as one
+                batch for gradient accumulation (see num_positives).
             
             * Only if mask_type == lincomb
         """
 
+        # With mixed precision training the network outputs are in reduced precision, but log_sum_exp, the BCE on
+        # clamped masks and the focal losses need fp32. This should be called outside of autocast for the same reason.
+        predictions = {k: v.float() if torch.is_tensor(v) and v.is_floating_point() else v
+                       for k, v in predictions.items()}
+
         loc_data  = predictions['loc']
         conf_data = predictions['conf']
         mask_data = predictions['mask']
@@ -183,12 +192,20 @@ class MultiBoxLoss(nn.Module):
 
         # Divide all losses by the number of positives.
         # Don't do it for loss[P] because that doesn't depend on the anchors.
-        total_num_pos = num_pos.data.sum().float()
+        if norm is None:
+            total_num_pos, total_batch_size = num_pos.data.sum().float(), batch_size
+        else:
+            total_num_pos, total_batch_size = norm
+
         for k in losses:
+            if k == 'P':
+                # loss[P] is already a mean over this batch, so weight it by this batch's share of the total
+                losses[k] *= batch_size / total_batch_size
+
             if k not in ('P', 'E', 'S'):
                 losses[k] /= total_num_pos
             else:
-                losses[k] /= batch_size
+                losses[k] /= total_batch_size
 
         # Loss Key:
         #  - B: Box Localization Loss
@@ -200,6 +217,37 @@ class MultiBoxLoss(nn.Module):
         #  - S: Semantic Segmentation Loss
         return losses
 
+    def num_positives(self, priors, targets, num_crowds):
+        """
+        Returns the number of priors that get matched to a gt box in this batch, which is what forward
+        normalizes most of the losses by. This doesn't depend on the predictions (unless
+        use_prediction_matching is on, which this doesn't support), so gradient accumulation can count
+        the positives in all of its micro-batches up front and normalize them as one batch.
+        """
+        num_priors = priors.size(0)
+        loc_t = priors.new(1, num_priors, 4)
+        conf_t = priors.new(1, num_priors).long()
+        idx_t = priors.new(1, num_priors).long()
+
+        num_pos = 0
+        for idx in range(len(targets)):
+            truths = targets[idx][:, :-1].data
+            labels = targets[idx][:, -1].data.long()
+
+            cur_crowds = num_crowds[idx]
+            if cur_crowds > 0:
+                crowd_boxes, truths = truths[-cur_crowds:], truths[:-cur_crowds]
+                labels = labels[:-cur_crowds]
+            else:
+                crowd_boxes = None
+
+            match(self.pos_threshold, self.neg_threshold,
+                  truths, priors.data, labels, crowd_boxes,
+                  loc_t, conf_t, idx_t, 0, None)
+            num_pos += (conf_t > 0).sum()
+
+        return num_pos
+
     def class_existence_loss(self, class_data, class_existence_t):
         return cfg.class_existence_alpha * F.binary_cross_entropy_with_logits(class_data, class_existence_t, reduction='sum')
 
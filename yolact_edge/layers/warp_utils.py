@@ -53,13 +53,15 @@ def deform_op(x, offset, mode: str = "bilinear", padding_mode: str = "zeros"):
         Tensor: warped image or feature map
     """
     assert x.size()[-2:] == offset.size()[-2:]
-    n, _, h, w = offset.size()
-    grid = generate_grid_as(n, h, w, x)
+    _, _, h, w = offset.size()
+    # The grid is the same for every image, so make one and let it broadcast over the batch (this also keeps the
+    # batch size out of exported graphs)
+    grid = generate_grid_as(1, h, w, x)
 
     grid *= torch.tensor([2/(w-1), 2/(h-1)], dtype=torch.float, device=x.device).view(1, 2, 1, 1)
     grid -= 1
     # offset *= torch.tensor([384. / 512 / 16 * 2, 512. / 384 / 16 * 2], dtype=torch.float, device=x.device).view(1, 2, 1, 1)
-    grid += offset / 8
+    grid = grid + offset / 8
     grid = grid.permute(0, 2, 3, 1)
 
     output = F.grid_sample(x, grid, mode=mode, padding_mode=padding_mode, align_corners=True)
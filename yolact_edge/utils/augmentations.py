@@ -35,6 +35,75 @@ def jaccard_numpy(box_a, box_b):
     return inter / union  # [A,B]
 
 
+def resize_masks(masks, width, height, chunk_size=512):
+    """
+    Resizes masks of shape [num_objects, h, w] to [num_objects, height, width] by treating each object as a
+    color channel. OpenCV only takes up to 512 channels at once, so this is done in chunks of chunk_size.
+    Boolean masks are resized as uint8.
+    """
+    if masks.dtype == np.bool_:
+        masks = masks.view(np.uint8)
+
+    out = np.empty((masks.shape[0], height, width), dtype=masks.dtype)
+
+    for start in range(0, masks.shape[0], chunk_size):
+        chunk = cv2.resize(masks[start:start+chunk_size].transpose((1, 2, 0)), (width, height))
+
+        # OpenCV resizes a (w,h,1) array to (s,s), so fix that
+        if chunk.ndim == 2:
+            chunk = chunk[:, :, None]
+
+        out[start:start+chunk_size] = chunk.transpose((2, 0, 1))
+
+    return out
+
+
+def sample_crop(boxes, num_crowds, width, height, min_iou, max_iou, num_trials=50):
+    """
+    Draws num_trials random crops for RandomSampleCrop at once and returns the first one that's valid as
+    (w, h, left, top, rect, keep), where rect is the integer crop [x1, y1, x2, y2] and keep says which
+    boxes have their center in it. Returns None if none of the trials work out.
+    """
+    w = random.uniform(0.3 * width, width, size=num_trials)
+    h = random.uniform(0.3 * height, height, size=num_trials)
+    left = random.uniform(width - w)
+    top = random.uniform(height - h)
+
+    # aspect ratio constraint b/t .5 & 2
+    valid = (h / w >= 0.5) * (h / w <= 2)
+
+    # [num_trials, 4] integer rects x1,y1,x2,y2
+    rects = np.stack((left, top, left+w, top+h), axis=1).astype(np.int64)
+
+    # [num_trials, num_boxes] IoU b/t the crops and gt boxes
+    max_xy = np.minimum(boxes[None, :, 2:], rects[:, None, 2:])
+    min_xy = np.maximum(boxes[None, :, :2], rects[:, None, :2])
+    inter = np.clip(max_xy - min_xy, a_min=0, a_max=np.inf).prod(axis=2)
+    area_boxes = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    area_rects = (rects[:, 2] - rects[:, 0]) * (rects[:, 3] - rects[:, 1])
+    overlap = inter / (area_boxes[None, :] + area_rects[:, None] - inter)
+
+    # This is the same (bugged) check as in RandomSampleCrop, see the comment there
+    valid *= ~((overlap.min(axis=1) < min_iou) * (max_iou < overlap.max(axis=1)))
+
+    # keep gt boxes with their center in the crop
+    centers = (boxes[:, :2] + boxes[:, 2:]) / 2.0
+    keep = (rects[:, None, 0] < centers[None, :, 0]) * (rects[:, None, 1] < centers[None, :, 1]) \
+         * (rects[:, None, 2] > centers[None, :, 0]) * (rects[:, None, 3] > centers[None, :, 1])
+
+    # Make sure there's at least one regular gt left
+    crowd_mask = np.zeros(boxes.shape[0], dtype=np.bool_)
+    if num_crowds > 0:
+        crowd_mask[-num_crowds:] = True
+    valid *= (keep * ~crowd_mask[None, :]).any(axis=1)
+
+    if not valid.any():
+        return None
+
+    idx = np.argmax(valid)
+    return w[idx], h[idx], left[idx], top[idx], rects[idx], keep[idx]
+
+
 class Compose(object):
     """Composes several augmentations together.
     Args:
@@ -213,15 +282,7 @@ class Resize(object):
         image = cv2.resize(image, (width, height))
         
         if self.resize_gt:
-            # Act like each object is a color channel
-            masks = masks.transpose((1, 2, 0))
-            masks = cv2.resize(masks, (width, height))
-            
-            # OpenCV resizes a (w,h,1) array to (s,s), so fix that
-            if len(masks.shape) == 2:
-                masks = np.expand_dims(masks, 0)
-            else:
-                masks = masks.transpose((2, 0, 1))
+            masks = resize_masks(masks, width, height)
 
             # Scale bounding boxes (which are currently absolute coordinates)
             boxes[:, [0, 2]] *= (width  / img_w)
@@ -428,15 +489,17 @@ class RandomSampleCrop(object):
             if max_iou is None:
                 max_iou = float('inf')
 
-            # max trails (50)
-            for _ in range(50):
-                current_image = image
+            if seeds is None:
+                # max trails (50), all drawn and checked at once. Only the first valid one goes through the loop.
+                crop = sample_crop(boxes, labels['num_crowds'], width, height, min_iou, max_iou)
+                if crop is None:
+                    continue
+                trials = [crop[:4]]
+            else:
+                trials = [seeds[1:5]]
 
-                if seeds is None:
-                    w = random.uniform(0.3 * width, width)
-                    h = random.uniform(0.3 * height, height)
-                else:
-                    w, h = seeds[1:3]
+            for w, h, left, top in trials:
+                current_image = image
 
                 # aspect ratio constraint b/t .5 & 2
                 if h / w < 0.5 or h / w > 2:
@@ -444,12 +507,6 @@ class RandomSampleCrop(object):
                         raise ValueError("reseed")
                     continue
 
-                if seeds is None:
-                    left = random.uniform(width - w)
-                    top = random.uniform(height - h)
-                else:
-                    left, top = seeds[3:5]
-
                 # convert to integer rect x1,y1,x2,y2
                 rect = np.array([int(left), int(top), int(left+w), int(top+h)])
 
@@ -718,7 +775,105 @@ class PhotometricDistort(object):
                 distort = ComposeVideo(self.pd[1:])
             im, masks, boxes, labels = distort(im, masks, boxes, labels, seeds=distort_seed)
             im, masks, boxes, labels = self.rand_light_noise(im, masks, boxes, labels)
-            
+
+            return im, masks, boxes, labels
+
+
+class FusedPhotometricDistort(object):
+    """
+    A faster PhotometricDistort. The random parameters are drawn from the same distributions in the
+    same order, and the seeds have the same layout, so the two can replay each other's seeds.
+
+    Instead of 4-6 separate passes, brightness and contrast are folded into one multiply-add (contrast
+    commutes with the HSV steps, so it doesn't matter which end of the chain it was drawn for). Scaling
+    S in HSV is the same as lerping each channel towards the pixel's max channel, so saturation alone is
+    done directly in BGR, and we only round trip through HSV when the hue actually changes.
+
+    The only pixels where this differs from PhotometricDistort (beyond float rounding) are ones whose
+    max channel ended up <= 0 after the brightness shift, where OpenCV's HSV conversion loses the color.
+    """
+
+    def __init__(self, contrast_range=(0.5, 1.5), saturation_range=(0.5, 1.5), hue_delta=18.0, brightness_delta=32):
+        self.contrast_range = contrast_range
+        self.saturation_range = saturation_range
+        self.hue_delta = hue_delta
+        self.brightness_delta = brightness_delta
+
+    @staticmethod
+    def _draw(lower, upper, default):
+        # The same coin flip + uniform draw that the Random* transforms above do
+        if random.randint(2):
+            return random.uniform(lower, upper)
+        return default
+
+    def draw_seeds(self):
+        """ Draws seeds laid out like PhotometricDistort's: (brightness, distort_seed_1, distort_seed). """
+        brightness = self._draw(-self.brightness_delta, self.brightness_delta, 0)
+        distort_seed_1 = random.randint(2)
+
+        if distort_seed_1:
+            contrast = self._draw(*self.contrast_range, 1.0)
+
+        saturation = self._draw(*self.saturation_range, 1.0)
+        hue = self._draw(-self.hue_delta, self.hue_delta, 0)
+
+        if distort_seed_1:
+            distort_seed = [contrast, None, saturation, hue, None]
+        else:
+            contrast = self._draw(*self.contrast_range, 1.0)
+            distort_seed = [None, saturation, hue, None, contrast]
+
+        return (brightness, distort_seed_1, distort_seed)
+
+    @staticmethod
+    def unpack_seeds(seeds):
+        """ Returns (brightness, contrast, saturation, hue) from a set of PhotometricDistort seeds. """
+        brightness, distort_seed_1, distort_seed = seeds
+
+        if distort_seed_1:
+            contrast, _, saturation, hue, _ = distort_seed
+        else:
+            _, saturation, hue, _, contrast = distort_seed
+
+        return brightness, contrast, saturation, hue
+
+    @staticmethod
+    def distort(image, brightness, contrast, saturation, hue):
+        """ Applies the photometric distortion to a float32 BGR image, returning a new image. """
+        # (x + brightness) * contrast in one go, which also gives us our own copy to modify in place
+        image = cv2.addWeighted(image, contrast, image, 0, brightness * contrast, dtype=cv2.CV_32F)
+
+        if hue != 0:
+            h, s, v = cv2.split(cv2.cvtColor(image, cv2.COLOR_BGR2HSV))
+
+            if saturation != 1:
+                s *= saturation
+
+            # Same wrap-around as RandomHue, but only the side we can actually cross
+            h += hue
+            if hue > 0:
+                h[h > 360.0] -= 360.0
+            else:
+                h[h < 0.0] += 360.0
+
+            image = cv2.cvtColor(cv2.merge((h, s, v)), cv2.COLOR_HSV2BGR)
+        elif saturation != 1:
+            # x' = max + s * (x - max), i.e., scaling S with H and V held fixed
+            max_channel = np.maximum(np.maximum(image[:, :, 0], image[:, :, 1]), image[:, :, 2])
+            image *= saturation
+            image += max_channel[:, :, None] * np.float32(1 - saturation)
+
+        return image
+
+    def __call__(self, image, masks, boxes, labels, seeds=None, require_seeds=False):
+        if seeds is None:
+            seeds = self.draw_seeds()
+
+        im = self.distort(image.astype(np.float32, copy=False), *self.unpack_seeds(seeds))
+
+        if require_seeds:
+            return seeds, (im, masks, boxes, labels)
+        else:
             return im, masks, boxes, labels
 
 
@@ -850,8 +1005,8 @@ class FastBaseTransform(torch.nn.Module):
     def __init__(self):
         super().__init__()
 
-        self.mean = torch.Tensor(MEANS).float().cuda()[None, :, None, None]
-        self.std  = torch.Tensor( STD ).float().cuda()[None, :, None, None]
+        self.mean = torch.Tensor(MEANS).float()[None, :, None, None]
+        self.std  = torch.Tensor( STD ).float()[None, :, None, None]
         self.transform = cfg.backbone.transform
 
     def forward(self, img):
@@ -883,6 +1038,82 @@ class FastBaseTransform(torch.nn.Module):
         # Return value is in channel order [n, c, h, w] and RGB
         return img
 
+
+class FastUint8Transform(torch.nn.Module):
+    """
+    The same transform as FastBaseTransform, for uint8 BGR images [n, h, w, c] on any device, that makes fewer
+    copies of the frame on the way:
+     - The image is resized as uint8 (on the CPU, where that's supported) straight from its [n, h, w, c] layout.
+     - Normalization and BGR -> RGB are a single multiply-add per channel, written into a preallocated buffer.
+
+    The result is that buffer, so it's overwritten by the next call with the same batch size and device. Use it
+    (or copy it) before transforming the next frames, or pass a tensor of your own as out. The buffer is allocated
+    in memory_format, so it can be made channels last for a model that runs in it (see Yolact.use_channels_last).
+    """
+
+    def __init__(self, memory_format=torch.contiguous_format):
+        super().__init__()
+        self.memory_format = memory_format
+
+        self.transform = cfg.backbone.transform
+        if self.transform.channel_order != 'RGB':
+            raise NotImplementedError
+
+        mean = torch.Tensor(MEANS).float()
+        std  = torch.Tensor( STD ).float()
+
+        if self.transform.normalize:
+            scale, bias = 1 / std, -mean / std
+        elif self.transform.subtract_means:
+            scale, bias = torch.ones(3), -mean
+        elif self.transform.to_float:
+            scale, bias = torch.full((3,), 1 / 255), torch.zeros(3)
+        else:
+            scale, bias = torch.ones(3), torch.zeros(3)
+
+        # MEANS and STD are in BGR order, the output is RGB
+        self.register_buffer('scale', scale.flip(0), persistent=False)
+        self.register_buffer('bias', bias.flip(0), persistent=False)
+
+        self.buffer = None
+
+    def output_size(self):
+        if type(cfg.max_size) == tuple:
+            return cfg.max_size[::-1]
+        return (cfg.max_size, cfg.max_size)
+
+    def forward(self, img, out=None):
+        """ img is a uint8 BGR tensor [n, h, w, c] (or [h, w, c]). Returns a float RGB tensor [n, c, h, w]. """
+        if cfg.preserve_aspect_ratio:
+            raise NotImplementedError
+
+        if img.dim() == 3:
+            img = img[None]
+        scale = self.scale.to(img.device)
+        bias = self.bias.to(img.device)
+
+        # A view in channels last memory format, not a copy
+        img = img.permute(0, 3, 1, 2)
+
+        height, width = self.output_size()
+        if img.size()[2:] != (height, width):
+            if img.dtype == torch.uint8 and img.device.type != 'cpu':
+                # Only the CPU resizes uint8 images
+                img = img.float()
+            img = F.interpolate(img, (height, width), mode='bilinear', align_corners=False)
+
+        if out is None:
+            size = (img.size(0), 3, height, width)
+            if self.buffer is None or self.buffer.size() != size or self.buffer.device != img.device:
+                self.buffer = torch.empty(size, device=img.device, memory_format=self.memory_format)
+            out = self.buffer
+
+        for c in range(3):
+            torch.addcmul(bias[c], img[:, 2 - c], scale[c], out=out[:, c])
+
+        # Return value is in channel order [n, c, h, w] and RGB
+        return out
+
 def do_nothing(img=None, masks=None, boxes=None, labels=None, seeds=None, require_seeds=False):
     if require_seeds:
         return None, (img, masks, boxes, labels)
@@ -893,6 +1124,10 @@ def do_nothing(img=None, masks=None, boxes=None, labels=None, seeds=None, requir
 def enable_if(condition, obj):
     return obj if condition else do_nothing
 
+
+def photometric_distort():
+    return FusedPhotometricDistort() if cfg.augment_fused_photometric_distort else PhotometricDistort()
+
 class SSDAugmentation(object):
     """ Transform to be used when training. """
 
@@ -900,7 +1135,7 @@ class SSDAugmentation(object):
         self.augment = Compose([
             ConvertFromInts(),
             ToAbsoluteCoords(),
-            enable_if(cfg.augment_photometric_distort, PhotometricDistort()),
+            enable_if(cfg.augment_photometric_distort, photometric_distort()),
             enable_if(cfg.augment_expand, Expand(mean)),
             enable_if(cfg.augment_random_sample_crop, RandomSampleCrop()),
             enable_if(cfg.augment_random_mirror, RandomMirror()),
@@ -917,6 +1152,24 @@ class SSDAugmentation(object):
         return self.augment(img, masks, boxes, labels)
 
 
+class SSDAugmentationPhotometric(object):
+    """
+    The per image half of SSDAugmentation when cfg.augment_batched is on. The geometric transforms and the
+    backbone transform are done later on the whole batch by BatchedSSDAugmentation, so this leaves the image
+    at its original size and the boxes in absolute coordinates.
+    """
+
+    def __init__(self, mean=MEANS, std=STD):
+        self.augment = Compose([
+            ConvertFromInts(),
+            ToAbsoluteCoords(),
+            enable_if(cfg.augment_photometric_distort, photometric_distort()),
+        ])
+
+    def __call__(self, img, masks, boxes, labels):
+        return self.augment(img, masks, boxes, labels)
+
+
 class SSDAugmentationVideo(object):
     """ Transform to be used when training. """
 
@@ -924,7 +1177,7 @@ class SSDAugmentationVideo(object):
         self.augment_s1 = ComposeVideo([
             ConvertFromInts(),
             ToAbsoluteCoords(),
-            enable_if(cfg.augment_photometric_distort, PhotometricDistort()),
+            enable_if(cfg.augment_photometric_distort, photometric_distort()),
             enable_if(cfg.augment_expand, Expand(mean)),
             enable_if(cfg.augment_random_sample_crop, RandomSampleCrop()),
             enable_if(cfg.augment_random_mirror, RandomMirror()),
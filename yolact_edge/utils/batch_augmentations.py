@@ -0,0 +1,229 @@
+import torch
+import torch.nn.functional as F
+import numpy as np
+from numpy import random
+
+from yolact_edge.data import cfg, MEANS, STD
+from yolact_edge.utils.augmentations import sample_crop
+
+
+class BatchedSSDAugmentation(object):
+    """
+    The geometric half of SSDAugmentation (expand, random sample crop, mirror, flip and resize) plus the
+    backbone transform, done on a whole collated batch at once on the training device.
+
+    Each of those transforms only scales, shifts or flips the image, so chained together they're a single
+    affine map from the output to the source image. The random parameters are drawn on the CPU with the same
+    distributions as Expand, RandomSampleCrop, etc. (which only needs the boxes), and then every image in the
+    batch is resampled with one grid_sample call. Each image's masks are resampled with one call as well, by
+    treating the objects as channels. Pixels that fall outside the source image come out as the mean, like
+    the padding that Expand does.
+
+    Use this with SSDAugmentationPhotometric as the dataset transform and padded_detection_collate as the
+    collate function. It takes and returns data in the same (images, (targets, masks, num_crowds)) format as
+    detection_collate, so prepare_data can be called on the result.
+    """
+
+    def __init__(self, device, mean=MEANS, std=STD):
+        if cfg.preserve_aspect_ratio:
+            raise NotImplementedError('Batched augmentation needs a fixed output size.')
+        if cfg.augment_random_rot90:
+            raise NotImplementedError('Batched augmentation does not support augment_random_rot90.')
+        if cfg.use_gt_bboxes:
+            raise NotImplementedError('Batched augmentation does not support use_gt_bboxes.')
+
+        self.device = device
+
+        if type(cfg.max_size) == tuple:
+            self.width, self.height = cfg.max_size
+        else:
+            self.width, self.height = cfg.max_size, cfg.max_size
+
+        self.mean = torch.tensor(mean, dtype=torch.float32, device=device)[None, :, None, None]
+        self.std  = torch.tensor(std,  dtype=torch.float32, device=device)[None, :, None, None]
+        self.transform = cfg.backbone.transform
+
+        channel_map = {c: idx for idx, c in enumerate('BGR')}
+        self.channel_permutation = [channel_map[c] for c in self.transform.channel_order]
+
+        # Same as in RandomSampleCrop
+        self.sample_options = (
+            None,
+            (0.1, None),
+            (0.3, None),
+            (0.7, None),
+            (0.9, None),
+            (None, None),
+        )
+
+    def sample_expand(self, width, height):
+        """ Returns the position of the image on the expanded canvas and the canvas size. """
+        if not cfg.augment_expand or random.randint(2):
+            return 0, 0, width, height
+
+        ratio = random.uniform(1, 4)
+        left = random.uniform(0, width*ratio - width)
+        top = random.uniform(0, height*ratio - height)
+
+        return int(left), int(top), int(width*ratio), int(height*ratio)
+
+    def sample_crop(self, boxes, num_crowds, width, height):
+        """ Returns a crop rect [x1, y1, x2, y2] and which boxes to keep, or None to use the whole image. """
+        if not cfg.augment_random_sample_crop:
+            return None
+
+        while True:
+            mode = self.sample_options[random.randint(len(self.sample_options))]
+
+            if mode is None:
+                return None
+
+            min_iou, max_iou = mode
+            if min_iou is None:
+                min_iou = float('-inf')
+            if max_iou is None:
+                max_iou = float('inf')
+
+            crop = sample_crop(boxes, num_crowds, width, height, min_iou, max_iou)
+            if crop is not None:
+                return crop[4:]
+
+    def sample(self, target, num_crowds, width, height):
+        """
+        Draws the augmentation for one image. Returns the transformed target (in percent coordinates), the
+        indices of the objects that survived and the source rect [x, y, w, h] that maps onto the output. The
+        rect is relative to the source image, so it can stick out of it. A negative w or h means mirrored.
+        """
+        boxes = target[:, :4].astype(np.float32)
+        labels = target[:, 4]
+        keep = np.arange(boxes.shape[0])
+
+        ex, ey, canvas_w, canvas_h = self.sample_expand(width, height)
+        boxes = boxes + np.array([ex, ey, ex, ey], dtype=np.float32)
+
+        crop = self.sample_crop(boxes, num_crowds, canvas_w, canvas_h)
+        if crop is None:
+            rect = np.array([0, 0, canvas_w, canvas_h])
+        else:
+            rect, mask = crop
+            boxes = boxes[mask].copy()
+            keep = keep[mask]
+
+            boxes[:, :2] = np.maximum(boxes[:, :2], rect[:2]) - rect[:2]
+            boxes[:, 2:] = np.minimum(boxes[:, 2:], rect[2:]) - rect[:2]
+
+        x, y = rect[0] - ex, rect[1] - ey
+        w, h = rect[2] - rect[0], rect[3] - rect[1]
+
+        if cfg.augment_random_mirror and random.randint(2):
+            boxes[:, 0::2] = w - boxes[:, 2::-2]
+            x, w = x + w, -w
+
+        if cfg.augment_random_flip and random.randint(2):
+            boxes[:, 1::2] = abs(h) - boxes[:, 3::-2]
+            y, h = y + h, -h
+
+        boxes[:, [0, 2]] *= self.width  / abs(w)
+        boxes[:, [1, 3]] *= self.height / abs(h)
+
+        # Discard boxes that are smaller than we'd like, like Resize does
+        box_w = boxes[:, 2] - boxes[:, 0]
+        box_h = boxes[:, 3] - boxes[:, 1]
+        small = (box_w > cfg.discard_box_width) * (box_h > cfg.discard_box_height)
+
+        boxes = boxes[small]
+        keep = keep[small]
+
+        boxes[:, [0, 2]] /= self.width
+        boxes[:, [1, 3]] /= self.height
+
+        target = np.hstack((boxes, labels[keep, None])).astype(np.float32)
+        return target, keep, (x, y, w, h)
+
+    def theta(self, rect, in_w, in_h):
+        """ The affine_grid matrix that maps the output onto rect of an in_w x in_h input (align_corners=False). """
+        x, y, w, h = rect
+        return [[w / in_w, 0, (w + 2*x) / in_w - 1],
+                [0, h / in_h, (h + 2*y) / in_h - 1]]
+
+    def draw(self, datum):
+        """
+        Draws the augmentation of every image in datum without resampling anything. Returns the transformed
+        targets and crowd counts (the same as __call__ returns) and the kept objects and source rect of each
+        image, which apply takes to do the rest.
+        """
+        images, (targets, masks, num_crowds) = datum
+
+        out_targets = []
+        out_crowds = []
+        samples = []
+
+        for idx in range(len(targets)):
+            # The parameters are drawn on the CPU, so the targets should stay on the host (see DataPrefetcher's
+            # host_targets). Ones on the GPU are brought back, which waits on the device.
+            target = targets[idx].cpu().numpy()
+            height, width = masks[idx].shape[1:]
+
+            # Unlike the per image version, we can't ask the data loader for another image if the augmentation
+            # throws away every box, so redraw a few times and fall back to just resizing the image.
+            for _ in range(10):
+                new_target, keep, rect = self.sample(target, num_crowds[idx], width, height)
+                if new_target.shape[0] > 0:
+                    break
+            else:
+                rect = (0, 0, width, height)
+                new_target = target[:, :4] / np.array([width, height, width, height], dtype=np.float32)
+                new_target = np.hstack((new_target, target[:, 4:])).astype(np.float32)
+                keep = np.arange(target.shape[0])
+
+            out_targets.append(torch.from_numpy(new_target))
+            out_crowds.append(int((new_target[:, 4] < 0).sum()))
+            samples.append((keep, rect))
+
+        return out_targets, out_crowds, samples
+
+    def apply(self, datum, drawn):
+        """ Resamples the images and masks of datum with the augmentation draw(datum) returned. """
+        images, (_, masks, _) = datum
+        out_targets, out_crowds, samples = drawn
+
+        batch_size, _, in_h, in_w = images.size()
+        images = images.to(self.device, non_blocking=True)
+
+        out_masks = []
+        thetas = []
+
+        for idx, (keep, rect) in enumerate(samples):
+            height, width = masks[idx].shape[1:]
+            thetas.append(self.theta(rect, in_w, in_h))
+
+            # All the masks for one image share the same transform, so do them as channels of one image
+            cur_masks = masks[idx][torch.from_numpy(keep)].to(self.device, non_blocking=True)
+            cur_theta = torch.tensor([self.theta(rect, width, height)], dtype=torch.float32, device=self.device)
+            grid = F.affine_grid(cur_theta, (1, cur_masks.size(0), self.height, self.width), align_corners=False)
+            cur_masks = F.grid_sample(cur_masks[None].float(), grid, mode='bilinear', align_corners=False)[0]
+
+            # Resize interpolates the uint8 masks, which rounds them back to 0 and 1
+            out_masks.append((cur_masks >= 0.5).float())
+
+        thetas = torch.tensor(thetas, dtype=torch.float32, device=self.device)
+        grid = F.affine_grid(thetas, (batch_size, 3, self.height, self.width), align_corners=False)
+
+        # Sample with the mean subtracted so that anything outside the image (which grid_sample zero pads) is the mean
+        images = F.grid_sample(images - self.mean, grid, mode='bilinear', align_corners=False)
+
+        if self.transform.normalize:
+            images = images / self.std
+        elif self.transform.subtract_means:
+            pass
+        elif self.transform.to_float:
+            images = (images + self.mean) / 255
+        else:
+            images = images + self.mean
+
+        images = images[:, self.channel_permutation].contiguous()
+
+        return images, (out_targets, out_masks, out_crowds)
+
+    def __call__(self, datum):
+        return self.apply(datum, self.draw(datum))
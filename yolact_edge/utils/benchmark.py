@@ -0,0 +1,128 @@
+import json
+import os
+import platform
+import time
+
+import torch
+
+
+RESULTS_VERSION = 1
+
+
+def environment(device):
+    """ What a benchmark ran on, saved with its results so runs on different machines aren't compared blindly. """
+    env = {
+        'python': platform.python_version(),
+        'torch': torch.__version__,
+        'cuda': torch.version.cuda,
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+        'num_threads': torch.get_num_threads(),
+        'device': str(device),
+        'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+    }
+
+    if torch.device(device).type == 'cuda':
+        env['device_name'] = torch.cuda.get_device_name(device)
+        env['cudnn'] = torch.backends.cudnn.version()
+
+    return env
+
+
+def run_key(run):
+    """ What identifies a run across result files. """
+    return (run['config'], run['size'], run['batch_size'], run['mode'])
+
+
+def stage_stats(stats, root):
+    """
+    Picks the regions timed under root out of utils.timer.stats() and names them by their path below it (e.g.
+    'fpn/flow'). root itself becomes 'total'. 'self' is the mean time of each stage minus the stages nested in it.
+    """
+    stages = {}
+    for path, s in stats.items():
+        if path == root:
+            name = 'total'
+        elif path.startswith(root + '/'):
+            name = path[len(root) + 1:]
+        else:
+            continue
+
+        stages[name] = {k: s[k] for k in ('count', 'mean', 'p50', 'p95', 'p99')}
+        stages[name]['self'] = s['self'] / s['count']
+        for key in ('device', 'memory'):
+            if key in s:
+                stages[name][key] = s[key]
+    return stages
+
+
+def save_results(path, results):
+    with open(path, 'w') as f:
+        json.dump(dict(results, version=RESULTS_VERSION), f, indent=2)
+
+
+def load_results(path):
+    with open(path, 'r') as f:
+        results = json.load(f)
+    if results.get('version') != RESULTS_VERSION:
+        raise ValueError('{} is not a benchmark result file of version {}.'.format(path, RESULTS_VERSION))
+    return results
+
+
+def compare_results(base, new, metric='p50', threshold=0.1, min_delta=0.1):
+    """
+    Compares the stages of every run in new with the same run (config, size, batch size and mode) in base.
+
+    A stage regressed if its metric (in ms) went up by more than threshold (a fraction of the base time) and by
+    more than min_delta ms, so that noise in stages that take next to no time isn't reported.
+
+    Returns a list of (run key, stage, base ms, new ms, regressed) for every stage in both, and the keys of the
+    runs that are only in one of them.
+    """
+    base_runs = {run_key(run): run for run in base['runs']}
+    new_runs = {run_key(run): run for run in new['runs']}
+
+    rows = []
+    for key, run in new_runs.items():
+        if key not in base_runs:
+            continue
+
+        base_stages = base_runs[key]['stages']
+        for stage, s in run['stages'].items():
+            if stage not in base_stages:
+                continue
+
+            old_ms, new_ms = base_stages[stage][metric], s[metric]
+            regressed = new_ms - old_ms > max(threshold * old_ms, min_delta)
+            rows.append((key, stage, old_ms, new_ms, regressed))
+
+    unmatched = sorted(set(base_runs) ^ set(new_runs))
+    return rows, unmatched
+
+
+def print_comparison(rows, unmatched, metric='p50'):
+    """ Prints the output of compare_results as a table, with regressed stages marked. """
+    print()
+
+    names = ['{} {} b{} {}'.format(*key) for key, *_ in rows]
+    max_run_width = max([len(name) for name in names] + [3])
+    max_stage_width = max([len(row[1]) for row in rows] + [5])
+
+    header = (' {:<%d} | {:<%d} | {:>10} | {:>10} | {:>8} ' % (max_run_width, max_stage_width)).format(
+        'Run', 'Stage', 'Base ' + metric, 'New ' + metric, 'Change')
+    format_str = ' {:<%d} | {:<%d} | {:>10.3f} | {:>10.3f} | {:>+7.1f}%% {}' % (max_run_width, max_stage_width)
+
+    print(header)
+    print('-' * len(header))
+    for name, (key, stage, old_ms, new_ms, regressed) in zip(names, rows):
+        change = (new_ms / old_ms - 1) * 100 if old_ms > 0 else 0
+        print(format_str.format(name, stage, old_ms, new_ms, change, '<- regression' if regressed else ''))
+    print()
+
+    for key in unmatched:
+        print('Only in one of the results: {} {} b{} {}'.format(*key))
+
+    num_regressed = sum(row[-1] for row in rows)
+    print('{} of {} stages regressed.'.format(num_regressed, len(rows)))
+    print()
@@ -0,0 +1,50 @@
+import torch
+
+
+class BufferPool():
+    """
+    Output tensors that are reused from frame to frame instead of allocated every time, for steady state inference
+    on inputs of a fixed size.
+
+    get() returns the buffer called name if it still has the size, dtype and device asked for, and allocates a new
+    one otherwise. allocations counts the latter, so once the pool has warmed up (a frame of each kind, e.g. a
+    keyframe and a non-keyframe) it shouldn't go up anymore. That only covers the pool's own buffers; benchmark.py
+    --output_buffers checks that none of the outputs are allocated anymore with utils.memory.
+
+    A buffer is overwritten by the frame that reuses it, so anything that holds on to outputs across frames (like
+    a pipeline with several frames in flight) needs num_slots of at least the number of frames in flight. Each
+    call to next_frame() moves on to the next slot.
+    """
+
+    def __init__(self, num_slots=1):
+        self.num_slots = num_slots
+        self.slot = 0
+        self.buffers = {}
+
+        self.allocations = 0
+        self.reuses = 0
+
+    def next_frame(self):
+        self.slot = (self.slot + 1) % self.num_slots
+
+    def get(self, name, size, dtype=torch.float32, device=None):
+        key = (name, self.slot)
+        size = torch.Size(size)
+
+        buf = self.buffers.get(key)
+        if buf is None or buf.size() != size or buf.dtype != dtype or buf.device != torch.device(device or 'cpu'):
+            buf = self.buffers[key] = torch.empty(size, dtype=dtype, device=device)
+            self.allocations += 1
+        else:
+            self.reuses += 1
+        return buf
+
+    def clear(self):
+        self.buffers.clear()
+
+    def stats(self):
+        return {
+            'allocations': self.allocations,
+            'reuses': self.reuses,
+            'bytes': sum(buf.numel() * buf.element_size() for buf in self.buffers.values()),
+        }
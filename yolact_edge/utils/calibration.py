@@ -0,0 +1,145 @@
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+
+import cv2
+import numpy as np
+import torch
+from torch.utils.data import Dataset, DataLoader
+
+
+def calibration_folders(calib_images):
+    """
+    Splits cfg.dataset.calib_images into (keyframe folder, next frame folder). Video calibration sets are given
+    as dir:prev_folder:next_folder, image ones as a single folder, in which case the second folder is None.
+    """
+    if ':' in calib_images:
+        calib_dir, prev_folder, next_folder = calib_images.split(':')
+        return os.path.join(calib_dir, prev_folder), os.path.join(calib_dir, next_folder)
+    return calib_images, None
+
+
+def iterate_batches(dataset, batch_size=1, device=None, num_workers=None):
+    """ Yields the items of dataset in order, stacked batch_size at a time and loaded by num_workers processes. """
+    if num_workers is None:
+        num_workers = min(4, os.cpu_count() or 1)
+
+    loader = DataLoader(dataset, batch_size=batch_size, num_workers=num_workers,
+                        pin_memory=device is not None and torch.device(device).type == 'cuda')
+
+    for batch in loader:
+        yield batch if device is None else batch.to(device, non_blocking=True)
+
+
+class CalibrationImages(Dataset):
+    """
+    The first max_images images in calib_folder (sorted by name), read and transformed only when they're indexed,
+    so a calibration set never has to fit in memory at once. Each item is a [3, h, w] float tensor on the CPU.
+
+    This can be given to torch2trt as an int8 calibration dataset directly. Use batches() to run through it.
+    """
+
+    def __init__(self, calib_folder, transform, max_images):
+        self.transform = transform
+        self.paths = sorted(str(x) for x in Path(calib_folder).glob('*'))[:max_images]
+
+        if len(self.paths) == 0:
+            raise FileNotFoundError('No calibration images in {}.'.format(calib_folder))
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getitem__(self, idx):
+        img = cv2.imread(self.paths[idx])
+        height, width, _ = img.shape
+
+        img, _, _, _ = self.transform(img, np.zeros((1, height, width), dtype=np.float), np.array([[0, 0, 1, 1]]),
+            {'num_crowds': 0, 'labels': np.array([0])})
+
+        return torch.from_numpy(img).permute(2, 0, 1)
+
+    def batches(self, batch_size=1, device=None, num_workers=None):
+        """ Yields the images in order, batch_size at a time, decoded in parallel. See iterate_batches. """
+        return iterate_batches(self, batch_size, device, num_workers)
+
+
+class MemmapActivations(Dataset):
+    """ Activations saved by ActivationCache, read from disk an item at a time. Items are [c, h, w] tensors. """
+
+    def __init__(self, path):
+        self.array = np.load(path, mmap_mode='r')
+
+    def __len__(self):
+        return self.array.shape[0]
+
+    def __getitem__(self, idx):
+        return torch.from_numpy(np.array(self.array[idx]))
+
+
+class ActivationWriter(object):
+    """ Appends batches of activations to a .npy file of count items, which only appears at path once it's closed. """
+
+    def __init__(self, path, count):
+        self.path = path
+        self.count = count
+        self.tmp_path = '{}.{}.tmp.npy'.format(path[:-len('.npy')], os.getpid())
+
+        self.array = None
+        self.written = 0
+
+    def write(self, batch):
+        batch = batch.detach().float().cpu().numpy()
+        if self.array is None:
+            self.array = np.lib.format.open_memmap(self.tmp_path, mode='w+', dtype=np.float32,
+                                                   shape=(self.count,) + batch.shape[1:])
+
+        num = min(batch.shape[0], self.count - self.written)
+        self.array[self.written:self.written + num] = batch[:num]
+        self.written += num
+
+    def close(self):
+        if self.array is None:
+            return
+        if self.written != self.count:
+            raise RuntimeError('Expected {} activations for {} but got {}.'.format(self.count, self.path, self.written))
+
+        self.array.flush()
+        del self.array
+        self.array = None
+        os.replace(self.tmp_path, self.path)
+
+
+class ActivationCache(object):
+    """
+    Intermediate activations for calibration (e.g. the inputs to the protonet and flow net), saved to disk as .npy
+    files so that they're only computed once and are memory mapped instead of held in memory when they're used.
+
+    Each key gets its own folder under root, so activations made with other weights, another config or other
+    calibration images are never read back. The key is also saved next to them as key.json.
+    """
+
+    def __init__(self, root, key):
+        self.key = json.loads(json.dumps(key, sort_keys=True))
+        digest = hashlib.sha1(json.dumps(self.key, sort_keys=True).encode()).hexdigest()[:16]
+        self.path = os.path.join(root, digest)
+        self.logger = logging.getLogger("yolact.calibration")
+
+    def _file(self, name):
+        return os.path.join(self.path, name + '.npy')
+
+    def has(self, name):
+        return os.path.isfile(self._file(name))
+
+    def load(self, name):
+        self.logger.debug('Loading cached {} calibration activations from {}.'.format(name, self.path))
+        return MemmapActivations(self._file(name))
+
+    def writer(self, name, count):
+        os.makedirs(self.path, exist_ok=True)
+        key_path = os.path.join(self.path, 'key.json')
+        if not os.path.isfile(key_path):
+            with open(key_path, 'w') as f:
+                json.dump(self.key, f, indent=2, sort_keys=True)
+        return ActivationWriter(self._file(name), count)
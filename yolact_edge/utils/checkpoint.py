@@ -0,0 +1,115 @@
+import os
+import threading
+import queue
+import logging
+
+import torch
+
+
+def training_state_path(path):
+    """ Where the optimizer state etc. that goes with the weights at path is saved. """
+    return path + '.opt'
+
+
+def atomic_save(obj, path):
+    """ torch.save, but through a temp file and a rename so a crash never leaves a half-written file at path. """
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    try:
+        torch.save(obj, tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def to_cpu(obj):
+    """ Returns a copy of obj with every tensor copied to the CPU, so it no longer changes as training goes on. """
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    elif isinstance(obj, dict):
+        return type(obj)((k, to_cpu(v)) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(x) for x in obj)
+    else:
+        return obj
+
+
+def load_training_state(path):
+    """ Returns the training state saved alongside the weights at path, or None if there isn't any. """
+    state_path = training_state_path(path)
+    if not os.path.exists(state_path):
+        return None
+    return torch.load(state_path, map_location='cpu')
+
+
+class CheckpointWriter(object):
+    """
+    Saves checkpoints on a background thread so that training doesn't stall while they're serialized.
+
+    save() copies everything to the CPU right away (which is quick and has to happen before the next step changes
+    the weights) and leaves the slow part, torch.save to disk, to the thread. Files are written atomically with
+    atomic_save. Saves and removes are done in the order they were asked for, so removing the previous checkpoint
+    after saving a new one never leaves you with neither.
+
+    The weights are saved exactly like Yolact.save_weights, so the files work with eval.py and load_weights. If
+    training_state is given, it's saved next to them (see training_state_path) for --resume.
+    """
+
+    def __init__(self):
+        self.logger = logging.getLogger("yolact.checkpoint")
+        self.jobs = queue.Queue()
+        self.error = None
+
+        self.thread = threading.Thread(target=self._run, name='checkpoint-writer', daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            job = self.jobs.get()
+            try:
+                if job is None:
+                    return
+                job()
+            except Exception as e:
+                self.logger.exception('Checkpoint writer failed')
+                self.error = e
+            finally:
+                self.jobs.task_done()
+
+    def _check(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError('A previous checkpoint failed to save') from error
+
+    def save(self, path, state_dict, training_state=None):
+        self._check()
+
+        state_dict = to_cpu(state_dict)
+        training_state = to_cpu(training_state)
+
+        def job():
+            atomic_save(state_dict, path)
+            if training_state is not None:
+                atomic_save(training_state, training_state_path(path))
+            self.logger.info('Saved {}'.format(path))
+
+        self.jobs.put(job)
+
+    def remove(self, path):
+        """ Removes a checkpoint (and its training state) once everything queued before this is written. """
+        def job():
+            for p in (path, training_state_path(path)):
+                if os.path.exists(p):
+                    os.remove(p)
+
+        self.jobs.put(job)
+
+    def wait(self):
+        """ Blocks until everything queued so far is on disk. """
+        self.jobs.join()
+        self._check()
+
+    def close(self):
+        self.wait()
+        self.jobs.put(None)
+        self.thread.join()
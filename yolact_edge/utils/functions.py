@@ -129,6 +129,9 @@ class SavePath:
     def remove_interrupt(save_folder):
         for p in Path(save_folder).glob('*_interrupt.pth'):
             p.unlink()
+        # And the optimizer state saved with it, if any (see utils/checkpoint.py)
+        for p in Path(save_folder).glob('*_interrupt.pth.opt'):
+            p.unlink()
     
     @staticmethod
     def get_interrupt(save_folder):
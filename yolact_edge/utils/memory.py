@@ -0,0 +1,196 @@
+import tracemalloc
+import weakref
+
+import torch
+from torch.utils._python_dispatch import TorchDispatchMode
+from torch.utils._pytree import tree_flatten
+
+
+class CudaMemory():
+    """ The bytes allocated by PyTorch's CUDA caching allocator on device, from its own statistics. """
+
+    name = 'cuda'
+
+    def __init__(self, device=None):
+        self.device = device
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def current(self):
+        return torch.cuda.memory_allocated(self.device)
+
+    def peak(self):
+        return torch.cuda.max_memory_allocated(self.device)
+
+    def reset_peak(self):
+        torch.cuda.reset_peak_memory_stats(self.device)
+
+
+class _TensorTracker(TorchDispatchMode):
+
+    def __init__(self, counter):
+        super().__init__()
+        self.counter = counter
+
+    def __torch_dispatch__(self, func, types, args=(), kwargs=None):
+        out = func(*args, **(kwargs or {}))
+
+        # Views and in-place ops return the storage of one of their inputs, which isn't a new allocation
+        inputs = set()
+        for arg in tree_flatten((args, kwargs))[0]:
+            if isinstance(arg, torch.Tensor):
+                inputs.add(arg.untyped_storage().data_ptr())
+
+        for tensor in tree_flatten(out)[0]:
+            if isinstance(tensor, torch.Tensor) and tensor.device.type == self.counter.device_type:
+                self.counter.track(tensor, inputs)
+        return out
+
+
+class TensorMemory():
+    """
+    The bytes of the CPU tensors PyTorch allocated since start(), for which there are no allocator statistics.
+
+    Every op run on this thread is intercepted with a TorchDispatchMode (which works inside TorchScript modules
+    too), and the storage of each tensor it returns is counted until the last tensor using it is freed. Tensors
+    that existed before start() aren't counted. Pass another device_type to count the tensors of that device, e.g.
+    to check which tensors were allocated with tracks().
+    """
+
+    name = 'tensors'
+
+    def __init__(self, device_type='cpu'):
+        self.device_type = device_type
+        self._live = {}
+        self._current = 0
+        self._peak = 0
+        self._mode = None
+
+    def start(self):
+        self._mode = _TensorTracker(self)
+        self._mode.__enter__()
+
+    def stop(self):
+        if self._mode is not None:
+            self._mode.__exit__(None, None, None)
+            self._mode = None
+
+    def track(self, tensor, inputs):
+        storage = tensor.untyped_storage()
+        key = storage.data_ptr()
+        if key not in self._live:
+            if key in inputs:
+                return
+            self._live[key] = [0, storage.nbytes()]
+            self._current += storage.nbytes()
+            self._peak = max(self._peak, self._current)
+
+        self._live[key][0] += 1
+        weakref.finalize(tensor, self._free, key)
+
+    def tracks(self, tensor):
+        """ Whether the storage of tensor was allocated since start() (and is still alive). """
+        return tensor.untyped_storage().data_ptr() in self._live
+
+    def _free(self, key):
+        entry = self._live[key]
+        entry[0] -= 1
+        if entry[0] == 0:
+            self._current -= entry[1]
+            del self._live[key]
+
+    def current(self):
+        return self._current
+
+    def peak(self):
+        return self._peak
+
+    def reset_peak(self):
+        self._peak = self._current
+
+
+class PythonMemory():
+    """ The bytes allocated by Python and numpy (which reports its arrays to tracemalloc), from tracemalloc. """
+
+    name = 'python'
+
+    def __init__(self):
+        self._started = False
+
+    def start(self):
+        self._started = not tracemalloc.is_tracing()
+        if self._started:
+            tracemalloc.start()
+
+    def stop(self):
+        if self._started:
+            tracemalloc.stop()
+
+    def current(self):
+        return tracemalloc.get_traced_memory()[0]
+
+    def peak(self):
+        return tracemalloc.get_traced_memory()[1]
+
+    def reset_peak(self):
+        tracemalloc.reset_peak()
+
+
+class MemoryFrame():
+    __slots__ = ('start', 'peaks')
+
+    def __init__(self, start):
+        self.start = start
+        self.peaks = dict(start)
+
+
+class MemoryRecorder():
+    """
+    Measures the memory each region of a Profiler allocates, with one or more counters (CudaMemory, TensorMemory,
+    PythonMemory). For every region and counter it records the peak above what was allocated when the region
+    started and what's still allocated when it ends (the retained bytes, e.g. outputs and saved features).
+
+    The counters only have a single peak, so it's reset when a region starts and the peak up to then is passed
+    on to the regions it's nested in. The counters are for the whole process (TensorMemory for the thread that
+    called start()), so regions are only attributed correctly when one thread runs them at a time.
+    """
+
+    def __init__(self, counters):
+        self.counters = counters
+
+    def start(self):
+        for counter in self.counters:
+            counter.start()
+
+    def stop(self):
+        for counter in self.counters:
+            counter.stop()
+
+    def enter(self, parent):
+        """ Called when a region starts, with the MemoryFrame of the region it's nested in, if any. """
+        for counter in self.counters:
+            if parent is not None:
+                parent.peaks[counter.name] = max(parent.peaks[counter.name], counter.peak())
+            counter.reset_peak()
+        return MemoryFrame({counter.name: counter.current() for counter in self.counters})
+
+    def exit(self, frame, parent):
+        """ Called when a region ends. Returns the peak and retained bytes of each counter. """
+        usage = {}
+        for counter in self.counters:
+            peak = max(frame.peaks[counter.name], counter.peak())
+            if parent is not None:
+                parent.peaks[counter.name] = max(parent.peaks[counter.name], peak)
+            usage[counter.name] = (peak - frame.start[counter.name], counter.current() - frame.start[counter.name])
+        return usage
+
+
+def default_counters(device=None):
+    """ The CUDA allocator's statistics on CUDA devices and tensor allocations on the CPU, and Python's either way. """
+    if device is not None and torch.device(device).type == 'cuda':
+        return [CudaMemory(device), PythonMemory()]
+    return [TensorMemory(), PythonMemory()]
@@ -0,0 +1,318 @@
+"""
+Counters, gauges and histograms for long-running inference, which can be scraped by Prometheus.
+
+Everything goes through the module level registry, which is a NullRegistry until enable() is called, so that
+metrics cost next to nothing when they aren't collected:
+
+    from yolact_edge.utils import metrics
+    metrics.enable(port=9100)  # Serves http://127.0.0.1:9100/metrics from a background thread
+    metrics.frames_in().inc()
+
+Any object with the counter / gauge / histogram methods of Registry can be plugged in with set_registry() (e.g. an
+adapter for prometheus_client).
+"""
+
+import logging
+import math
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from yolact_edge.utils import timer
+
+
+DEFAULT_BUCKETS = (.001, .0025, .005, .01, .025, .05, .075, .1, .25, .5, 1.0, 2.5, 5.0, math.inf)
+
+
+class _NullMetric():
+    """ What a NullRegistry returns for every metric. Every method does nothing. """
+
+    def labels(self, **labels):
+        return self
+
+    def inc(self, amount=1):
+        pass
+
+    def dec(self, amount=1):
+        pass
+
+    def set(self, value):
+        pass
+
+    def observe(self, value):
+        pass
+
+
+_NULL_METRIC = _NullMetric()
+
+
+class _Child():
+    """ A metric with its label values filled in. """
+    __slots__ = ('metric', 'key')
+
+    def __init__(self, metric, key):
+        self.metric = metric
+        self.key = key
+
+    def inc(self, amount=1):
+        self.metric._inc(self.key, amount)
+
+    def dec(self, amount=1):
+        self.metric._inc(self.key, -amount)
+
+    def set(self, value):
+        self.metric._set(self.key, value)
+
+    def observe(self, value):
+        self.metric._observe(self.key, value)
+
+
+def _format_labels(labelnames, key, extra=()):
+    pairs = list(zip(labelnames, key)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', r'\\').replace('"', r'\"'))
+                          for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value))
+
+
+class Metric():
+    """ A metric with a value for every combination of the values of its labelnames. Use labels() to pick one. """
+
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def labels(self, **labels):
+        return _Child(self, tuple(str(labels[name]) for name in self.labelnames))
+
+    def inc(self, amount=1):
+        self._inc((), amount)
+
+    def dec(self, amount=1):
+        self._inc((), -amount)
+
+    def set(self, value):
+        self._set((), value)
+
+    def observe(self, value):
+        self._observe((), value)
+
+    def _inc(self, key, amount):
+        raise TypeError('{} {} can\'t be incremented.'.format(self.type, self.name))
+
+    def _set(self, key, value):
+        raise TypeError('{} {} can\'t be set.'.format(self.type, self.name))
+
+    def _observe(self, key, value):
+        raise TypeError('{} {} can\'t observe values.'.format(self.type, self.name))
+
+    def samples(self):
+        """ A list of (name, label string, value) for every value of this metric. """
+        with self._lock:
+            return [(self.name, _format_labels(self.labelnames, key), value) for key, value in self._values.items()]
+
+    def exposition(self):
+        lines = ['# HELP {} {}'.format(self.name, self.documentation), '# TYPE {} {}'.format(self.name, self.type)]
+        lines += ['{}{} {}'.format(name, labels, _format_value(value)) for name, labels, value in self.samples()]
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    """ A count that only goes up, like the number of frames processed. """
+
+    type = 'counter'
+
+    def _inc(self, key, amount):
+        if amount < 0:
+            raise ValueError('Counter {} can only go up.'.format(self.name))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """ A value that goes up and down, like the number of frames waiting in a queue. """
+
+    type = 'gauge'
+
+    def _inc(self, key, amount):
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _set(self, key, value):
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(Metric):
+    """ Counts of the observed values in each of buckets (upper bounds), along with their sum and count. """
+
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        if self.buckets[-1] != math.inf:
+            self.buckets += (math.inf,)
+
+    def _observe(self, key, value):
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+
+            for idx, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][idx] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for key, (counts, total, count) in self._values.items():
+                cumulative = 0
+                for bound, num in zip(self.buckets, counts):
+                    cumulative += num
+                    labels = _format_labels(self.labelnames, key, [('le', _format_value(bound))])
+                    samples.append((self.name + '_bucket', labels, cumulative))
+                samples.append((self.name + '_sum', _format_labels(self.labelnames, key), total))
+                samples.append((self.name + '_count', _format_labels(self.labelnames, key), count))
+        return samples
+
+
+class Registry():
+    """ Keeps every metric by name. Asking for a metric that already exists returns it. """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def _get(self, cls, name, documentation, labelnames, **kwdargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, documentation, labelnames, **kwdargs)
+            elif type(metric) is not cls or metric.labelnames != tuple(labelnames):
+                raise ValueError('Metric {} already exists as a {} with labels {}.'.format(
+                    name, metric.type, metric.labelnames))
+            return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._get(Counter, name, documentation, labelnames)
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._get(Gauge, name, documentation, labelnames)
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._get(Histogram, name, documentation, labelnames, buckets=buckets)
+
+    def exposition(self):
+        """ Every metric in the Prometheus text exposition format. """
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda metric: metric.name)
+        return ''.join(metric.exposition() + '\n' for metric in metrics)
+
+    def serve(self, port, host='127.0.0.1'):
+        """ Serves exposition() at http://host:port/metrics from a daemon thread. Returns the server. """
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+
+                body = registry.exposition().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+
+        logging.getLogger("yolact.metrics").info(
+            'Serving metrics at http://{}:{}/metrics'.format(host, server.server_address[1]))
+        return server
+
+
+class NullRegistry():
+    """ The registry while metrics are disabled. Every metric it returns does nothing. """
+
+    def counter(self, name, documentation, labelnames=()):
+        return _NULL_METRIC
+
+    def gauge(self, name, documentation, labelnames=()):
+        return _NULL_METRIC
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return _NULL_METRIC
+
+    def exposition(self):
+        return ''
+
+
+registry = NullRegistry()
+
+
+def set_registry(new_registry):
+    """ Sends all metrics to new_registry from now on. Use a NullRegistry to disable them. """
+    global registry
+    registry = new_registry
+
+    if isinstance(new_registry, NullRegistry):
+        timer.profiler.metrics = None
+    else:
+        timer.profiler.metrics = stage_seconds()
+
+
+def enable(port=None, host='127.0.0.1'):
+    """ Starts collecting metrics in a Registry and, if port is given, serves them over HTTP on host. """
+    if isinstance(registry, NullRegistry):
+        set_registry(Registry())
+    if port is not None:
+        return registry.serve(port, host)
+
+
+# The metrics reported by the inference and video paths
+
+def frames_in():
+    return registry.counter('yolact_frames_in_total', 'Frames read from the input.')
+
+def frames_out():
+    return registry.counter('yolact_frames_out_total', 'Frames that came out of the pipeline (displayed, written or returned).')
+
+def frames_dropped():
+    return registry.counter('yolact_frames_dropped_total', 'Frames that couldn\'t be read from the input.')
+
+def network_frames():
+    return registry.counter('yolact_network_frames_total', 'Frames run through the network, by whether they were a keyframe.',
+                            ('keyframe',))
+
+def detections():
+    return registry.histogram('yolact_detections', 'Detections per frame.',
+                              buckets=(0, 1, 2, 5, 10, 20, 50, 100, 200, math.inf))
+
+def queue_size():
+    return registry.gauge('yolact_queue_size', 'Frames waiting in each queue of the video pipeline.', ('queue',))
+
+def stage_seconds():
+    return registry.histogram('yolact_stage_seconds', 'The time each stage timed with utils.timer took, by its path.',
+                              ('stage',))
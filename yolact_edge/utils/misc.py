@@ -28,4 +28,8 @@ def is_main_process():
 
 def barrier():
     if is_distributed_initialized():
-        dist.barrier()
\ No newline at end of file
+        dist.barrier()
+
+def is_scripted(module):
+    """ Whether module was compiled with torch.jit. With PYTORCH_JIT=0, ScriptModules are plain Python modules. """
+    return isinstance(module, torch.jit.ScriptModule) and isinstance(getattr(module, '_c', None), torch._C.ScriptModule)
@@ -0,0 +1,212 @@
+import contextlib
+import inspect
+import logging
+
+import torch
+import torch.nn as nn
+
+from yolact_edge.data.config import cfg
+from yolact_edge.layers.box_utils import jaccard
+from yolact_edge.utils.misc import is_scripted
+from yolact_edge.utils.shapes import record_input_shapes
+
+
+def decode_batched(loc, priors, variances=(0.1, 0.2)):
+    """ box_utils.decode for a whole batch of predictions [batch_size, num_priors, 4] at once. """
+    priors = priors[None]
+
+    centers = priors[:, :, :2] + loc[:, :, :2] * variances[0] * priors[:, :, 2:]
+    sizes = priors[:, :, 2:] * torch.exp(loc[:, :, 2:] * variances[1])
+
+    return torch.cat((centers - sizes / 2, centers + sizes / 2), dim=2)
+
+
+class FastNMS(nn.Module):
+    """
+    The decode and fast NMS that Detect does, but batched and with a fixed number of detections per image so that
+    it can be exported. Detections past the last real one (and the ones NMS removes) are padded with a score of 0.
+
+    Like Detect, only priors whose best class scores over conf_thresh take part, NMS is per class and the top
+    cfg.max_num_detections detections over all classes are returned. Returns boxes [batch_size, k, 4] in relative
+    point form, scores [batch_size, k], classes [batch_size, k] (without the background class, like Detect) and
+    mask coefficients [batch_size, k, mask_dim].
+    """
+
+    def __init__(self, detect, max_num_detections):
+        super().__init__()
+
+        self.conf_thresh = detect.conf_thresh
+        self.nms_thresh = detect.nms_thresh
+        self.top_k = detect.top_k
+        self.max_num_detections = max_num_detections
+
+    def forward(self, loc, conf, mask, priors):
+        batch_size = loc.size(0)
+        num_priors = priors.size(0)
+        mask_dim = mask.size(2)
+
+        boxes = decode_batched(loc, priors)
+
+        # [batch_size, num_classes, num_priors], ignoring the background class
+        scores = conf[:, :, 1:].transpose(1, 2)
+        num_classes = scores.size(1)
+
+        valid = scores.max(dim=1, keepdim=True)[0] > self.conf_thresh
+        scores = torch.where(valid, scores, torch.full_like(scores, -1))
+
+        top_k = min(self.top_k, num_priors)
+        scores, idx = scores.topk(top_k, dim=2)
+        valid = scores >= 0
+
+        idx = idx.reshape(batch_size, num_classes * top_k, 1)
+        boxes = torch.gather(boxes, 1, idx.expand(-1, -1, 4)).view(batch_size * num_classes, top_k, 4)
+        masks = torch.gather(mask, 1, idx.expand(-1, -1, mask_dim))
+
+        iou = jaccard(boxes, boxes).view(batch_size, num_classes, top_k, top_k)
+        # Only higher scoring, valid boxes get to suppress a box
+        iou = (iou * valid[:, :, :, None].float()).triu(diagonal=1)
+        iou_max = iou.max(dim=2)[0]
+
+        keep = (iou_max <= self.nms_thresh) & valid
+        scores = (scores * keep.float()).view(batch_size, num_classes * top_k)
+
+        classes = torch.arange(num_classes, device=loc.device)[None, :, None].expand(batch_size, -1, top_k)
+        classes = classes.reshape(batch_size, num_classes * top_k)
+
+        scores, order = scores.topk(min(self.max_num_detections, num_classes * top_k), dim=1)
+        boxes = torch.gather(boxes.view(batch_size, num_classes * top_k, 4), 1, order[:, :, None].expand(-1, -1, 4))
+        masks = torch.gather(masks, 1, order[:, :, None].expand(-1, -1, mask_dim))
+        classes = torch.gather(classes, 1, order)
+
+        return boxes, scores, classes, masks
+
+
+@contextlib.contextmanager
+def raw_predictions(net):
+    """ Makes net return the raw head outputs (after the softmax) instead of running Detect on them. """
+    detect = net.detect
+    net.detect = lambda preds: preds
+    try:
+        yield net
+    finally:
+        net.detect = detect
+
+
+class InferenceGraph(nn.Module):
+    """
+    One of the two inference paths of a Yolact model, as a module with only tensors going in and out, so that it
+    can be traced and exported.
+
+    The keyframe path (keyframe=True) takes images and runs the full backbone, both FPN phases, the protonet and
+    the prediction heads. The non-keyframe path takes images and the statistics saved from the last keyframe, and
+    runs the partial backbone, the flow net, the warp, SPA, the second FPN phase and the heads. See output_names
+    and input_names for what goes in and out. If the model doesn't warp features (cfg.flow.warp_mode is 'none'),
+    there's only the keyframe path and it doesn't output any statistics.
+
+    With nms=True, the outputs are run through FastNMS instead of returning every prior.
+    """
+
+    def __init__(self, net, keyframe=True, nms=False):
+        super().__init__()
+
+        self.net = net
+        self.keyframe = keyframe
+        self.with_statistics = cfg.flow is not None and cfg.flow.warp_mode != 'none'
+        self.num_feats = len(cfg.backbone.selected_layers)
+        # With P4P5 warping, P3 is rebuilt from the lateral layer, so the non-keyframe path doesn't take feat0
+        self.first_warped = 1 if self.with_statistics and cfg.flow.warp_layers == 'P4P5' else 0
+        self.nms = FastNMS(net.detect, cfg.max_num_detections) if nms else None
+
+        if not keyframe and not self.with_statistics:
+            raise ValueError('This model has no non-keyframe path (cfg.flow.warp_mode is \'none\').')
+
+        # Yolact only has an inference path in eval mode
+        self.eval()
+
+    @property
+    def input_names(self):
+        names = ['images']
+        if not self.keyframe:
+            names += ['lateral'] + ['feat{}'.format(i) for i in range(self.first_warped, self.num_feats)]
+        return names
+
+    @property
+    def output_names(self):
+        if self.nms is not None:
+            names = ['boxes', 'scores', 'classes', 'coeffs', 'proto']
+        else:
+            names = ['loc', 'conf', 'mask', 'priors', 'proto']
+
+        if self.keyframe and self.with_statistics:
+            names += ['lateral'] + ['feat{}'.format(i) for i in range(self.num_feats)]
+        return names
+
+    def forward(self, images, *statistics):
+        if self.keyframe:
+            extras = {"backbone": "full", "interrupt": False, "keep_statistics": True, "moving_statistics": None}
+        else:
+            extras = {"backbone": "partial", "interrupt": False,
+                      "moving_statistics": {"lateral": statistics[0],
+                                            "feats": [None] * self.first_warped + list(statistics[1:])}}
+
+        with raw_predictions(self.net):
+            outs = self.net(images, extras=extras)
+        preds = outs['pred_outs']
+
+        if self.nms is not None:
+            outputs = self.nms(preds['loc'], preds['conf'], preds['mask'], preds['priors']) + (preds['proto'],)
+        else:
+            outputs = (preds['loc'], preds['conf'], preds['mask'], preds['priors'], preds['proto'])
+
+        if self.keyframe and self.with_statistics:
+            outputs += (outs['lateral'],) + tuple(outs['feats'])
+
+        return outputs
+
+    def example_inputs(self, batch_size=1):
+        """ Zeros of the input shapes for cfg.max_size, as recorded by record_input_shapes. """
+        input_shapes = record_input_shapes(self.net)
+        shapes = input_shapes['backbone'][:1]
+
+        if not self.keyframe:
+            # The statistics are the lateral and the outputs of the first FPN phase, which the second phase takes
+            feats = input_shapes['fpn_phase_2'][:self.num_feats]
+            shapes = shapes + feats[:1] + feats[self.first_warped:]
+
+        device = next(self.net.parameters()).device
+        return tuple(torch.zeros((batch_size,) + shape[1:], device=device) for shape in shapes)
+
+    def inputs_after(self, images, keyframe_outputs):
+        """ The inputs of the non-keyframe path for images, given the outputs of the keyframe path before them. """
+        num_outputs = len(self.output_names)
+        return (images, keyframe_outputs[num_outputs]) + tuple(keyframe_outputs[num_outputs + 1 + self.first_warped:])
+
+
+def export_onnx(net, path, keyframe=True, nms=False, opset_version=16):
+    """
+    Exports one inference path of net (see InferenceGraph) to an ONNX file at path, with a dynamic batch size. The
+    image size is fixed to cfg.max_size. Returns the InferenceGraph that was exported.
+    """
+    logger = logging.getLogger("yolact.export")
+
+    scripted = [name for name, module in net.named_children() if is_scripted(module)]
+    if scripted:
+        raise RuntimeError('{} were compiled with torch.jit and can\'t be traced for export. '
+                           'Run with PYTORCH_JIT=0.'.format(', '.join(scripted)))
+
+    graph = InferenceGraph(net, keyframe=keyframe, nms=nms)
+    inputs = graph.example_inputs()
+
+    dynamic_axes = {name: {0: 'batch'} for name in graph.input_names + graph.output_names if name != 'priors'}
+
+    kwdargs = {}
+    if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+        # The dynamo exporter can't handle the Python side of Yolact's forward
+        kwdargs['dynamo'] = False
+
+    with torch.no_grad():
+        torch.onnx.export(graph, inputs, path, input_names=graph.input_names, output_names=graph.output_names,
+                          dynamic_axes=dynamic_axes, opset_version=opset_version, **kwdargs)
+
+    logger.info('Exported the {} path to {}.'.format('keyframe' if keyframe else 'non-keyframe', path))
+    return graph
@@ -0,0 +1,141 @@
+import logging
+
+import torch
+import torch.nn as nn
+
+try:
+    from torch.ao.nn.intrinsic import ConvReLU2d
+except ImportError:
+    from torch.nn.intrinsic import ConvReLU2d
+
+from yolact_edge.backbone import Bottleneck, ResNetBackbone
+from yolact_edge.yolact import NoReLUBottleneck, PredictionModule
+
+
+# Modules whose forward applies self.bn<i> directly to the output of self.conv<i>
+_CONV_BN_ATTRS = (
+    (Bottleneck,       (('conv1', 'bn1'), ('conv2', 'bn2'), ('conv3', 'bn3'))),
+    (NoReLUBottleneck, (('conv1', 'bn1'), ('conv2', 'bn2'), ('conv3', 'bn3'))),
+    (ResNetBackbone,   (('conv1', 'bn1'),)),
+    (PredictionModule, (('conv', 'bn'),)),
+)
+
+
+def fold_conv_bn(conv, bn):
+    """
+    Folds the (eval mode) batch norm bn into the conv right before it, in place. Afterwards conv(x) computes what
+    bn(conv(x)) used to. The math is done in double so the result is as close to the original as it can be.
+    """
+    weight = conv.weight.detach().double()
+    bias = conv.bias.detach().double() if conv.bias is not None else torch.zeros_like(weight[:, 0, 0, 0])
+
+    scale = torch.rsqrt(bn.running_var.double() + bn.eps)
+    if bn.affine:
+        scale = scale * bn.weight.detach().double()
+    shift = -bn.running_mean.double() * scale
+    if bn.affine:
+        shift = shift + bn.bias.detach().double()
+
+    conv.weight = nn.Parameter((weight * scale[:, None, None, None]).to(conv.weight.dtype))
+    conv.bias = nn.Parameter((bias * scale + shift).to(conv.weight.dtype))
+
+
+def _can_fold(conv, bn):
+    return type(conv) is nn.Conv2d and isinstance(bn, nn.BatchNorm2d) \
+        and bn.track_running_stats and bn.running_var is not None
+
+
+def _fold(conv, bn, folded):
+    # Modules can be reachable from more than one parent (the partial backbone shares its layers with the full
+    # one), so only fold each batch norm once, but still take it out of every parent.
+    if id(bn) not in folded:
+        fold_conv_bn(conv, bn)
+        folded[id(bn)] = bn
+
+
+def _fold_sequential(seq, folded):
+    """ Folds every Conv2d, BatchNorm2d pair in an nn.Sequential and leaves an Identity where the BN was. """
+    for idx in range(len(seq) - 1):
+        if _can_fold(seq[idx], seq[idx + 1]):
+            _fold(seq[idx], seq[idx + 1], folded)
+            seq[idx + 1] = nn.Identity()
+
+
+def _fold_attrs(module, folded):
+    for cls, pairs in _CONV_BN_ATTRS:
+        if not isinstance(module, cls):
+            continue
+        for conv_name, bn_name in pairs:
+            conv, bn = getattr(module, conv_name, None), getattr(module, bn_name, None)
+            if _can_fold(conv, bn):
+                _fold(conv, bn, folded)
+                setattr(module, bn_name, nn.Identity())
+
+
+def _fuse_relu(seq):
+    """
+    Merges Conv2d, ReLU pairs in an nn.Sequential (skipping the Identities left by folding) into one ConvReLU2d.
+    This doesn't change the float model, but it's what quantization needs to emit a single fused int8 kernel.
+    ReLU6 and LeakyReLU have no fused module to go to, so they're only made in place.
+    """
+    fused = 0
+    mods = list(seq)
+    for idx, m in enumerate(mods):
+        if isinstance(m, (nn.ReLU6, nn.LeakyReLU)):
+            m.inplace = True
+        if type(m) is not nn.Conv2d:
+            continue
+
+        nxt = idx + 1
+        while nxt < len(mods) and isinstance(mods[nxt], nn.Identity):
+            nxt += 1
+
+        if nxt < len(mods) and type(mods[nxt]) is nn.ReLU:
+            seq[idx] = ConvReLU2d(m, nn.ReLU(inplace=True))
+            seq[nxt] = nn.Identity()
+            mods[nxt] = seq[nxt]
+            fused += 1
+    return fused
+
+
+def optimize_for_inference(net):
+    """
+    Rewrites a Yolact model in place for inference and returns it:
+        - Every BatchNorm2d that directly follows a Conv2d is folded into that conv's weights and removed.
+        - Conv2d, ReLU pairs in Sequentials become a single ConvReLU2d.
+        - The heads that only exist for the extra training losses (class_existence_fc and semantic_seg_conv)
+          are deleted.
+
+    The outputs stay the same up to float rounding. The model can't be trained afterwards (the batch norm
+    statistics are gone), so net.train() raises, and the weights it saves don't load into a normal model.
+    Modules compiled with torch.jit (the FPN and flow net) are left as they are.
+    """
+    logger = logging.getLogger("yolact.eval")
+
+    net.eval()
+
+    folded = {}
+    for module in list(net.modules()):
+        if isinstance(module, torch.jit.ScriptModule):
+            continue
+        if isinstance(module, nn.Sequential):
+            _fold_sequential(module, folded)
+        _fold_attrs(module, folded)
+
+    fused = 0
+    for module in list(net.modules()):
+        if isinstance(module, nn.Sequential) and not isinstance(module, (ConvReLU2d, torch.jit.ScriptModule)):
+            fused += _fuse_relu(module)
+
+    removed = []
+    for name in ('class_existence_fc', 'semantic_seg_conv'):
+        if hasattr(net, name):
+            delattr(net, name)
+            removed.append(name)
+
+    net.inference_optimized = True
+
+    logger.info('Optimized for inference: folded {} batch norms, fused {} ReLUs, removed {}.'.format(
+        len(folded), fused, ', '.join(removed) if removed else 'no training branches'))
+
+    return net
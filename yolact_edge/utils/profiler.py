@@ -0,0 +1,404 @@
+import json
+import os
+import threading
+import time
+from collections import defaultdict, deque
+
+import numpy as np
+import torch
+
+
+class Region():
+    """ Everything recorded for one region (a path of nested names like 'Network Extra/backbone'). """
+
+    def __init__(self, max_samples):
+        self.count = 0
+        self.total_ns = 0
+        self.self_ns = 0
+        self.samples = deque(maxlen=max_samples)
+        self.device_samples = deque(maxlen=max_samples)
+        self.memory_samples = deque(maxlen=max_samples)
+
+
+class TraceRecorder():
+    """
+    Collects every region a Profiler times as a Chrome trace event (with the thread it ran on and the annotations
+    that thread had at the time), to be saved with save() and opened in chrome://tracing or ui.perfetto.dev.
+
+    Only the last max_events events are kept.
+    """
+
+    def __init__(self, max_events=1000000):
+        self.pid = os.getpid()
+        self.events = deque(maxlen=max_events)
+        self.thread_names = {}
+
+    def add(self, name, start_ns, end_ns, args=None):
+        thread = threading.current_thread()
+        self.thread_names[thread.ident] = thread.name
+
+        event = {'name': name, 'ph': 'X', 'ts': start_ns / 1000, 'dur': (end_ns - start_ns) / 1000,
+                 'pid': self.pid, 'tid': thread.ident}
+        if args:
+            event['args'] = args
+        self.events.append(event)
+
+    def save(self, path):
+        metadata = [{'name': 'thread_name', 'ph': 'M', 'pid': self.pid, 'tid': tid, 'args': {'name': name}}
+                    for tid, name in list(self.thread_names.items())]
+
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': metadata + list(self.events), 'displayTimeUnit': 'ms'}, f)
+
+
+def summarize_memory(samples):
+    """ The mean and max of the peak and retained bytes in samples of MemoryRecorder.exit, for each counter. """
+    summary = {}
+    for name in samples[0]:
+        peaks = np.array([sample[name][0] for sample in samples], dtype=np.float64)
+        retained = np.array([sample[name][1] for sample in samples], dtype=np.float64)
+        summary[name] = {'peak_mean': float(peaks.mean()), 'peak_max': int(peaks.max()),
+                         'retained_mean': float(retained.mean()), 'retained_max': int(retained.max())}
+    return summary
+
+
+class _Frame():
+    __slots__ = ('name', 'path', 'start', 'children', 'event', 'memory')
+
+    def __init__(self, name, path, start, event, memory):
+        self.name = name
+        self.path = path
+        self.start = start
+        self.children = 0
+        self.event = event
+        self.memory = memory
+
+
+class _NullRegion():
+    """ What region() returns when the profiler is disabled, so that a disabled region costs next to nothing. """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, e, ev, t):
+        return False
+
+
+_NULL_REGION = _NullRegion()
+
+
+class _ActiveRegion():
+    __slots__ = ('profiler', 'name', 'use_stack')
+
+    def __init__(self, profiler, name, use_stack):
+        self.profiler = profiler
+        self.name = name
+        self.use_stack = use_stack
+
+    def __enter__(self):
+        self.profiler.start(self.name, use_stack=self.use_stack)
+        return self
+
+    def __exit__(self, e, ev, t):
+        self.profiler.stop(self.name, use_stack=self.use_stack)
+        return False
+
+
+class Profiler():
+    """
+    A hierarchical profiler that's safe to use from several threads at once.
+
+    Every thread has its own stack of running regions, so nested regions from one thread never interfere with
+    another's. Each region is recorded under its path in the stack ('Network Extra/backbone'), with its total and
+    self (excluding nested regions) time in nanoseconds and a window of the last max_samples durations for the
+    percentiles in stats().
+
+    Separately, the self time of each region name since the last reset() is kept for the per-iteration table of
+    print_stats() and total_time(), which is what utils.timer has always reported.
+
+    Host timers measure when the Python code ran, which for asynchronous CUDA work isn't when the GPU ran it.
+    With device_events=True each region also records a pair of CUDA events, and stats() reports the time the GPU
+    took between them as well. This needs no synchronization until the stats are read.
+
+    If trace is set to a TraceRecorder, every region is also added to it as a trace event, along with whatever
+    the thread that ran it last passed to annotate() (e.g. the frame index and whether it was a keyframe).
+
+    If memory is set to a MemoryRecorder (see utils.memory), the peak and retained bytes of every nested region are
+    recorded too, and stats() summarizes them under 'memory'. Measuring memory takes time, which is counted in the
+    regions, so don't compare timings with and without it.
+
+    If metrics is set to a histogram with a 'stage' label (see utils.metrics), the duration of every region is
+    observed in it in seconds, labeled with its path.
+
+    When disabled, region() returns a shared no-op context manager and start / stop return immediately.
+    """
+
+    def __init__(self, enabled=True, max_samples=10000, device_events=False):
+        self.enabled = enabled
+        self.max_samples = max_samples
+        self.device_events = device_events
+
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+        self._regions = {}
+        self._iteration_ns = defaultdict(int)
+        self._disabled_names = set()
+        self._pending_events = []
+
+        self.trace = None
+        self.memory = None
+        self.metrics = None
+
+    def _state(self):
+        local = self._local
+        if not hasattr(local, 'stack'):
+            local.stack = []
+            local.free = {}
+            local.annotations = None
+        return local
+
+    def annotate(self, **annotations):
+        """ Attaches annotations to the trace events of every region this thread times from now on. """
+        self._state().annotations = annotations or None
+
+    def _event(self):
+        if not self.device_events or not torch.cuda.is_available():
+            return None
+        event = torch.cuda.Event(enable_timing=True)
+        event.record()
+        return event
+
+    def _record(self, name, path, start, elapsed, self_time, start_event, annotations, memory=None):
+        end_event = None
+        if start_event is not None:
+            end_event = torch.cuda.Event(enable_timing=True)
+            end_event.record()
+
+        with self._lock:
+            region = self._regions.get(path)
+            if region is None:
+                region = self._regions[path] = Region(self.max_samples)
+            region.count += 1
+            region.total_ns += elapsed
+            region.self_ns += self_time
+            region.samples.append(elapsed)
+            if memory is not None:
+                region.memory_samples.append(memory)
+
+            self._iteration_ns[name] += self_time
+
+            if start_event is not None:
+                self._pending_events.append((region, start_event, end_event))
+            if self.trace is not None:
+                self.trace.add(name, start, start + elapsed, annotations)
+            num_pending = len(self._pending_events)
+
+        if self.metrics is not None:
+            self.metrics.labels(stage=path).observe(elapsed / 1e9)
+
+        # Don't let events pile up forever if nobody reads the stats
+        if num_pending > self.max_samples:
+            self._resolve_events()
+
+    def start(self, name, use_stack=True):
+        """
+        Starts timing the region name. If use_stack is True, it's nested in the region this thread is in and
+        stop() ends it. Otherwise, it's timed on its own until stop(name, use_stack=False).
+        """
+        if not self.enabled:
+            return
+
+        state = self._state()
+        now = time.perf_counter_ns()
+
+        if use_stack:
+            path = name if not state.stack else state.stack[-1].path + '/' + name
+            memory = None
+            if self.memory is not None:
+                memory = self.memory.enter(state.stack[-1].memory if state.stack else None)
+                now = time.perf_counter_ns()
+            state.stack.append(_Frame(name, path, now, self._event(), memory))
+        else:
+            state.free[name] = (now, self._event())
+
+    def stop(self, name=None, use_stack=True):
+        """ Stops the innermost running region of this thread or, if use_stack is False, the region name. """
+        if not self.enabled:
+            return
+
+        now = time.perf_counter_ns()
+        state = self._state()
+
+        if use_stack:
+            if not state.stack:
+                print('Warning: timer stopped with no timer running!')
+                return
+
+            frame = state.stack.pop()
+            elapsed = now - frame.start
+            if state.stack:
+                state.stack[-1].children += elapsed
+
+            memory = None
+            if frame.memory is not None and self.memory is not None:
+                memory = self.memory.exit(frame.memory, state.stack[-1].memory if state.stack else None)
+
+            self._record(frame.name, frame.path, frame.start, elapsed, elapsed - frame.children, frame.event,
+                         state.annotations, memory)
+        else:
+            if name not in state.free:
+                print('Warning: timer for %s stopped before starting!' % name)
+                return
+
+            start, event = state.free.pop(name)
+            elapsed = now - start
+            self._record(name, name, start, elapsed, elapsed, event, state.annotations)
+
+    def region(self, name, use_stack=True):
+        """ A context manager that times its body as the region name. """
+        if not self.enabled:
+            return _NULL_REGION
+        return _ActiveRegion(self, name, use_stack)
+
+    def disable(self, name):
+        """ Leaves the region name out of total_time() and print_stats(). It's still in stats(). """
+        self._disabled_names.add(name)
+
+    def enable(self, name):
+        self._disabled_names.discard(name)
+
+    def reset(self):
+        """ Starts a new iteration for total_time() and print_stats(). Call this at the start of an iteration. """
+        with self._lock:
+            self._iteration_ns.clear()
+
+    def clear(self):
+        """ Forgets everything recorded so far. """
+        with self._lock:
+            self._iteration_ns.clear()
+            self._regions.clear()
+            self._pending_events.clear()
+
+    def iteration_times(self):
+        """ The self time in seconds of each region name since the last reset(). """
+        with self._lock:
+            return {name: ns / 1e9 for name, ns in self._iteration_ns.items() if name not in self._disabled_names}
+
+    def total_time(self):
+        """ The time in seconds spent in regions since the last reset(). """
+        return sum(self.iteration_times().values())
+
+    def _resolve_events(self):
+        with self._lock:
+            pending, self._pending_events = self._pending_events, []
+
+        for region, start_event, end_event in pending:
+            end_event.synchronize()
+            with self._lock:
+                region.device_samples.append(int(start_event.elapsed_time(end_event) * 1e6))
+
+    def stats(self):
+        """
+        Returns a dict from the path of each region to its count, total and self time and the mean, p50, p95 and
+        p99 of its last max_samples durations, all in ms. Regions timed with device events also have the mean and
+        percentiles of their GPU time under 'device'.
+
+        Regions measured with a MemoryRecorder have the mean and max of their peak and retained bytes for each
+        memory counter under 'memory', e.g. stats['Network/proto']['memory']['tensors']['peak_max'].
+        """
+        self._resolve_events()
+
+        def summarize(samples):
+            samples = np.array(samples, dtype=np.float64) / 1e6
+            p50, p95, p99 = np.percentile(samples, (50, 95, 99))
+            return {'mean': float(samples.mean()), 'p50': float(p50), 'p95': float(p95), 'p99': float(p99)}
+
+        # Other threads keep recording while this summarizes, so copy everything out under the lock
+        with self._lock:
+            regions = [(path, region.count, region.total_ns, region.self_ns, list(region.samples),
+                        list(region.device_samples), list(region.memory_samples))
+                       for path, region in self._regions.items()]
+
+        stats = {}
+        for path, count, total_ns, self_ns, samples, device_samples, memory_samples in regions:
+            stats[path] = {
+                'count': count,
+                'total': total_ns / 1e6,
+                'self': self_ns / 1e6,
+            }
+            stats[path].update(summarize(samples))
+            if device_samples:
+                stats[path]['device'] = summarize(device_samples)
+            if memory_samples:
+                stats[path]['memory'] = summarize_memory(memory_samples)
+        return stats
+
+    def print_stats(self):
+        """ Prints the time of each region since the last reset() into a table. """
+        print()
+
+        times = self.iteration_times()
+
+        max_name_width = max([len(k) for k in times.keys()] + [4])
+        if max_name_width % 2 == 1: max_name_width += 1
+        format_str = ' {:>%d} | {:>10.4f} ' % max_name_width
+
+        header = (' {:^%d} | {:^10} ' % max_name_width).format('Name', 'Time (ms)')
+        print(header)
+
+        sep_idx = header.find('|')
+        sep_text = ('-' * sep_idx) + '+' + '-' * (len(header)-sep_idx-1)
+        print(sep_text)
+
+        for name, seconds in times.items():
+            print(format_str.format(name, seconds*1000))
+
+        print(sep_text)
+        print(format_str.format('Total', sum(times.values())*1000))
+        print()
+
+    def print_summary(self):
+        """ Prints the count and percentiles of every region over everything recorded, nested by path. """
+        print()
+
+        stats = self.stats()
+        names = {path: '  ' * path.count('/') + path.split('/')[-1] for path in stats}
+
+        max_name_width = max([len(k) + len(' (device)') for k in names.values()] + [4])
+        header = (' {:<%d} | {:>7} | {:>9} | {:>9} | {:>9} | {:>9} ' % max_name_width).format(
+            'Name', 'Count', 'Mean (ms)', 'p50', 'p95', 'p99')
+        format_str = ' {:<%d} | {:>7d} | {:>9.3f} | {:>9.3f} | {:>9.3f} | {:>9.3f} ' % max_name_width
+
+        print(header)
+        print('-' * len(header))
+        for path in sorted(stats):
+            s = stats[path]
+            print(format_str.format(names[path], s['count'], s['mean'], s['p50'], s['p95'], s['p99']))
+            if 'device' in s:
+                d = s['device']
+                print(format_str.format(names[path] + ' (device)', s['count'], d['mean'], d['p50'], d['p95'], d['p99']))
+        print()
+
+    def print_memory_summary(self):
+        """ Prints the peak and retained memory of every region measured with a MemoryRecorder, nested by path. """
+        print()
+
+        stats = {path: s for path, s in self.stats().items() if 'memory' in s}
+        rows = []
+        for path in sorted(stats):
+            for counter, m in stats[path]['memory'].items():
+                name = '  ' * path.count('/') + path.split('/')[-1]
+                rows.append(('{} ({})'.format(name, counter), stats[path]['count'], m))
+
+        max_name_width = max([len(row[0]) for row in rows] + [4])
+        header = (' {:<%d} | {:>7} | {:>14} | {:>13} | {:>18} ' % max_name_width).format(
+            'Name', 'Count', 'Mean peak (MB)', 'Max peak (MB)', 'Mean retained (MB)')
+        format_str = ' {:<%d} | {:>7d} | {:>14.2f} | {:>13.2f} | {:>18.2f} ' % max_name_width
+
+        print(header)
+        print('-' * len(header))
+        for name, count, m in rows:
+            print(format_str.format(name, count, m['peak_mean'] / 2**20, m['peak_max'] / 2**20,
+                                    m['retained_mean'] / 2**20))
+        print()
@@ -0,0 +1,269 @@
+import copy
+import inspect
+import logging
+import time
+
+import numpy as np
+import torch
+from torch.fx import PH, symbolic_trace
+from torch.utils.data import Subset
+
+from yolact_edge.layers.box_utils import jaccard
+from yolact_edge.utils.misc import is_scripted
+from yolact_edge.utils.calibration import CalibrationImages, calibration_folders, iterate_batches
+from yolact_edge.yolact import PredictionModuleTRTWrapper
+
+
+def quantization_backend():
+    """ The quantized kernels to use on this machine: x86 (fbgemm + onednn) on Intel / AMD and qnnpack on ARM. """
+    engines = torch.backends.quantized.supported_engines
+    for engine in ('x86', 'fbgemm', 'qnnpack'):
+        if engine in engines:
+            return engine
+    raise RuntimeError('This build of PyTorch has no quantized CPU backend.')
+
+
+def _trace(module, concrete_args=None):
+    """
+    Traces module with FX, fixing the arguments in concrete_args, so that prepare_fx (which doesn't take concrete
+    args itself) sees a forward with a plain signature.
+    """
+    if concrete_args is None:
+        return module
+
+    gm = symbolic_trace(module, concrete_args=concrete_args)
+
+    # Tracing with an argument fixed to None leaves a guard on it in the graph that breaks when it's traced again
+    for node in list(gm.graph.nodes):
+        if node.op == 'call_function' and getattr(node.target, '__name__', '') == '_assert_is_none':
+            gm.graph.erase_node(node)
+    gm.recompile()
+
+    return gm
+
+
+class Int8Quantizer(object):
+    """
+    Post-training static quantization of Yolact for CPU inference, with PyTorch's FX graph mode quantization.
+
+    The backbone (and partial backbone), FPN, protonet and prediction heads are each traced, observed on the
+    calibration images and converted to int8, and then swapped into the model in place of the fp32 modules, much
+    like the TensorRT conversion does. They take and return fp32 tensors, so everything between them (flow, Detect
+    and the rest) is untouched and still runs in fp32.
+
+    TorchScript modules can't be traced by FX. On a machine with at most one GPU, the FPN and flow net are
+    compiled with torch.jit when yolact.py is imported, so run with PYTORCH_JIT=0 to have the FPN quantized as well.
+    """
+
+    def __init__(self, net, cfg, backend=None):
+        from torch.ao.quantization import get_default_qconfig_mapping
+
+        self.net = net
+        self.cfg = cfg
+        self.logger = logging.getLogger("yolact.eval")
+
+        self.backend = backend if backend is not None else quantization_backend()
+        torch.backends.quantized.engine = self.backend
+        self.qconfig_mapping = get_default_qconfig_mapping(self.backend)
+
+        # (parent, name, prepared module) for everything that's being quantized
+        self.prepared = []
+
+    def prepare(self, example_images):
+        """ Swaps observed versions of each part of the network in for calibration. """
+        from torch.ao.quantization.quantize_fx import prepare_fx
+
+        net, cfg = self.net, self.cfg
+
+        with torch.no_grad():
+            convouts = net.backbone(example_images)
+            selected = [convouts[i] for i in cfg.backbone.selected_layers]
+            num_selected = len(selected)
+
+            # Unused optional inputs of the FPN phases are fixed to None
+            unused_inputs = {'x{}'.format(i + 1): None for i in range(num_selected, 7)}
+
+            if cfg.flow is not None:
+                fpn_outs = net.fpn_phase_1(*selected)[:num_selected]
+                fpn_outs = net.fpn_phase_2(*fpn_outs)
+            elif cfg.fpn is not None:
+                fpn_outs = net.fpn(selected)
+            else:
+                fpn_outs = convouts
+
+        # ResNet backbones take a partial flag, which is always False by the time they're called
+        backbone_args = {'partial': False} if 'partial' in inspect.signature(net.backbone.forward).parameters else None
+
+        targets = [(net, 'backbone', (example_images,), backbone_args)]
+        if hasattr(net, 'partial_backbone'):
+            targets.append((net, 'partial_backbone', (example_images,), backbone_args))
+
+        if cfg.flow is not None:
+            # The non-keyframe path runs the last lateral layer on its own, so keep an fp32 copy of it around
+            if cfg.flow.warp_mode != 'take' and not hasattr(net, 'lat_layer'):
+                net.lat_layer = net.fpn_phase_1.lat_layers[-1]
+            targets.append((net, 'fpn_phase_1', tuple(selected), unused_inputs))
+            targets.append((net, 'fpn_phase_2', tuple(fpn_outs[:num_selected]), unused_inputs))
+        elif cfg.fpn is not None:
+            targets.append((net, 'fpn', (selected,), {'convouts': [PH] * num_selected}))
+
+        if hasattr(net, 'proto_net') and net.num_grids == 0:
+            proto_x = example_images if net.proto_src is None else fpn_outs[net.proto_src]
+            targets.append((net, 'proto_net', (proto_x,), None))
+
+        for idx, pred_layer in enumerate(net.prediction_layers):
+            # The priors are made in Python, so only the convs go through FX (the same split as for TensorRT)
+            wrapper = PredictionModuleTRTWrapper(pred_layer)
+            wrapper.pred_layer_torch = wrapper.pred_layer
+            net.prediction_layers[idx] = wrapper
+            targets.append((wrapper, 'pred_layer', (fpn_outs[net.selected_layers[idx]],), None))
+
+        for parent, name, example_inputs, concrete_args in targets:
+            module = getattr(parent, name)
+            if is_scripted(module):
+                self.logger.warning('Leaving {} in fp32 because it is a TorchScript module. '
+                                    'Run with PYTORCH_JIT=0 to quantize it.'.format(name))
+                continue
+
+            prepared = prepare_fx(_trace(module, concrete_args), self.qconfig_mapping, example_inputs)
+            setattr(parent, name, prepared)
+            self.prepared.append((parent, name, prepared))
+
+    def calibrate(self, images):
+        """
+        Runs keyframes through the network so that every observer sees real activations. images is a dataset of
+        [3, h, w] images (or a tensor of them), which is streamed through one image at a time.
+        """
+        extras = {"backbone": "full", "interrupt": False, "moving_statistics": None}
+
+        with torch.no_grad():
+            for img in iterate_batches(images):
+                self.net(img, extras=extras)
+
+                if hasattr(self.net, 'partial_backbone'):
+                    self.net.partial_backbone(img)
+
+    def convert(self):
+        from torch.ao.quantization.quantize_fx import convert_fx
+
+        for parent, name, prepared in self.prepared:
+            setattr(parent, name, convert_fx(prepared))
+
+        self.logger.info('Quantized {} to int8 ({} backend).'.format(
+            ', '.join(sorted(set(name for _, name, _ in self.prepared))), self.backend))
+
+
+def _run(net, img):
+    extras = {"backbone": "full", "interrupt": False, "moving_statistics": None}
+
+    with torch.no_grad():
+        start = time.perf_counter()
+        dets = net(img, extras=extras)['pred_outs'][0]
+        elapsed = time.perf_counter() - start
+
+    return dets, elapsed
+
+
+def quantization_report(fp32_net, int8_net, images, score_threshold=0.3, iou_threshold=0.5, warmup=2):
+    """
+    Compares int8_net against fp32_net on images (a dataset of [3, h, w] images), one image at a time. Accuracy is measured against the fp32
+    detections, since calibration images don't have ground truth: a confident (> score_threshold) fp32 detection
+    counts as matched if the int8 model found the same class with an IoU of at least iou_threshold.
+
+    Returns a dict with the median latency of both models in ms, the fraction of fp32 detections matched, the mean
+    IoU and the mean absolute score difference of the matches.
+    """
+    for i in range(min(warmup, len(images))):
+        _run(fp32_net, images[i][None])
+        _run(int8_net, images[i][None])
+
+    fp32_times, int8_times = [], []
+    num_dets = num_matched = 0
+    ious, score_diffs = [], []
+
+    for i in range(len(images)):
+        img = images[i][None]
+        fp32_dets, fp32_time = _run(fp32_net, img)
+        int8_dets, int8_time = _run(int8_net, img)
+        fp32_times.append(fp32_time)
+        int8_times.append(int8_time)
+
+        if fp32_dets is None:
+            continue
+
+        keep = fp32_dets['score'] > score_threshold
+        boxes, classes, scores = fp32_dets['box'][keep], fp32_dets['class'][keep], fp32_dets['score'][keep]
+        num_dets += boxes.size(0)
+
+        if int8_dets is None or boxes.size(0) == 0 or int8_dets['box'].size(0) == 0:
+            continue
+
+        overlaps = jaccard(boxes.float(), int8_dets['box'].float())
+        overlaps[classes[:, None] != int8_dets['class'][None, :]] = 0
+        best_iou, best_idx = overlaps.max(dim=1)
+
+        matched = best_iou >= iou_threshold
+        num_matched += int(matched.sum())
+        ious.extend(best_iou[matched].tolist())
+        score_diffs.extend((scores[matched] - int8_dets['score'][best_idx[matched]]).abs().tolist())
+
+    fp32_ms = float(np.median(fp32_times)) * 1000
+    int8_ms = float(np.median(int8_times)) * 1000
+
+    return {
+        'images': len(images),
+        'fp32_ms': fp32_ms,
+        'int8_ms': int8_ms,
+        'speedup': fp32_ms / max(int8_ms, 1e-9),
+        'detections': num_dets,
+        'matched': num_matched / max(num_dets, 1),
+        'mean_iou': float(np.mean(ious)) if ious else 0.,
+        'mean_score_diff': float(np.mean(score_diffs)) if score_diffs else 0.,
+    }
+
+
+def quantize_int8(net, cfg, args, transform, report=True):
+    """
+    Quantizes net to int8 for the CPU in place, calibrating on the images in cfg.dataset.calib_images (or
+    args.calib_images). This is the CPU counterpart to convert_to_tensorrt.
+
+    If report is set, a fifth of the calibration images are held out and used to compare the int8 model against
+    fp32 with quantization_report, which is logged and returned. Otherwise this returns None.
+    """
+    logger = logging.getLogger("yolact.eval")
+
+    if args.cuda:
+        raise ValueError('Int8 quantization is for CPU inference. Run with --cuda=False.')
+
+    calib_images = args.calib_images if args.calib_images is not None else cfg.dataset.calib_images
+    # Video calibration sets are split into keyframes and the frames after them; we only need keyframes
+    calib_images, _ = calibration_folders(calib_images)
+
+    images = CalibrationImages(calib_images, transform, cfg.torch2trt_max_calibration_images)
+    logger.info('Using {} calibration images from {}.'.format(len(images), calib_images))
+
+    num_report = len(images) // 5 if report else 0
+    if report and num_report == 0:
+        logger.warning('Too few calibration images to hold any out, so the report uses the calibration images.')
+        calib_set = report_set = images
+    else:
+        num_calib = len(images) - num_report
+        calib_set = Subset(images, range(num_calib))
+        report_set = Subset(images, range(num_calib, len(images)))
+
+    fp32_net = copy.deepcopy(net) if report else None
+
+    quantizer = Int8Quantizer(net, cfg)
+    logger.info('Calibrating on {} images...'.format(len(calib_set)))
+    quantizer.prepare(calib_set[0][None])
+    quantizer.calibrate(calib_set)
+    quantizer.convert()
+
+    if not report:
+        return None
+
+    results = quantization_report(fp32_net, net, report_set)
+    logger.info('int8 vs fp32 on {images} held out images: {fp32_ms:.1f} ms -> {int8_ms:.1f} ms ({speedup:.2f}x), '
+                '{matched:.1%} of {detections} detections matched with a mean IoU of {mean_iou:.3f} and a mean '
+                'score difference of {mean_score_diff:.3f}.'.format(**results))
+    return results
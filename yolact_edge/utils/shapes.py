@@ -0,0 +1,102 @@
+import logging
+
+import torch
+
+from yolact_edge.data.config import cfg
+
+
+# The parts of Yolact that get converted to TensorRT or exported on their own, by attribute path. The ones a
+# model doesn't have are skipped. lat_layer and the prediction layers are added in record_input_shapes.
+_PARTS = ('backbone', 'partial_backbone', 'fpn', 'fpn_phase_1', 'fpn_phase_2', 'proto_net', 'spa',
+          'flow_net', 'flow_net.flow_net')
+
+
+def image_size():
+    """ The (width, height) of the network input, from cfg.max_size. """
+    if type(cfg.max_size) == tuple:
+        return cfg.max_size
+    return cfg.max_size, cfg.max_size
+
+
+def _get_part(net, path):
+    module = net
+    for name in path.split('.'):
+        module = getattr(module, name, None)
+        if module is None:
+            return None
+    return module
+
+
+def _tensor_shapes(args):
+    shapes = []
+    for arg in args:
+        if torch.is_tensor(arg):
+            shapes.append(tuple(arg.size()))
+        elif isinstance(arg, (list, tuple)):
+            shapes.extend(_tensor_shapes(arg))
+    return shapes
+
+
+def record_input_shapes(net):
+    """
+    Runs a dummy keyframe of size cfg.max_size through net (and for models that warp features, a non-keyframe
+    after it) and records what each of the parts that get converted to TensorRT or exported is called with.
+
+    Returns a dict from the attribute path of each part (e.g. 'fpn_phase_1' or 'prediction_layers.0') to the
+    shapes of the tensors it took, in order and with a batch size of 1. Parts that didn't run aren't in it.
+    """
+    logger = logging.getLogger("yolact.model.shapes")
+
+    parts = {path: _get_part(net, path) for path in _PARTS}
+    parts = {path: module for path, module in parts.items() if module is not None}
+
+    for idx, pred_layer in enumerate(net.prediction_layers):
+        parts['prediction_layers.{}'.format(idx)] = pred_layer
+
+    if hasattr(net, 'fpn_phase_1') and cfg.flow.warp_mode not in ('none', 'take'):
+        parts['lat_layer'] = net.lat_layer if hasattr(net, 'lat_layer') else net.fpn_phase_1.lat_layers[-1]
+
+    shapes = {}
+
+    def record(path):
+        def hook(module, args):
+            # Parts that are called more than once (the backbone with a partial flag) keep their first call
+            shapes.setdefault(path, _tensor_shapes(args))
+        return hook
+
+    handles = [module.register_forward_pre_hook(record(path)) for path, module in parts.items()]
+
+    width, height = image_size()
+    device = next(net.parameters()).device
+    x = torch.zeros(1, 3, height, width, device=device)
+
+    was_training = net.training
+    net.eval()
+
+    try:
+        with torch.no_grad():
+            if cfg.flow is None or cfg.flow.warp_mode == 'none':
+                net(x, extras={"backbone": "full", "interrupt": False, "moving_statistics": None})
+            else:
+                outs = net(x, extras={"backbone": "full", "interrupt": False, "keep_statistics": True,
+                                      "moving_statistics": None})
+                net(x, extras={"backbone": "partial", "interrupt": False,
+                               "moving_statistics": {"lateral": outs["lateral"], "feats": outs["feats"]}})
+    finally:
+        for handle in handles:
+            handle.remove()
+        if was_training:
+            net.train()
+
+    for path in sorted(shapes):
+        logger.debug('{}: {}'.format(path, ', '.join(str(shape) for shape in shapes[path])))
+
+    return shapes
+
+
+def dummy_inputs(input_shapes, path, device=None, fn=torch.ones):
+    """ Inputs of the shapes recorded for path, made with fn (torch.ones, torch.randn, ...), to convert it with. """
+    if path not in input_shapes:
+        raise KeyError('No input shapes were recorded for {}. It didn\'t run in a forward pass at cfg.max_size.'
+                       .format(path))
+    return [fn(shape, device=device) for shape in input_shapes[path]]
@@ -1,10 +1,81 @@
 import logging
-import numpy as np
 import torch
-import cv2
-from pathlib import Path
-import math
-import os
+
+from yolact_edge.utils.calibration import ActivationCache, CalibrationImages, calibration_folders
+from yolact_edge.utils.trt_cache import weights_hash, calibration_fingerprint
+
+def collect_calibration_activations(net, cfg, images, next_images=None, protonet=True, flow_net=True, device=None):
+    """
+    Runs the calibration images through net and returns what the protonet and the flow net were called with, as
+    datasets to calibrate them on (None for the ones not asked for). Each image in images runs as a keyframe and,
+    for the flow net, the matching image in next_images runs as the non-keyframe after it.
+
+    The images are streamed through one batch at a time and the activations are written straight to an
+    ActivationCache next to the weights, so memory use doesn't grow with the number of calibration images. Later
+    conversions with the same weights, config and calibration images read them back from there.
+    """
+    logger = logging.getLogger("yolact.eval")
+
+    cache = ActivationCache(net.model_path + '.calib', {
+        'weights': weights_hash(net),
+        'max_size': cfg.max_size,
+        'backbone': cfg.backbone.name,
+        'calib_images': calibration_fingerprint(net.calib_images),
+        'max_calibration_images': cfg.torch2trt_max_calibration_images,
+    })
+
+    targets = {}
+    if protonet:
+        targets['proto_net'] = net.proto_net
+    if flow_net:
+        targets['flow_net'] = net.flow_net.flow_net
+
+    missing = [name for name in targets if not cache.has(name)]
+    if missing:
+        num_images = len(images) if 'flow_net' not in missing else min(len(images), len(next_images))
+        logger.debug('Generating calibration dataset for {} with {} images...'.format(', '.join(missing), num_images))
+
+        writers = {name: cache.writer(name, num_images) for name in missing}
+        # The protonet runs on every frame, but only keyframes go in its calibration set
+        recording = set()
+
+        def hook(name):
+            def forward_hook(module, inputs, outputs):
+                if name in recording:
+                    writers[name].write(inputs[0])
+            return forward_hook
+
+        handles = [targets[name].register_forward_hook(hook(name)) for name in missing]
+
+        batches = images.batches(device=device)
+        if 'flow_net' in missing:
+            batches = zip(batches, next_images.batches(device=device))
+        else:
+            batches = ((batch, None) for batch in batches)
+
+        try:
+            with torch.no_grad():
+                for batch, next_batch in batches:
+                    recording.update(name for name in missing if name != 'flow_net')
+                    outs = net(batch, extras={"backbone": "full", "keep_statistics": True, "moving_statistics": None})
+                    recording.clear()
+
+                    if next_batch is not None:
+                        recording.add('flow_net')
+                        net(next_batch, extras={"backbone": "partial", "moving_statistics": {
+                            "lateral": outs["lateral"],
+                            "feats": outs["feats"],
+                        }})
+                        recording.clear()
+        finally:
+            for handle in handles:
+                handle.remove()
+
+        for writer in writers.values():
+            writer.close()
+
+    return [cache.load(name) if name in targets else None for name in ('proto_net', 'flow_net')]
+
 
 def convert_to_tensorrt(net, cfg, args, transform):
     logger = logging.getLogger("yolact.eval")
@@ -28,6 +99,7 @@ def convert_to_tensorrt(net, cfg, args, transform):
         return
 
     net.model_path = args.trained_model
+    net.calib_images = args.calib_images if args.calib_images is not None else cfg.dataset.calib_images
 
     if args.use_tensorrt_safe_mode:
         cfg.use_tensorrt_safe_mode = True
@@ -35,121 +107,25 @@ def convert_to_tensorrt(net, cfg, args, transform):
 
     calibration_dataset = None
     calibration_protonet_dataset = None
-    calibration_ph_dataset = None
-    calibration_fpn_dataset = None
     calibration_flow_net_dataset = None
 
-    if (cfg.torch2trt_backbone_int8 or cfg.torch2trt_protonet_int8 or cfg.torch2trt_flow_net_int8):
-        if (not cfg.torch2trt_backbone_int8 or net.has_trt_cached_module('backbone', True)) and \
-            (not cfg.torch2trt_protonet_int8 or net.has_trt_cached_module('proto_net', True)) and \
-                (not cfg.torch2trt_flow_net_int8 or net.has_trt_cached_module('flow_net', True)):
-            logger.debug('Skipping generation of calibration dataset for backbone/flow_net because there is cache...')
-        else:
-            logger.debug('Generating calibration dataset for backbone of {} images...'.format(cfg.torch2trt_max_calibration_images))
-
-            calib_images = cfg.dataset.calib_images
-            if args.calib_images is not None:
-                calib_images = args.calib_images
-
-            def pull_calib_dataset(calib_folder, transform=transform, max_calibration_images=cfg.torch2trt_max_calibration_images):
-                images = []
-                paths = [str(x) for x in Path(calib_folder).glob('*')]
-                paths = paths[:max_calibration_images]
-                for path in paths:
-                    img = cv2.imread(path)
-                    height, width, _ = img.shape
-
-                    img, _, _, _ = transform(img, np.zeros((1, height, width), dtype=np.float), np.array([[0, 0, 1, 1]]),
-                        {'num_crowds': 0, 'labels': np.array([0])})
-
-                    images.append(torch.from_numpy(img).permute(2, 0, 1))
-
-                calibration_dataset = torch.stack(images)
-                if args.cuda:
-                    calibration_dataset = calibration_dataset.cuda()
-                return calibration_dataset
-
-            if ':' in calib_images:
-                calib_dir, prev_folder, next_folder = calib_images.split(':')
-                prev_dir = os.path.join(calib_dir, prev_folder)
-                next_dir = os.path.join(calib_dir, next_folder)
-
-                calibration_dataset = pull_calib_dataset(prev_dir)
-                calibration_next_dataset = pull_calib_dataset(next_dir)
-            else:
-                calibration_dataset = pull_calib_dataset(calib_images)
-
-    n_images_per_batch = 1
-    if cfg.torch2trt_protonet_int8:
-        if net.has_trt_cached_module('proto_net', True):
-            logger.debug('Skipping generation of calibration dataset for protonet because there is cache...')
+    if cfg.torch2trt_backbone_int8 or cfg.torch2trt_protonet_int8 or cfg.torch2trt_flow_net_int8:
+        # These only read images as they're used, so there's no cost to making them when everything is cached
+        prev_folder, next_folder = calibration_folders(net.calib_images)
+        calibration_dataset = CalibrationImages(prev_folder, transform, cfg.torch2trt_max_calibration_images)
+        calibration_next_dataset = None
+        if next_folder is not None:
+            calibration_next_dataset = CalibrationImages(next_folder, transform, cfg.torch2trt_max_calibration_images)
+
+        protonet = cfg.torch2trt_protonet_int8 and not net.has_trt_cached_module('proto_net', True)
+        flow_net = cfg.torch2trt_flow_net_int8 and not net.has_trt_cached_module('flow_net', True)
+
+        if protonet or flow_net:
+            calibration_protonet_dataset, calibration_flow_net_dataset = collect_calibration_activations(
+                net, cfg, calibration_dataset, calibration_next_dataset, protonet=protonet, flow_net=flow_net,
+                device='cuda' if args.cuda else None)
         else:
-            logger.debug('Generating calibration dataset for protonet with {} images...'.format(cfg.torch2trt_max_calibration_images))
-            calibration_protonet_dataset = []
-
-            def forward_hook(self, inputs, outputs):
-                calibration_protonet_dataset.append(inputs[0])
-
-            proto_net_handle = net.proto_net.register_forward_hook(forward_hook)
-
-    if (cfg.torch2trt_protonet_int8 or cfg.torch2trt_flow_net_int8):
-        if (not cfg.torch2trt_protonet_int8 or net.has_trt_cached_module('proto_net', True)) and (not cfg.torch2trt_flow_net_int8 or net.has_trt_cached_module('flow_net', True)):
             logger.debug('Skipping generation of calibration dataset for protonet/flow_net because there is cache...')
-        else:
-            with torch.no_grad():
-                laterals = []
-                f1, f2, f3 = [], [], []
-                for i in range(math.ceil(cfg.torch2trt_max_calibration_images / n_images_per_batch)):
-                    gt_forward_out = net(calibration_dataset[i*n_images_per_batch:(i+1)*n_images_per_batch], extras={
-                        "backbone": "full",
-                        "keep_statistics": True,
-                        "moving_statistics": None
-                    })
-                    laterals.append(gt_forward_out["lateral"])
-                    f1.append(gt_forward_out["feats"][0])
-                    f2.append(gt_forward_out["feats"][1])
-                    f3.append(gt_forward_out["feats"][2])
-
-            laterals = torch.cat(laterals, dim=0)
-            f1 = torch.cat(f1, dim=0)
-            f2 = torch.cat(f2, dim=0)
-            f3 = torch.cat(f3, dim=0)
-
-    if cfg.torch2trt_protonet_int8:
-        if net.has_trt_cached_module('proto_net', True):
-            logger.debug('Skipping generation of calibration dataset for protonet because there is cache...')
-        else:
-            proto_net_handle.remove()
-            calibration_protonet_dataset = torch.cat(calibration_protonet_dataset, dim=0)
-
-    if cfg.torch2trt_flow_net_int8:
-        if net.has_trt_cached_module('flow_net', True):
-            logger.debug('Skipping generation of calibration dataset for flow_net because there is cache...')
-        else:
-            logger.debug('Generating calibration dataset for flow_net with {} images...'.format(cfg.torch2trt_max_calibration_images))
-            calibration_flow_net_dataset = []
-
-            def forward_hook(self, inputs, outputs):
-                calibration_flow_net_dataset.append(inputs[0])
-
-            handle = net.flow_net.flow_net.register_forward_hook(forward_hook)
-            for i in range(math.ceil(cfg.torch2trt_max_calibration_images / n_images_per_batch)):
-                extras = {
-                    "backbone": "partial",
-                    "moving_statistics": {
-                        "lateral": laterals[i*n_images_per_batch:(i+1)*n_images_per_batch],
-                        "feats": [
-                            f1[i*n_images_per_batch:(i+1)*n_images_per_batch],
-                            f2[i*n_images_per_batch:(i+1)*n_images_per_batch],
-                            f3[i*n_images_per_batch:(i+1)*n_images_per_batch]
-                        ]
-                    }
-                }
-                with torch.no_grad():
-                    net(calibration_next_dataset[i*n_images_per_batch:(i+1)*n_images_per_batch], extras=extras)
-            handle.remove()
-
-            calibration_flow_net_dataset = torch.cat(calibration_flow_net_dataset, dim=0)
 
     if cfg.torch2trt_backbone or cfg.torch2trt_backbone_int8:
         logger.info("Converting backbone to TensorRT...")
@@ -176,4 +152,5 @@ def convert_to_tensorrt(net, cfg, args, transform):
         logger.info('Converting flow_net to TensorRT...')
         net.to_tensorrt_flow_net(cfg.torch2trt_flow_net_int8, calibration_dataset=calibration_flow_net_dataset, batch_size=args.trt_batch_size)
 
-    logger.info("Converted to TensorRT.")
\ No newline at end of file
+    logger.info("Converted to TensorRT.")
+    logger.info("TensorRT engine cache: {hits} hits, {misses} misses, {evictions} evicted.".format(**net.trt_engine_cache().stats()))
\ No newline at end of file
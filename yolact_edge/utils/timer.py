@@ -1,131 +1,101 @@
-import time
-from collections import defaultdict
+from yolact_edge.utils.profiler import Profiler, TraceRecorder
+from yolact_edge.utils.memory import MemoryRecorder, default_counters
 
-_total_times = defaultdict(lambda:  0)
-_start_times = defaultdict(lambda: -1)
-_disabled_names = set()
-_timer_stack = []
-_running_timer = None
-_disable_all = False
+profiler = Profiler()
 
 def disable_all():
-    global _disable_all
-    _disable_all = True
+    profiler.enabled = False
 
 def enable_all():
-    global _disable_all
-    _disable_all = False
+    profiler.enabled = True
+
+def use_device_events(enabled=True):
+    """ Also time regions with CUDA events, for the time the GPU spent on them. See Profiler. """
+    profiler.device_events = enabled
+
+def start_trace(max_events=1000000):
+    """ Starts recording every timer as a Chrome trace event. See TraceRecorder. """
+    profiler.trace = TraceRecorder(max_events)
+
+def save_trace(path):
+    """ Writes the events recorded since start_trace to path as Chrome trace JSON. """
+    if profiler.trace is not None:
+        profiler.trace.save(path)
+
+def start_memory(device=None, counters=None):
+    """
+    Starts measuring the peak and retained memory of every timer, with the given counters or the default ones for
+    device. See MemoryRecorder. This slows everything down, so it's for finding out where memory goes only.
+    """
+    stop_memory()
+    profiler.memory = MemoryRecorder(counters if counters is not None else default_counters(device))
+    profiler.memory.start()
+
+def stop_memory():
+    """ Stops measuring memory. What was measured so far stays in stats(). """
+    if profiler.memory is not None:
+        profiler.memory.stop()
+        profiler.memory = None
+
+def annotate(**annotations):
+    """ Tags the trace events of this thread's timers from now on, e.g. with annotate(frame=3, keyframe=True). """
+    profiler.annotate(**annotations)
 
 def disable(fn_name):
     """ Disables the given function name fom being considered for the average or outputted in print_stats. """
-    _disabled_names.add(fn_name)
+    profiler.disable(fn_name)
 
 def enable(fn_name):
     """ Enables function names disabled by disable. """
-    _disabled_names.remove(fn_name)
+    profiler.enable(fn_name)
 
 def reset():
     """ Resets the current timer. Call this at the start of an iteration. """
-    global _running_timer
-    _total_times.clear()
-    _start_times.clear()
-    _timer_stack.clear()
-    _running_timer = None
+    profiler.reset()
 
 def start(fn_name, use_stack=True):
     """
     Start timing the specific function.
-    Note: If use_stack is True, only one timer can be active at a time.
-          Once you stop this timer, the previous one will start again.
+    Note: If use_stack is True, the timer is nested in the one this thread is running (which doesn't count the
+          time spent in this one) until it's stopped.
     """
-    global _running_timer, _disable_all
-    
-    if _disable_all:
-        return
-
-    if use_stack:
-        if _running_timer is not None:
-            stop(_running_timer, use_stack=False)
-            _timer_stack.append(_running_timer)
-        start(fn_name, use_stack=False)
-        _running_timer = fn_name
-    else:
-        _start_times[fn_name] = time.perf_counter()
+    profiler.start(fn_name, use_stack=use_stack)
 
 def stop(fn_name=None, use_stack=True):
     """
-    If use_stack is True, this will stop the currently running timer and restore
-    the previous timer on the stack if that exists. Note if use_stack is True,
-    fn_name will be ignored.
+    If use_stack is True, this will stop the timer this thread started last and go back to the one it's nested
+    in. Note if use_stack is True, fn_name will be ignored.
 
     If use_stack is False, this will just stop timing the timer fn_name.
     """
-    global _running_timer, _disable_all
-
-    if _disable_all:
-        return
-
-    if use_stack:
-        if _running_timer is not None:
-            stop(_running_timer, use_stack=False)
-            if len(_timer_stack) > 0:
-                _running_timer = _timer_stack.pop()
-                start(_running_timer, use_stack=False)
-            else:
-                _running_timer = None
-        else:
-            print('Warning: timer stopped with no timer running!')
-    else:
-        if _start_times[fn_name] > -1:
-            _total_times[fn_name] += time.perf_counter() - _start_times[fn_name]
-        else:
-            print('Warning: timer for %s stopped before starting!' % fn_name)
-
+    profiler.stop(fn_name, use_stack=use_stack)
 
 def print_stats():
     """ Prints the current timing information into a table. """
-    print()
-
-    all_fn_names = [k for k in _total_times.keys() if k not in _disabled_names]
+    profiler.print_stats()
 
-    max_name_width = max([len(k) for k in all_fn_names] + [4])
-    if max_name_width % 2 == 1: max_name_width += 1
-    format_str = ' {:>%d} | {:>10.4f} ' % max_name_width
+def print_summary():
+    """ Prints the percentiles of every timer over everything so far. """
+    profiler.print_summary()
 
-    header = (' {:^%d} | {:^10} ' % max_name_width).format('Name', 'Time (ms)')
-    print(header)
+def print_memory_summary():
+    """ Prints the memory of every timer measured since start_memory. """
+    profiler.print_memory_summary()
 
-    sep_idx = header.find('|')
-    sep_text = ('-' * sep_idx) + '+' + '-' * (len(header)-sep_idx-1)
-    print(sep_text)
-
-    for name in all_fn_names:
-        print(format_str.format(name, _total_times[name]*1000))
-    
-    print(sep_text)
-    print(format_str.format('Total', total_time()*1000))
-    print()
+def stats():
+    """ See Profiler.stats. """
+    return profiler.stats()
 
 def total_time():
     """ Returns the total amount accumulated across all functions in seconds. """
-    return sum([elapsed_time for name, elapsed_time in _total_times.items() if name not in _disabled_names])
+    return profiler.total_time()
 
 
-class env():
+def env(fn_name, use_stack=True):
     """
-    A class that lets you go:
+    A function that lets you go:
         with timer.env(fn_name):
             # (...)
     That automatically manages a timer start and stop for you.
     """
-
-    def __init__(self, fn_name, use_stack=True):
-        self.fn_name = fn_name
-        self.use_stack = use_stack
-
-    def __enter__(self):
-        start(self.fn_name, use_stack=self.use_stack)
-
-    def __exit__(self, e, ev, t):
-        stop(self.fn_name, use_stack=self.use_stack)
-
+    return profiler.region(fn_name, use_stack=use_stack)
@@ -0,0 +1,169 @@
+import hashlib
+import json
+import logging
+import os
+import time
+from pathlib import Path
+
+import torch
+
+
+MANIFEST_VERSION = 1
+
+
+def manifest_path(model_path):
+    """ Where the manifest for the TensorRT engines cached next to the weights at model_path is kept. """
+    return model_path + '.trt.json'
+
+
+def weights_hash(module):
+    """
+    A hash of the contents of every parameter and buffer of module, in order. Names aren't included, so a module
+    and a wrapper around it hash the same.
+    """
+    sha = hashlib.sha1()
+    for tensor in module.state_dict().values():
+        if not torch.is_tensor(tensor):
+            continue
+        tensor = tensor.detach().cpu().contiguous()
+        sha.update('{}{}'.format(tensor.dtype, tuple(tensor.size())).encode())
+        sha.update(tensor.reshape(-1).view(torch.uint8).numpy().tobytes())
+    return sha.hexdigest()
+
+
+def calibration_fingerprint(calib_images):
+    """
+    A hash of the names, sizes and modification times of the calibration images. calib_images is a folder, or
+    dir:prev_folder:next_folder for video models like in convert_to_tensorrt.
+    """
+    if calib_images is None:
+        return None
+
+    if ':' in calib_images:
+        calib_dir, *folders = calib_images.split(':')
+        folders = [os.path.join(calib_dir, folder) for folder in folders]
+    else:
+        folders = [calib_images]
+
+    sha = hashlib.sha1()
+    for folder in folders:
+        for path in sorted(Path(folder).glob('*')):
+            stat = path.stat()
+            sha.update('{}:{}:{}\n'.format(path.relative_to(folder), stat.st_size, int(stat.st_mtime)).encode())
+    return sha.hexdigest()
+
+
+def library_versions():
+    """ The versions of everything an engine depends on. Engines aren't portable across any of these. """
+    versions = {'torch': torch.__version__, 'cuda': torch.version.cuda, 'cudnn': None, 'device': None,
+                'tensorrt': None, 'torch2trt': None}
+
+    if torch.cuda.is_available():
+        versions['cudnn'] = torch.backends.cudnn.version()
+        versions['device'] = torch.cuda.get_device_name()
+
+    try:
+        import tensorrt
+        versions['tensorrt'] = tensorrt.__version__
+    except ImportError:
+        pass
+
+    try:
+        import torch2trt
+        versions['torch2trt'] = getattr(torch2trt, '__version__', 'unknown')
+    except ImportError:
+        pass
+
+    return versions
+
+
+def _normalize(obj):
+    # Keys go through JSON in the manifest, so compare them the way they'll come back out (tuples become lists)
+    return json.loads(json.dumps(obj, sort_keys=True))
+
+
+class EngineCache(object):
+    """
+    Keeps track of which cached TensorRT engine was built from what, in a JSON manifest next to the weights.
+
+    Each engine file has an entry in the manifest with the key it was built for: a dict of everything that changes
+    the engine, like the hash of the module's weights, the relevant config, the input shapes and the library
+    versions. lookup() only counts an engine as a hit if it's on disk and its key is the same as the one asked for.
+    Engines that don't match (or that aren't in the manifest, e.g. ones from before there was one) are deleted, so
+    they're rebuilt instead of silently reused.
+
+    Nothing here needs TensorRT, the engines themselves are just files.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.logger = logging.getLogger("yolact.model.trt_cache")
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self.entries = {}
+        if os.path.isfile(path):
+            try:
+                with open(path, 'r') as f:
+                    manifest = json.load(f)
+                if manifest.get('version') == MANIFEST_VERSION:
+                    self.entries = manifest['entries']
+                else:
+                    self.logger.warning('Ignoring TensorRT cache manifest {} from another version.'.format(path))
+            except (ValueError, KeyError) as e:
+                self.logger.warning('Ignoring unreadable TensorRT cache manifest {}: {}'.format(path, e))
+
+    def _name(self, engine_path):
+        # Entries are keyed by file name so the weights and their engines can be moved around together
+        return os.path.basename(engine_path)
+
+    def is_valid(self, engine_path, key):
+        """ Whether there's an engine at engine_path built for key. Doesn't touch the cache or the stats. """
+        entry = self.entries.get(self._name(engine_path))
+        return os.path.isfile(engine_path) and entry is not None and entry['key'] == _normalize(key)
+
+    def mismatches(self, engine_path, key):
+        """ The fields of key that differ from what the engine at engine_path was built for. """
+        entry = self.entries.get(self._name(engine_path))
+        if entry is None:
+            return None
+        key = _normalize(key)
+        fields = set(key) | set(entry['key'])
+        return sorted(field for field in fields if key.get(field) != entry['key'].get(field))
+
+    def lookup(self, engine_path, key):
+        """ Returns whether the engine at engine_path can be used for key, evicting it if it can't. """
+        if self.is_valid(engine_path, key):
+            self.hits += 1
+            return True
+
+        self.misses += 1
+        if os.path.isfile(engine_path):
+            mismatches = self.mismatches(engine_path, key)
+            reason = 'it isn\'t in the manifest' if mismatches is None else '{} changed'.format(', '.join(mismatches))
+            self.logger.info('Evicting stale TensorRT engine {} because {}.'.format(engine_path, reason))
+            self.evict(engine_path)
+        return False
+
+    def store(self, engine_path, key):
+        """ Records that the engine just written to engine_path was built for key. """
+        self.entries[self._name(engine_path)] = {'key': _normalize(key), 'created': time.time()}
+        self.save()
+
+    def evict(self, engine_path):
+        if os.path.isfile(engine_path):
+            os.remove(engine_path)
+        if self.entries.pop(self._name(engine_path), None) is not None:
+            self.save()
+        self.evictions += 1
+
+    def save(self):
+        tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump({'version': MANIFEST_VERSION, 'entries': self.entries}, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
@@ -17,7 +17,11 @@ from yolact_edge.backbone import construct_backbone
 
 import torch.backends.cudnn as cudnn
 from yolact_edge.utils import timer
+from yolact_edge.utils.buffers import BufferPool
 from yolact_edge.utils.functions import MovingAverage
+from yolact_edge.utils.checkpoint import atomic_save
+from yolact_edge.utils.shapes import record_input_shapes, dummy_inputs
+from yolact_edge.utils.trt_cache import EngineCache, manifest_path, weights_hash, calibration_fingerprint, library_versions
 
 import logging
 import os
@@ -33,7 +37,8 @@ except:
 
 # This is required for Pytorch 1.0.1 on Windows to initialize Cuda on some driver versions.
 # See the bug report here: https://github.com/pytorch/pytorch/issues/17108
-torch.cuda.current_device()
+if torch.cuda.is_available():
+    torch.cuda.current_device()
 
 # As of March 10, 2019, Pytorch DataParallel still doesn't support JIT Script Modules
 use_jit = False if use_torch2trt else torch.cuda.device_count() <= 1
@@ -205,19 +210,7 @@ class PredictionModule(nn.Module):
         conv_h = x.size(2)
         conv_w = x.size(3)
         
-        if cfg.extra_head_net is not None:
-            x = src.upfeature(x)
-        
-        if cfg.use_prediction_module:
-            # The two branches of PM design (c)
-            a = src.block(x)
-            
-            b = src.conv(x)
-            b = src.bn(b)
-            b = F.relu(b)
-            
-            # TODO: Possibly switch this out for a product
-            x = a + b
+        x = self.head_features(x)
 
         bbox_x = src.bbox_extra(x)
         conf_x = src.conf_extra(x)
@@ -259,6 +252,36 @@ class PredictionModule(nn.Module):
         
         return preds
     
+    def head_features(self, x):
+        """ The features the head layers run on: x through the extra head net and prediction module, if any. """
+        src = self if self.parent[0] is None else self.parent[0]
+
+        if cfg.extra_head_net is not None:
+            x = src.upfeature(x)
+        
+        if cfg.use_prediction_module:
+            # The two branches of PM design (c)
+            a = src.block(x)
+            
+            b = src.conv(x)
+            b = src.bn(b)
+            b = F.relu(b)
+            
+            # TODO: Possibly switch this out for a product
+            x = a + b
+
+        return x
+
+    def head_outputs(self, x):
+        """
+        The raw outputs of the bbox, conf and mask layers for x, each [batch_size, num_priors * k, conv_h, conv_w],
+        before they're reshaped to one row per prior or go through any activation.
+        """
+        src = self if self.parent[0] is None else self.parent[0]
+        x = self.head_features(x)
+
+        return src.bbox_layer(src.bbox_extra(x)), src.conf_layer(src.conf_extra(x)), src.mask_layer(src.mask_extra(x))
+
     def make_priors(self, conv_h, conv_w):
         """ Note that priors are [x,y,width,height] where (x,y) is the center of the box. """
         
@@ -549,23 +572,18 @@ class PredictionModuleTRTWrapper(nn.Module):
         self.pred_layer = PredictionModuleTRT(*pred_layer.params[:-2], None, pred_layer.params[-1])
 
         pred_layer_w = pred_layer.parent[0] if pred_layer.parent[0] is not None else pred_layer
-        self.pred_layer.load_state_dict(pred_layer_w.state_dict())
 
-    def to_tensorrt(self, int8_mode=False, calibration_dataset=None, batch_size=1):
+        # Share the layers instead of copying their weights, so this also works once they've been optimized
+        for name, module in pred_layer_w.named_children():
+            setattr(self.pred_layer, name, module)
+
+    def to_tensorrt(self, input_size, int8_mode=False, calibration_dataset=None, batch_size=1):
         if int8_mode:
             trt_fn = partial(torch2trt, int8_mode=True, int8_calib_dataset=calibration_dataset, strict_type_constraints=True, max_batch_size=batch_size)
         else:
             trt_fn = partial(torch2trt, fp16_mode=True, strict_type_constraints=True, max_batch_size=batch_size)
 
-        input_sizes = [
-                (1, 256, 69, 69),
-                (1, 256, 35, 35),
-                (1, 256, 18, 18),
-                (1, 256, 9, 9),
-                (1, 256, 5, 5),
-        ]
-
-        x = torch.ones(input_sizes[self.pred_layer.index]).cuda()
+        x = torch.ones(input_size).cuda()
         self.pred_layer_torch = self.pred_layer
         self.pred_layer = trt_fn(self.pred_layer, [x])
 
@@ -1176,72 +1194,73 @@ class Yolact(nn.Module):
         # For use in evaluation
         self.detect = Detect(cfg.num_classes, bkg_label=0, top_k=200, conf_thresh=0.05, nms_thresh=0.5)
 
+        # See use_output_buffers, use_channels_last and use_fused_heads
+        self.output_buffers = None
+        self.channels_last = False
+        self.fused_heads = False
+
     def save_weights(self, path):
         """ Saves the model's weights using compression because the file sizes were getting too big. """
-        torch.save(self.state_dict(), path)
+        atomic_save(self.state_dict(), path)
     
     def load_weights(self, path, args=None):
         """ Loads weights from a compressed save file. """
-        state_dict = torch.load(path, map_location='cpu')
-
-        # Get all possible weights
+        try:
+            # Memory map the checkpoint so tensors are only read in as they're copied into the model
+            state_dict = torch.load(path, map_location='cpu', mmap=True)
+        except (TypeError, RuntimeError):
+            # mmap needs Pytorch 2.1+ and a checkpoint in the zipfile format
+            state_dict = torch.load(path, map_location='cpu')
+
+        # Get all possible weights. These share storage with the model, so this doesn't copy anything.
         cur_state_dict = self.state_dict()
 
+        drop_weight_keys = []
         if args is not None and args.drop_weights is not None:
             drop_weight_keys = args.drop_weights.split(',')
-        
-        transfered_from_yolact = False
 
-        for key in list(state_dict.keys()):
+        def is_dropped(key):
+            return any(key.startswith(drop_key) for drop_key in drop_weight_keys)
+
+        new_state_dict = {}
+        keys_not_used = []
+        keys_mismatch = []
+
+        # Resolve all the key remapping in one pass over the checkpoint
+        for key, value in state_dict.items():
             # For backward compatability, remove these (the new variable is called layers)
             if key.startswith('backbone.layer') and not key.startswith('backbone.layers'):
-                del state_dict[key]
-        
+                continue
+
             # Also for backward compatibility with v1.0 weights, do this check
             if key.startswith('fpn.downsample_layers.'):
                 if cfg.fpn is not None and int(key.split('.')[2]) >= cfg.fpn.num_downsample:
-                    del state_dict[key]
+                    continue
 
-            if args is not None and args.drop_weights is not None:
-                for drop_key in drop_weight_keys:
-                    if key.startswith(drop_key):
-                        del state_dict[key]
+            if is_dropped(key):
+                continue
 
+            # Split pretrained FPN weights from YOLACT into the two phase FPN
             if key.startswith('fpn.lat_layers'):
-                transfered_from_yolact = True
-                state_dict[key.replace('fpn.', 'fpn_phase_1.')] = state_dict[key]
-                del state_dict[key]
-            elif key.startswith('fpn.') and key in state_dict:
-                transfered_from_yolact = True
-                state_dict[key.replace('fpn.', 'fpn_phase_2.')] = state_dict[key]
-                del state_dict[key]
-
-        keys_not_exist = []
-        keys_not_used = []
-        keys_mismatch = []
-
-        for key in list(cur_state_dict.keys()):
-            if args is not None and args.drop_weights is not None:
-                for drop_key in drop_weight_keys:
-                    if key.startswith(drop_key):
-                        state_dict[key] = cur_state_dict[key]
-
-            # for compatibility with models without existing modules
-            if key not in state_dict:
-                keys_not_exist.append(key)
-                state_dict[key] = cur_state_dict[key]
-            else:
-                # check key size mismatches
-                if state_dict[key].size() != cur_state_dict[key].size():
-                    keys_mismatch.append(key)
-                    state_dict[key] = cur_state_dict[key]
-
+                key = key.replace('fpn.', 'fpn_phase_1.')
+            elif key.startswith('fpn.'):
+                key = key.replace('fpn.', 'fpn_phase_2.')
 
-        # for compatibility with models with simpler architectures, remove unused weights.
-        for key in list(state_dict.keys()):
+            # for compatibility with models with simpler architectures, remove unused weights.
             if key not in cur_state_dict:
                 keys_not_used.append(key)
-                del state_dict[key]
+            # dropped weights keep their current values
+            elif is_dropped(key):
+                continue
+            # check key size mismatches
+            elif value.size() != cur_state_dict[key].size():
+                keys_mismatch.append(key)
+            else:
+                new_state_dict[key] = value
+
+        # for compatibility with models without existing modules
+        keys_not_exist = [key for key in cur_state_dict
+                          if key not in new_state_dict and key not in keys_mismatch and not is_dropped(key)]
 
         logger = logging.getLogger("yolact.model.load")
         if len(keys_not_used) > 0:
@@ -1256,7 +1275,8 @@ class Yolact(nn.Module):
         if args is not None and (args.coco_transfer or args.yolact_transfer):
             logger.warning("`--coco_transfer` or `--yolact_transfer` is no longer needed. The code will automatically detect and convert YOLACT-trained weights now.")
 
-        self.load_state_dict(state_dict)
+        # Anything not in new_state_dict keeps the value it has now, so this can copy straight into the parameters
+        self.load_state_dict(new_state_dict, strict=False)
 
         if not self.training:
             self.create_partial_backbone()
@@ -1321,6 +1341,9 @@ class Yolact(nn.Module):
                         module.bias.data.zero_()
 
     def train(self, mode=True):
+        if mode and getattr(self, 'inference_optimized', False):
+            raise RuntimeError('This model was optimized for inference (see optimize_for_inference) and can\'t be trained.')
+
         super().train(mode)
 
         if cfg.freeze_bn:
@@ -1439,6 +1462,89 @@ class Yolact(nn.Module):
         if hasattr(self, "flow_net"):
             self.flow_net = FlowNetMiniTRTWrapper(self.flow_net)
 
+    def use_output_buffers(self, num_slots=1):
+        """
+        Writes the concatenated prediction heads, the softmaxed scores and the prototypes of every frame into
+        buffers that are reused from frame to frame (see BufferPool), instead of allocating them every time. This
+        only applies to inference. Outputs are overwritten num_slots frames later, so use them before that.
+        Pass num_slots=0 to go back to allocating them.
+        """
+        self.output_buffers = BufferPool(num_slots) if num_slots > 0 else None
+
+    def use_channels_last(self):
+        """
+        Converts the weights to the channels last memory format and makes forward convert its input to it too,
+        which makes convolutions faster on most CPUs (and on GPUs with tensor cores). Every layer keeps its output in
+        that format, so the permutes to [n, h, w, c] of the prototypes and prediction heads become free views.
+        """
+        self.to(memory_format=torch.channels_last)
+        self.channels_last = True
+
+    def use_fused_heads(self, enabled=True):
+        """
+        Runs the prediction heads of every FPN level straight into one tensor per output, in prior order (see
+        fused_pred_heads), instead of permuting each level's outputs into their own tensors and concatenating
+        them. Falls back to the usual path for anything can_fuse_heads doesn't support.
+        """
+        self.fused_heads = enabled
+
+    def can_fuse_heads(self):
+        """ Whether the prediction heads can run fused for the current config and mode. """
+        return (not self.training and cfg.eval_mask_branch and cfg.mask_type in (mask_type.direct, mask_type.lincomb)
+                and not (cfg.use_instance_coeff or cfg.use_yolo_regressors or cfg.mask_proto_coeff_gate
+                         or cfg.mask_proto_prototypes_as_features)
+                and all(type(pred_layer) is PredictionModule for pred_layer in self.prediction_layers))
+
+    def fused_pred_heads(self, outs, buffers=None):
+        """
+        The same predictions as running every prediction layer and concatenating their outputs, but each head's
+        output is copied once, from its [n, h, w, c] view straight into its rows of the output (which is taken
+        from buffers, if given). With share_prediction_module every level runs the same layers.
+        """
+        layers = list(zip(self.selected_layers, self.prediction_layers))
+        x = outs[self.selected_layers[0]]
+        batch_size = x.size(0)
+
+        num_rows = [outs[idx].size(2) * outs[idx].size(3) * pred_layer.num_priors for idx, pred_layer in layers]
+        dims = {'loc': 4, 'conf': cfg.num_classes, 'mask': cfg.mask_dim}
+
+        pred_outs = {}
+        for k, dim in dims.items():
+            size = (batch_size, sum(num_rows), dim)
+            if buffers is None:
+                pred_outs[k] = torch.empty(size, dtype=x.dtype, device=x.device)
+            else:
+                pred_outs[k] = buffers.get(k, size, x.dtype, x.device)
+
+        priors = []
+        start = 0
+        for (idx, pred_layer), rows in zip(layers, num_rows):
+            # A hack for the way dataparallel works
+            if cfg.share_prediction_module and pred_layer is not self.prediction_layers[0]:
+                pred_layer.parent = [self.prediction_layers[0]]
+
+            conv_h, conv_w = outs[idx].size()[2:]
+            for k, out in zip(dims, pred_layer.head_outputs(outs[idx])):
+                pred_outs[k][:, start:start + rows].view(batch_size, conv_h, conv_w, -1).copy_(out.permute(0, 2, 3, 1))
+
+            priors.append(pred_layer.make_priors(conv_h, conv_w))
+            start += rows
+
+        # The masks are this frame's own tensor, so activate them in place where the activation allows it
+        activation = torch.sigmoid if cfg.mask_type == mask_type.direct else cfg.mask_proto_coeff_activation
+        if activation in (torch.sigmoid, torch.tanh):
+            activation(pred_outs['mask'], out=pred_outs['mask'])
+        else:
+            pred_outs['mask'] = activation(pred_outs['mask'])
+
+        if buffers is None:
+            pred_outs['priors'] = torch.cat(priors, -2)
+        else:
+            size = (sum(num_rows), 4)
+            pred_outs['priors'] = torch.cat(priors, -2, out=buffers.get('priors', size, priors[0].dtype, priors[0].device))
+
+        return pred_outs
+
     def create_partial_backbone(self):
         if cfg.flow.warp_mode == 'none':
             return
@@ -1446,40 +1552,87 @@ class Yolact(nn.Module):
         logger = logging.getLogger("yolact.model.load")
         logger.debug("Creating partial backbone...")
 
-        backbone = construct_backbone(cfg.backbone)
-        backbone.load_state_dict(self.backbone.state_dict())
-        backbone.layers = backbone.layers[:2]
+        # A shallow copy of the backbone with only the first two layers. It shares every module (and so every
+        # parameter) with self.backbone, so it costs no extra memory, but it's still its own module for TensorRT.
+        backbone = copy.copy(self.backbone)
+        backbone._parameters = backbone._parameters.copy()
+        backbone._buffers = backbone._buffers.copy()
+        backbone._modules = backbone._modules.copy()
+        backbone.layers = self.backbone.layers[:2]
 
         self.partial_backbone = backbone
         logger.debug("Partial backbone created...")
     
+    def trt_input_shapes(self):
+        """ The input shapes of the parts that get converted to TensorRT (see record_input_shapes), recorded once. """
+        if not hasattr(self, 'input_shapes'):
+            self.input_shapes = record_input_shapes(self)
+        return self.input_shapes
+
+    def trt_inputs(self, path, fn=torch.ones):
+        """ Example inputs on the GPU to convert the part at path with. """
+        return dummy_inputs(self.trt_input_shapes(), path, device='cuda', fn=fn)
+
     def _get_trt_cache_path(self, module_name, int8_mode=False, batch_size=1):
         return "{}.{}{}{}.trt".format(self.model_path, module_name, ".int8_{}".format(cfg.torch2trt_max_calibration_images) if int8_mode else "", "_bs_{}".format(batch_size))
 
-    def has_trt_cached_module(self, module_name, int8_mode=False, batch_size=1):
+    def trt_engine_cache(self):
+        """ The manifest of the TensorRT engines cached next to self.model_path. """
+        if not hasattr(self, 'engine_cache'):
+            self.engine_cache = EngineCache(manifest_path(self.model_path))
+        return self.engine_cache
+
+    def _get_trt_cache_key(self, module_name, int8_mode=False, batch_size=1, parent=None):
+        """ Everything the engine for parent.module_name depends on. See EngineCache. """
+        module = getattr(self if parent is None else parent, module_name)
+        return {
+            'module': module_name,
+            'int8': bool(int8_mode),
+            'batch_size': batch_size,
+            'weights': weights_hash(module),
+            'config': {
+                'max_size': cfg.max_size,
+                'backbone': cfg.backbone.name,
+                'selected_layers': list(cfg.backbone.selected_layers),
+                'use_tensorrt_safe_mode': cfg.use_tensorrt_safe_mode,
+                'torch2trt_max_calibration_images': cfg.torch2trt_max_calibration_images if int8_mode else None,
+            },
+            'input_shapes': self.trt_input_shapes(),
+            'calibration': calibration_fingerprint(getattr(self, 'calib_images', None)) if int8_mode else None,
+            'versions': library_versions(),
+        }
+
+    def has_trt_cached_module(self, module_name, int8_mode=False, batch_size=1, parent=None):
         module_path = self._get_trt_cache_path(module_name, int8_mode, batch_size)
-        return os.path.isfile(module_path)
+        key = self._get_trt_cache_key(module_name, int8_mode, batch_size, parent)
+        return self.trt_engine_cache().is_valid(module_path, key)
 
-    def load_trt_cached_module(self, module_name, int8_mode=False, batch_size=1):
+    def load_trt_cached_module(self, module_name, int8_mode=False, batch_size=1, parent=None, key=None):
         module_path = self._get_trt_cache_path(module_name, int8_mode, batch_size)
-        if not os.path.isfile(module_path):
+        if key is None:
+            key = self._get_trt_cache_key(module_name, int8_mode, batch_size, parent)
+        if not self.trt_engine_cache().lookup(module_path, key):
             return None
         module = TRTModule()
         module.load_state_dict(torch.load(module_path))
         return module
 
-    def save_trt_cached_module(self, module, module_name, int8_mode=False, batch_size=1):
+    def save_trt_cached_module(self, module, module_name, int8_mode=False, batch_size=1, key=None):
         module_path = self._get_trt_cache_path(module_name, int8_mode, batch_size)
         torch.save(module.state_dict(), module_path)
+        if key is not None:
+            self.trt_engine_cache().store(module_path, key)
 
     def trt_load_if(self, module_name, trt_fn, trt_fn_params, int8_mode=False, parent=None, batch_size=1):
         if parent is None: parent=self
         if not hasattr(parent, module_name): return
         module = getattr(parent, module_name)
-        trt_cache = self.load_trt_cached_module(module_name, int8_mode, batch_size=batch_size)
+        # The key has to be taken from the PyTorch module, before it's converted
+        key = self._get_trt_cache_key(module_name, int8_mode, batch_size, parent)
+        trt_cache = self.load_trt_cached_module(module_name, int8_mode, batch_size=batch_size, key=key)
         if trt_cache is None:
             module = trt_fn(module, trt_fn_params)
-            self.save_trt_cached_module(module, module_name, int8_mode, batch_size=batch_size)
+            self.save_trt_cached_module(module, module_name, int8_mode, batch_size=batch_size, key=key)
         else:
             module = trt_cache
 
@@ -1493,11 +1646,11 @@ class Yolact(nn.Module):
         else:
             trt_fn = partial(torch2trt, fp16_mode=True, strict_type_constraints=True, max_batch_size=batch_size)
 
-        x = torch.ones((1, 3, cfg.max_size, cfg.max_size)).cuda()
-        # self.backbone = trt_fn(self.backbone, [x])
-        # self.partial_backbone = trt_fn(self.partial_backbone, [x])
-        self.trt_load_if("backbone", trt_fn, [x], int8_mode, batch_size=batch_size)
-        self.trt_load_if("partial_backbone", trt_fn, [x], int8_mode, batch_size=batch_size)
+        x = self.trt_inputs("backbone")
+        # self.backbone = trt_fn(self.backbone, x)
+        # self.partial_backbone = trt_fn(self.partial_backbone, x)
+        self.trt_load_if("backbone", trt_fn, x, int8_mode, batch_size=batch_size)
+        self.trt_load_if("partial_backbone", trt_fn, x, int8_mode, batch_size=batch_size)
 
     def to_tensorrt_protonet(self, int8_mode=False, calibration_dataset=None, batch_size=1):
         """Converts ProtoNet to a TRTModule.
@@ -1507,9 +1660,9 @@ class Yolact(nn.Module):
         else:
             trt_fn = partial(torch2trt, fp16_mode=True, strict_type_constraints=True, max_batch_size=batch_size)
 
-        x = torch.ones((1, 256, 69, 69)).cuda()
-        # self.proto_net = trt_fn(self.proto_net, [x])
-        self.trt_load_if("proto_net", trt_fn, [x], int8_mode, batch_size=batch_size)
+        x = self.trt_inputs("proto_net")
+        # self.proto_net = trt_fn(self.proto_net, x)
+        self.trt_load_if("proto_net", trt_fn, x, int8_mode, batch_size=batch_size)
 
     def to_tensorrt_fpn(self, int8_mode=False, calibration_dataset=None, batch_size=1):
         """Converts FPN to a TRTModule.
@@ -1519,52 +1672,20 @@ class Yolact(nn.Module):
         else:
             trt_fn = partial(torch2trt, fp16_mode=True, strict_type_constraints=True, max_batch_size=batch_size)
 
+        input_shapes = self.trt_input_shapes()
         self.lat_layer = self.fpn_phase_1.lat_layers[-1]
 
-        if cfg.backbone.name == "ResNet50" or cfg.backbone.name == "ResNet101":
-            x = [
-                torch.randn(1, 512, 69, 69).cuda(),
-                torch.randn(1, 1024, 35, 35).cuda(),
-                torch.randn(1, 2048, 18, 18).cuda(),
-                ]
-        elif cfg.backbone.name == "MobileNetV2":
-            x = [
-                torch.randn(1, 32, 69, 69).cuda(),
-                torch.randn(1, 64, 35, 35).cuda(),
-                torch.randn(1, 160, 18, 18).cuda(),
-                ]
-        else:
-            raise ValueError("Backbone: {} is not currently supported with TensorRT.".format(cfg.backbone.name))
-
+        x = self.trt_inputs("fpn_phase_1", fn=torch.randn)
         self.trt_load_if("fpn_phase_1", trt_fn, x, int8_mode, batch_size=batch_size)
 
-        if cfg.backbone.name == "ResNet50" or cfg.backbone.name == "ResNet101":
-            x = [
-                torch.randn(1, 256, 69, 69).cuda(),
-                torch.randn(1, 256, 35, 35).cuda(),
-                torch.randn(1, 256, 18, 18).cuda(),
-                ]
-        elif cfg.backbone.name == "MobileNetV2":
-            x = [
-                torch.randn(1, 256, 69, 69).cuda(),
-                torch.randn(1, 256, 35, 35).cuda(),
-                torch.randn(1, 256, 18, 18).cuda(),
-                ]
-        else:
-            raise ValueError("Backbone: {} is not currently supported with TensorRT.".format(cfg.backbone.name))
-
+        x = self.trt_inputs("fpn_phase_2", fn=torch.randn)
         self.trt_load_if("fpn_phase_2", trt_fn, x, int8_mode, batch_size=batch_size)
 
         trt_fn = partial(torch2trt, fp16_mode=True, strict_type_constraints=True)
 
-        if cfg.backbone.name == "ResNet50" or cfg.backbone.name == "ResNet101":
-            x = torch.randn(1, 512, 69, 69).cuda()
-        elif cfg.backbone.name == "MobileNetV2":
-            x = torch.randn(1, 32, 69, 69).cuda()
-        else:
-            raise ValueError("Backbone: {} is not currently supported with TensorRT.".format(cfg.backbone.name))
-
-        self.trt_load_if("lat_layer", trt_fn, [x], int8_mode=False, batch_size=batch_size)
+        # The lateral layer only runs by itself on non-keyframes, and its input is the first input to the FPN
+        x = self.trt_inputs("lat_layer" if "lat_layer" in input_shapes else "fpn_phase_1", fn=torch.randn)[:1]
+        self.trt_load_if("lat_layer", trt_fn, x, int8_mode=False, batch_size=batch_size)
 
     def to_tensorrt_prediction_head(self, int8_mode=False, calibration_dataset=None, batch_size=1):
         """Converts Prediction Head to a TRTModule.
@@ -1574,9 +1695,11 @@ class Yolact(nn.Module):
         else:
             trt_fn = partial(torch2trt, fp16_mode=True, strict_type_constraints=True, max_batch_size=batch_size)
 
+        input_shapes = self.trt_input_shapes()
+
         for idx, pred_layer in enumerate(self.prediction_layers):
             pred_layer = PredictionModuleTRTWrapper(pred_layer)
-            pred_layer.to_tensorrt(batch_size=batch_size)
+            pred_layer.to_tensorrt(input_shapes["prediction_layers.{}".format(idx)][0], batch_size=batch_size)
             self.prediction_layers[idx] = pred_layer
 
     def to_tensorrt_spa(self, int8_mode=False, calibration_dataset=None, batch_size=1):
@@ -1587,11 +1710,8 @@ class Yolact(nn.Module):
         else:
             trt_fn = partial(torch2trt, fp16_mode=True, strict_type_constraints=True, max_batch_size=batch_size)
 
-        c3 = torch.ones((1, 256, 69, 69)).cuda()
-        f2 = torch.ones((1, 256, 35, 35)).cuda()
-        f3 = torch.ones((1, 256, 18, 18)).cuda()
-
-        self.trt_load_if("spa", trt_fn, [c3, f2, f3], int8_mode, parent=self.spa, batch_size=batch_size)
+        x = self.trt_inputs("spa")
+        self.trt_load_if("spa", trt_fn, x, int8_mode, parent=self.spa, batch_size=batch_size)
 
     def to_tensorrt_flow_net(self, int8_mode=False, calibration_dataset=None, batch_size=1):
         """Converts FlowNet to a TRTModule.
@@ -1602,11 +1722,9 @@ class Yolact(nn.Module):
             trt_fn = partial(torch2trt, fp16_mode=True, strict_type_constraints=True, max_batch_size=batch_size)
 
 
-        lateral_channels = cfg.fpn.num_features
-        if len(cfg.flow.reduce_channels) > 0:
-            lateral_channels = cfg.flow.reduce_channels[-1]
-        x = torch.ones((1, lateral_channels * 2, 69, 69)).cuda()
-        self.trt_load_if("flow_net", trt_fn, [x], int8_mode, parent=self.flow_net, batch_size=batch_size)
+        # What gets converted is the flow net inside FlowNetMiniTRTWrapper, which takes both laterals concatenated
+        x = self.trt_inputs("flow_net.flow_net")
+        self.trt_load_if("flow_net", trt_fn, x, int8_mode, parent=self.flow_net, batch_size=batch_size)
 
     def forward(self, x, extras=None):
         """ The input should be of size [batch_size, 3, img_h, img_w] """
@@ -1616,6 +1734,13 @@ class Yolact(nn.Module):
 
         outs_wrapper = {}
 
+        buffers = None if self.training else self.output_buffers
+        if buffers is not None:
+            buffers.next_frame()
+
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
+
         with timer.env('backbone'):
             if cfg.flow is None or extras is None or extras["backbone"] == "full":
                 outs = self.backbone(x)
@@ -1718,7 +1843,7 @@ class Yolact(nn.Module):
                 proto_x = x if self.proto_src is None else outs[self.proto_src]
                 
                 if self.num_grids > 0:
-                    grids = self.grid.repeat(proto_x.size(0), 1, 1, 1)
+                    grids = self.grid.expand(proto_x.size(0), -1, -1, -1)
                     proto_x = torch.cat([proto_x, grids], dim=1)
 
                 proto_out = self.proto_net(proto_x)
@@ -1733,40 +1858,62 @@ class Yolact(nn.Module):
                         proto_downsampled = proto_out.detach()
                 
                 # Move the features last so the multiplication is easy
-                proto_out = proto_out.permute(0, 2, 3, 1).contiguous()
+                proto_out = proto_out.permute(0, 2, 3, 1)
+                if buffers is None:
+                    proto_out = proto_out.contiguous()
+                else:
+                    proto_out = buffers.get('proto', proto_out.size(), proto_out.dtype, proto_out.device).copy_(proto_out)
 
                 if cfg.mask_proto_bias:
                     bias_shape = [x for x in proto_out.size()]
                     bias_shape[-1] = 1
-                    proto_out = torch.cat([proto_out, torch.ones(*bias_shape)], -1)
-
-        with timer.env('pred_heads'):
-            pred_outs = { 'loc': [], 'conf': [], 'mask': [], 'priors': [] }
+                    if buffers is None:
+                        proto_out = torch.cat([proto_out, torch.ones(*bias_shape)], -1)
+                    else:
+                        size = list(proto_out.size())
+                        size[-1] += 1
+                        proto_bias = buffers.get('proto_bias', size, proto_out.dtype, proto_out.device)
+                        proto_bias[..., :-1] = proto_out
+                        proto_bias[..., -1] = 1
+                        proto_out = proto_bias
+
+        if self.fused_heads and self.can_fuse_heads():
+            with timer.env('pred_heads'):
+                pred_outs = self.fused_pred_heads(outs, buffers)
+        else:
+            with timer.env('pred_heads'):
+                pred_outs = { 'loc': [], 'conf': [], 'mask': [], 'priors': [] }
 
-            if cfg.use_instance_coeff:
-                pred_outs['inst'] = []
+                if cfg.use_instance_coeff:
+                    pred_outs['inst'] = []
 
-            for idx, pred_layer in zip(self.selected_layers, self.prediction_layers):
-                pred_x = outs[idx]
+                for idx, pred_layer in zip(self.selected_layers, self.prediction_layers):
+                    pred_x = outs[idx]
 
-                if cfg.mask_type == mask_type.lincomb and cfg.mask_proto_prototypes_as_features:
-                    # Scale the prototypes down to the current prediction layer's size and add it as inputs
-                    proto_downsampled = F.interpolate(proto_downsampled, size=outs[idx].size()[2:], mode='bilinear', align_corners=False)
-                    pred_x = torch.cat([pred_x, proto_downsampled], dim=1)
+                    if cfg.mask_type == mask_type.lincomb and cfg.mask_proto_prototypes_as_features:
+                        # Scale the prototypes down to the current prediction layer's size and add it as inputs
+                        proto_downsampled = F.interpolate(proto_downsampled, size=outs[idx].size()[2:], mode='bilinear', align_corners=False)
+                        pred_x = torch.cat([pred_x, proto_downsampled], dim=1)
 
-                # This is re-enabled during training or non-TRT inference.
-                if self.training or not (cfg.torch2trt_prediction_module or cfg.torch2trt_prediction_module_int8):
-                    # A hack for the way dataparallel works
-                    if cfg.share_prediction_module and pred_layer is not self.prediction_layers[0]:
-                        pred_layer.parent = [self.prediction_layers[0]]
+                    # This is re-enabled during training or non-TRT inference.
+                    if self.training or not (cfg.torch2trt_prediction_module or cfg.torch2trt_prediction_module_int8):
+                        # A hack for the way dataparallel works
+                        if cfg.share_prediction_module and pred_layer is not self.prediction_layers[0]:
+                            pred_layer.parent = [self.prediction_layers[0]]
 
-                p = pred_layer(pred_x)
+                    p = pred_layer(pred_x)
                 
-                for k, v in p.items():
-                    pred_outs[k].append(v)
+                    for k, v in p.items():
+                        pred_outs[k].append(v)
 
-        for k, v in pred_outs.items():
-            pred_outs[k] = torch.cat(v, -2)
+            with timer.env('pred_cat'):
+                for k, v in pred_outs.items():
+                    if buffers is None:
+                        pred_outs[k] = torch.cat(v, -2)
+                    else:
+                        size = list(v[0].size())
+                        size[-2] = sum(x.size(-2) for x in v)
+                        pred_outs[k] = torch.cat(v, -2, out=buffers.get(k, size, v[0].dtype, v[0].device))
 
         if proto_out is not None:
             pred_outs['proto'] = proto_out
@@ -1783,12 +1930,18 @@ class Yolact(nn.Module):
         else:
             if cfg.use_sigmoid_focal_loss:
                 # Note: even though conf[0] exists, this mode doesn't train it so don't use it
-                pred_outs['conf'] = torch.sigmoid(pred_outs['conf'])
+                if buffers is None:
+                    pred_outs['conf'] = torch.sigmoid(pred_outs['conf'])
+                else:
+                    torch.sigmoid(pred_outs['conf'], out=pred_outs['conf'])
             elif cfg.use_objectness_score:
                 # See focal_loss_sigmoid in multibox_loss.py for details
                 objectness = torch.sigmoid(pred_outs['conf'][:, :, 0])
                 pred_outs['conf'][:, :, 1:] = objectness[:, :, None] * F.softmax(pred_outs['conf'][:, :, 1:], -1)
                 pred_outs['conf'][:, :, 0 ] = 1 - objectness
+            elif buffers is not None:
+                conf = pred_outs['conf']
+                pred_outs['conf'] = torch.softmax(conf, -1, out=buffers.get('conf_softmax', conf.size(), conf.dtype, conf.device))
             else:
                 pred_outs['conf'] = F.softmax(pred_outs['conf'], -1)
 